@@ -3,6 +3,8 @@ import os
 import numpy as np
 import numpy.ctypeslib as clib
 
+from .SeisLocnp import _phases, _grid, _peaks, _norm, _cells, _map_shape
+
 c_int = clib.ctypes.c_int
 c_int8 = clib.ctypes.c_int8
 c_int16 = clib.ctypes.c_int16
@@ -11,11 +13,31 @@ c_int64 = clib.ctypes.c_int64
 c_dbl = clib.ctypes.c_double
 c_dPt = clib.ndpointer(dtype=np.float64, flags="C_CONTIGUOUS")
 c_dPt = clib.ndpointer(dtype=np.float64, flags="C_CONTIGUOUS")
+c_fPt = clib.ndpointer(dtype=np.float32, flags="C_CONTIGUOUS")
 c_i8Pt = clib.ndpointer(dtype=np.int8, flags="C_CONTIGUOUS")
 c_i16Pt = clib.ndpointer(dtype=np.int16, flags="C_CONTIGUOUS")
 c_i32Pt = clib.ndpointer(dtype=np.int32, flags="C_CONTIGUOUS")
 c_i64Pt = clib.ndpointer(dtype=np.int64, flags="C_CONTIGUOUS")
 c_iPt = clib.ndpointer(dtype=np.int32, flags="C_CONTIGUOUS")
+c_vPtPt = clib.ctypes.POINTER(clib.ctypes.c_void_p)
+
+
+def _ndpointer_or_null(dtype):
+    '''
+        ndpointer argtype that also accepts None, passed to C as a NULL pointer.
+    '''
+    base = clib.ndpointer(dtype=dtype, flags="C_CONTIGUOUS")
+
+    def from_param(cls, obj):
+        if obj is None:
+            return None
+        return base.from_param(obj)
+
+    return type(base.__name__ + '_or_null', (base,), {'from_param': classmethod(from_param)})
+
+c_i64PtN = _ndpointer_or_null(np.int64)
+c_dPtN = _ndpointer_or_null(np.float64)
+c_fPtN = _ndpointer_or_null(np.float32)
 
 if os.name == 'nt':
     _seisloclib = clib.load_library(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../lib/SeisLoc.dll'), '.')
@@ -91,40 +113,224 @@ def nlevinson(acc):
 
 
 
-_seisloclib.scan4d.argtypes = [c_dPt,  c_i32Pt, c_dPt, c_int32,  c_int32, c_int32, c_int32, c_int64, c_int64]
-_seisloclib.detect4d.argtypes = [c_dPt, c_dPt, c_i64Pt,c_int32, c_int32, c_int32, c_int64, c_int64]
-# _seisloclib.detect4d_t.argtypes = [c_dPt, c_dPt, c_i64Pt,c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.scan4d.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_dPtN, c_int32, c_i64PtN, c_dPt, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.detect4d.argtypes = [c_dPt, c_dPt, c_i64Pt, c_dPtN, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.marginal4d.argtypes = [c_dPt, c_dPt, c_int32, c_int32, c_int32, c_int64, c_int32, c_int64]
+_seisloclib.detect4d_peaks.argtypes = [c_dPt, c_dPt, c_i64Pt, c_dPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int64]
+_seisloclib.scandetect4d.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_dPtN, c_int32, c_i64PtN, c_dPt, c_i64Pt, c_dPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int32, c_int64]
+_seisloclib.scan4d_tiled.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_dPtN, c_int32, c_i64PtN, c_dPt, c_int32, c_int32, c_int32, c_int64, c_int32, c_int32, c_int64]
+_seisloclib.scan4d_tiled_f.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_fPtN, c_int32, c_i64PtN, c_fPt, c_int32, c_int32, c_int32, c_int64, c_int32, c_int32, c_int64]
+_seisloclib.scan4d_f.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_fPtN, c_int32, c_i64PtN, c_fPt, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.detect4d_f.argtypes = [c_fPt, c_fPt, c_i64Pt, c_fPtN, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.marginal4d_f.argtypes = [c_fPt, c_fPt, c_int32, c_int32, c_int32, c_int64, c_int32, c_int64]
+_seisloclib.detect4d_peaks_f.argtypes = [c_fPt, c_fPt, c_i64Pt, c_fPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int64]
+_seisloclib.scandetect4d_f.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_fPtN, c_int32, c_i64PtN, c_fPt, c_i64Pt, c_fPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int32, c_int64]
+_seisloclib.scan4d_t.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_dPtN, c_int32, c_i64PtN, c_dPt, c_int32, c_int32, c_int32, c_int64, c_int64, c_int32, c_int32, c_int64]
+_seisloclib.detect4d_t.argtypes = [c_dPt, c_dPt, c_i64Pt, c_dPtN, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.detect4d_peaks_t.argtypes = [c_dPt, c_dPt, c_i64Pt, c_dPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int64]
+_seisloclib.marginal4d_t.argtypes = [c_dPt, c_dPt, c_int32, c_int32, c_int64, c_int32, c_int64]
+_seisloclib.scan4d_t_f.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_fPtN, c_int32, c_i64PtN, c_fPt, c_int32, c_int32, c_int32, c_int64, c_int64, c_int32, c_int32, c_int64]
+_seisloclib.detect4d_t_f.argtypes = [c_fPt, c_fPt, c_i64Pt, c_fPtN, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.detect4d_peaks_t_f.argtypes = [c_fPt, c_fPt, c_i64Pt, c_fPtN, c_int32, c_int32, c_int32, c_int64, c_i32Pt, c_int32, c_int32, c_int64]
+_seisloclib.marginal4d_t_f.argtypes = [c_fPt, c_fPt, c_int32, c_int32, c_int64, c_int32, c_int64]
+_seisloclib.jackknife4d.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_dPtN, c_int32, c_i64PtN, c_dPt, c_i64Pt, c_i32Pt, c_int32, c_int32, c_int32, c_int32, c_int32, c_int32, c_int64, c_int64]
+_seisloclib.jackknife4d_f.argtypes = [c_vPtPt, c_vPtPt, c_vPtPt, c_i32Pt, c_i32Pt, c_fPtN, c_int32, c_i64PtN, c_fPt, c_i64Pt, c_i32Pt, c_int32, c_int32, c_int32, c_int32, c_int32, c_int32, c_int64, c_int64]
+
+
+def _phase_args(phases, weights):
+    '''
+        Kernel arguments of the phases from SeisLocnp._phases: pointer arrays of
+        the onsets, tables and active rows, the station and active row counts, the
+        weights and the number of phases. The arrays are passed in place, only
+        non-contiguous arrays are copied, and are kept referenced by the pointers.
+    '''
+    nphase = len(phases)
+    sigs = [np.ascontiguousarray(sig) for sig, tt, stn in phases]
+    tts  = [np.ascontiguousarray(tt, dtype=np.int32) for sig, tt, stn in phases]
+    stns = [stn for sig, tt, stn in phases]
+    ptrs = clib.ctypes.c_void_p * nphase
+    args = [ptrs(*[arr.ctypes.data for arr in arrs]) for arrs in (sigs, tts, stns)]
+    for ptr, arrs in zip(args, (sigs, tts, stns)):
+        ptr._arrays = arrs
+    args += [np.array([sig.shape[0] for sig in sigs], dtype=np.int32),
+             np.array([stn.size for stn in stns], dtype=np.int32),
+             weights, c_int32(nphase)]
+    return args
 
-def scan(sig, tt, fsmp,lsmp, nsamp, map4d, threads):
-    nstn, ssmp = sig.shape
-    if not tt.shape[-1] == nstn:
-        raise ValueError('Mismatch between number of stations for data and LUT, {} - {}.'.format(
-            nstn, tt.shape[-1]))
-    ncell = tt.shape[:-1]
+
+def _kernel(name, *arrays):
+    '''
+        Select the double (float64) or single (float32) precision kernel from
+        the dtype of the floating point arrays. All arrays must share one dtype.
+    '''
+    dtype = arrays[0].dtype
+    for arr in arrays[1:]:
+        if arr.dtype != dtype:
+            raise ValueError('Mixed precision arrays, {} - {}.'.format(dtype, arr.dtype))
+    if dtype == np.float32:
+        return getattr(_seisloclib, name + '_f')
+    return getattr(_seisloclib, name)
+
+
+def scan(sig, tt, fsmp,lsmp, nsamp, map4d, threads, kernel='direct', cell_tile=16, time_tile=1024, stations=None, layout='cell', weights=None, cells=None):
+    '''
+        Stacking of the onset functions into the 4D coalescence map.
+
+        sig      - Onset array with tt its travel-time index table, or a list of
+                   (onset, table) pairs with tt None, one pair per phase, e.g.
+                   [(snr_p, ttp), (snr_s, tts)]. The phases are separate buffers
+                   and are stacked in order without concatenating them. All
+                   onsets have the same length and all tables the same cells.
+
+        kernel   - 'direct' loops cell, station, time. 'tiled' stacks blocks of
+                   cell_tile adjacent cells against time_tile samples of every
+                   station onset while it is in cache. Both give identical maps.
+        stations - Rows of sig (columns of tt) to stack, default all. Rows that
+                   are not listed are skipped by the kernel. For a list of
+                   phases, None or a list of the rows of each phase.
+        weights  - Optional weight of each phase, default 1.
+        layout   - 'cell' for a cell-major map, ncell + (nsamp,), or 'time' for a
+                   time-major map, (nsamp,) + ncell. The time-major map is always
+                   stacked in cell_tile x time_tile blocks, kernel is ignored.
+        cells    - Optional flat cell indices into tt, e.g. a region of interest.
+                   Only these cells are stacked, the other cells of the map are
+                   left unchanged.
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
     tcell = np.prod(ncell)
     if map4d.size < nsamp*tcell:
         raise ValueError('4D-Array is too small.')
+    cells = _cells(cells, tcell, unique=True)
+    nlist = tcell if cells is None else cells.size
 
-    if sig.size < nsamp + fsmp:
-        raise ValueError('Data array smaller than Coalescence array')
+    phase = _phase_args(phases, weights)
 
+    if _map_shape(layout, map4d.shape)[0] == '_t':
+        _kernel('scan4d_t', phases[0][0], map4d)(*phase, cells, map4d, c_int32(fsmp), c_int32(lsmp), c_int32(nsamp), c_int64(nlist), c_int64(tcell),
+                                                 c_int32(max(1, cell_tile)), c_int32(max(1, time_tile)), c_int64(threads))
+    elif kernel == 'direct':
+        _kernel('scan4d', phases[0][0], map4d)(*phase, cells, map4d, c_int32(fsmp), c_int32(lsmp),c_int32(nsamp), c_int64(nlist), c_int64(threads))
+    elif kernel == 'tiled':
+        _kernel('scan4d_tiled', phases[0][0], map4d)(*phase, cells, map4d, c_int32(fsmp), c_int32(lsmp), c_int32(nsamp), c_int64(nlist),
+                                                     c_int32(max(1, cell_tile)), c_int32(max(1, time_tile)), c_int64(threads))
+    else:
+        raise ValueError('Unknown scan kernel {}, use direct or tiled.'.format(kernel))
 
-    _seisloclib.scan4d(sig, tt, map4d, c_int32(fsmp), c_int32(lsmp),c_int32(nsamp), c_int32(nstn),  c_int64(tcell), c_int64(threads))
 
+def detect(mmap, dsnr, dind, fsmp, lsmp,threads, peaks=1, separation=0, layout='cell', norm=None):
+    '''
+        Maximum coalescence and flat cell index per sample of the map.
 
-def detect(mmap, dsnr, dind, fsmp, lsmp,threads):
-    nsamp = mmap.shape[-1]
-    ncell = np.prod(mmap.shape[:-1])
-    if dsnr.size < nsamp or dind.size < nsamp:
-        raise ValueError('Ouput array size too small, sample count = {}.'.format(nsamp))
-    _seisloclib.detect4d(mmap, dsnr, dind, c_int32(fsmp),c_int32(lsmp),c_int32(nsamp), c_int64(ncell), c_int64(threads))
+        peaks      - With peaks > 1, dsnr and dind are (peaks, nsamp) and hold the
+                     best peaks per sample in descending order, each at least
+                     separation cells (Chebyshev distance) from a larger peak.
+                     The first row equals the single peak result, missing
+                     peaks are 0 with index -1.
+        layout     - 'cell' or 'time', the layout of mmap as for scan.
+        norm       - Optional array of nsamp. Receives the sum of the map over the
+                     cells per sample, accumulated in the detection pass, and dsnr
+                     is the coalescence of the normalised map, map / norm.
+    '''
+    suffix, nsamp, grid = _map_shape(layout, mmap.shape)
+    ncell = np.prod(grid)
+    _peaks(dsnr, dind, nsamp, peaks)
+    _norm(norm, nsamp, dsnr.dtype)
+    if peaks == 1:
+        _kernel('detect4d' + suffix, mmap, dsnr)(mmap, dsnr, dind, norm, c_int32(fsmp),c_int32(lsmp),c_int32(nsamp), c_int64(ncell), c_int64(threads))
+    else:
+        _kernel('detect4d_peaks' + suffix, mmap, dsnr)(mmap, dsnr, dind, norm, c_int32(fsmp), c_int32(lsmp), c_int32(nsamp), c_int64(ncell),
+                                                       _grid(grid), c_int32(peaks), c_int32(separation), c_int64(threads))
 
 
-# def detect_t(mmap, dsnr, dind, fsmp, lsmp, threads):
-#     nsamp = mmap.shape[0]
-#     ncell = np.prod(mmap.shape[1:])
-#     if dsnr.size < nsamp or dind.size < nsamp:
-#         raise ValueError('Ouput array size too small, sample count = {}.'.format(nsamp))
-#     _seisloclib.detect4d_t(mmap, dsnr, dind, c_int32(fsmp), c_int32(lsmp),
-#                      c_int32(nsamp), c_int64(ncell), c_int64(threads))
+def marginal(mmap, mout, fsmp, lsmp, threads, reduce='logsumexp', layout='cell'):
+    '''
+        Reduction of the 4D map over the samples [fsmp, lsmp) into the 3D array
+        mout, without a temporary copy of the map.
+
+        reduce - 'logsumexp' for log(sum(exp(map))), evaluated about the maximum of
+                 each cell so large coalescence values do not overflow, or 'max'.
+        layout - 'cell' or 'time', the layout of mmap as for scan.
+    '''
+    suffix, nsamp, grid = _map_shape(layout, mmap.shape)
+    ncell = np.prod(grid)
+    if mout.size < ncell:
+        raise ValueError('Ouput array size too small, cell count = {}.'.format(ncell))
+    if not 0 <= fsmp < lsmp <= nsamp:
+        raise ValueError('Sample range [{}, {}) outside of the map, sample count = {}.'.format(fsmp, lsmp, nsamp))
+    modes = {'logsumexp': 0, 'max': 1}
+    if reduce not in modes:
+        raise ValueError('Unknown reduction {}, use logsumexp or max.'.format(reduce))
+    if suffix == '_t':
+        # The time-major rows are ncell long, the sample count is not needed
+        _kernel('marginal4d_t', mmap, mout)(mmap, mout, c_int32(fsmp), c_int32(lsmp), c_int64(ncell), c_int32(modes[reduce]), c_int64(threads))
+    else:
+        _kernel('marginal4d', mmap, mout)(mmap, mout, c_int32(fsmp), c_int32(lsmp), c_int32(nsamp), c_int64(ncell), c_int32(modes[reduce]), c_int64(threads))
+
+
+def scan_detect(sig, tt, fsmp, lsmp, nsamp, dsnr, dind, threads, tile=None, cells=None, stations=None, peaks=1, separation=0, norm=None, weights=None):
+    '''
+        Fused scan and detect. Returns the same maximum coalescence and cell index
+        per sample as scan followed by detect, without allocating the 4D map.
+        Scratch memory is threads x tile samples.
+
+        sig      - Onset array with tt its table, or a list of (onset, table) pairs
+                   with tt None, as for scan.
+        cells    - Optional int64 array of flat cell indices into tt. Only these cells
+                   are stacked and dind holds the flat index of the maximum cell.
+        stations - Rows of sig (columns of tt) to stack, default all, or a list of
+                   the rows of each phase.
+        weights  - Optional weight of each phase, default 1.
+        peaks    - Number of spatially separated peaks per sample, as for detect.
+        norm     - Optional per-sample normalisation as for detect, the sums are
+                   accumulated while stacking (over the listed cells only).
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
+    tcell = np.prod(ncell)
+    _peaks(dsnr, dind, nsamp, peaks)
+    _norm(norm, nsamp, dsnr.dtype)
+
+    grid = _grid(ncell)
+    cells = _cells(cells, tcell)
+    if cells is not None:
+        tcell = cells.size
+
+    phase = _phase_args(phases, weights)
+
+    if tile is None:
+        # Enough time tiles to keep every thread busy, but long enough to
+        # amortise re-reading the travel-time table once per tile.
+        tile = max(64, min(1024, nsamp // max(1, 4*threads)))
+
+    _kernel('scandetect4d', phases[0][0], dsnr)(*phase, cells, dsnr, dind, norm, c_int32(fsmp), c_int32(lsmp), c_int32(nsamp), c_int64(tcell),
+                                                grid, c_int32(peaks), c_int32(separation), c_int32(tile), c_int64(threads))
+
+
+def jackknife(sig, tt, fsmp, lsmp, nsamp, t0, t1, dsnr, dind, dsmp, threads, cells=None, stations=None, weights=None):
+    '''
+        Leave-one-station-out maxima of the coalescence over the samples [t0, t1),
+        from a single stacking pass that keeps the contribution of every station
+        next to the total stack. The stack without a station is the total minus
+        its contribution.
+
+        sig      - Onset array with tt its table, or a list of (onset, table) pairs
+                   with tt None, as for scan. Row o of every phase is station o.
+        dsnr     - Output of nstn + 1 values, nstn the largest onset row count.
+                   dsnr[o] is the maximum over the cells and samples without
+                   station o, dind[o] its flat cell index and dsmp[o] (int32) its
+                   sample. Entry nstn is the maximum with all stations.
+        cells    - Optional flat cell indices into tt to search, as for scan_detect.
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
+    tcell = np.prod(ncell)
+    nout  = max(psig.shape[0] for psig, ptt, pstn in phases)
+    if dsnr.size < nout + 1 or dind.size < nout + 1 or dsmp.size < nout + 1:
+        raise ValueError('Ouput array size too small, station count = {}.'.format(nout))
+    if not 0 <= t0 < t1 <= nsamp:
+        raise ValueError('Sample range [{}, {}) outside of the onsets, sample count = {}.'.format(t0, t1, nsamp))
+    cells = _cells(cells, tcell)
+    if cells is not None:
+        tcell = cells.size
 
+    phase = _phase_args(phases, weights)
+    _kernel('jackknife4d', phases[0][0], dsnr)(*phase, cells, dsnr, dind, dsmp, c_int32(nout), c_int32(fsmp), c_int32(lsmp), c_int32(nsamp),
+                                               c_int32(t0), c_int32(t1), c_int64(tcell), c_int64(threads))
@@ -0,0 +1,414 @@
+'''
+    Vectorised NumPy implementation of the SeisLoclib API. It is the reference
+    for the compiled kernels and the fallback backend when lib/SeisLoc.so cannot
+    be loaded, see SeisLoc.core.backend. The threads arguments are accepted for
+    compatibility and ignored.
+
+'''
+import numpy as np
+
+
+def _stations(stations, nstn):
+    '''
+        Active station rows of the onset array as a sorted int32 array, all rows
+        if stations is None.
+    '''
+    if stations is None:
+        return np.arange(nstn, dtype=np.int32)
+    stations = np.unique(np.asarray(stations, dtype=np.int32))
+    if stations.size > 0 and (stations[0] < 0 or stations[-1] >= nstn):
+        raise ValueError('Active station index outside of the data, station count = {}.'.format(nstn))
+    return stations
+
+
+def _grid(ncell):
+    '''
+        Grid dimensions of the cells as an int32 array of three entries, used to
+        measure the separation of peaks. Cells of a flat table form one row.
+    '''
+    ncell = tuple(int(n) for n in ncell)
+    if len(ncell) != 3:
+        ncell = (1, 1, int(np.prod(ncell)))
+    return np.array(ncell, dtype=np.int32)
+
+
+def _peaks(dsnr, dind, nsamp, peaks):
+    if peaks < 1:
+        raise ValueError('Number of peaks must be at least 1, peaks = {}.'.format(peaks))
+    if dsnr.size < nsamp*peaks or dind.size < nsamp*peaks:
+        raise ValueError('Ouput array size too small, sample count = {} for {} peaks.'.format(nsamp, peaks))
+
+
+def _norm(norm, nsamp, dtype):
+    if norm is None:
+        return
+    if norm.size < nsamp:
+        raise ValueError('Ouput array size too small, sample count = {}.'.format(nsamp))
+    if norm.dtype != dtype:
+        raise ValueError('Mixed precision arrays, {} - {}.'.format(dtype, norm.dtype))
+
+
+def _cells(cells, tcell, unique=False):
+    '''
+        Listed flat cell indices as an int64 array, None for all cells. With
+        unique the cells are sorted and repeated cells dropped, as a map row must
+        be stacked once only.
+    '''
+    if cells is None:
+        return None
+    cells = np.unique(cells).astype(np.int64) if unique else np.ascontiguousarray(cells, dtype=np.int64)
+    if cells.size > 0 and (cells.min() < 0 or cells.max() >= tcell):
+        raise ValueError('Cell index outside of the LUT, cell count = {}.'.format(tcell))
+    return cells
+
+
+def _map_shape(layout, shape):
+    '''
+        Kernel suffix, sample count and grid shape of a coalescence map of the
+        given layout, 'cell' for ncell + (nsamp,) or 'time' for (nsamp,) + ncell.
+    '''
+    if layout == 'cell':
+        return '', shape[-1], shape[:-1]
+    if layout == 'time':
+        return '_t', shape[0], shape[1:]
+    raise ValueError('Unknown map layout {}, use cell or time.'.format(layout))
+
+
+def _cell_major(mmap, layout, nsamp, tcell):
+    '''
+        Flat (tcell, nsamp) view of a map of either layout.
+    '''
+    if layout == 'time':
+        return mmap.reshape(-1)[:nsamp*tcell].reshape(nsamp, tcell).T
+    return mmap.reshape(-1)[:nsamp*tcell].reshape(tcell, nsamp)
+
+
+# Cells reduced at once, bounds the temporary arrays to _CHUNK x nsamp
+_CHUNK = 4096
+
+
+def onset(env, stw, ltw, gap):
+    env = np.ascontiguousarray(env, np.float64)
+    out = np.zeros(env.shape, dtype=np.float64)
+    stw, ltw, gap2 = int(stw), int(ltw), int(gap) >> 1
+    nsamp = env.shape[-1]
+    nidx = nsamp - ltw - stw - 2*gap2
+    if nidx <= 0:
+        return out
+
+    # Long window ending before and short window starting after the gap
+    csum = np.zeros(env.shape[:-1] + (nsamp + 1,))
+    np.cumsum(env, axis=-1, out=csum[..., 1:])
+    ii  = np.arange(nidx)
+    s0  = ltw + 2*gap2 + 1
+    slw = csum[..., ii + ltw] - csum[..., ii]
+    ssw = csum[..., s0 + ii + stw] - csum[..., s0 + ii]
+    pos = slw > 0
+    out[..., ltw+gap2:ltw+gap2+nidx] = np.where(pos, ssw / np.where(pos, slw, 1.0), 0.0) * (float(ltw) / stw)
+    return out
+
+
+def levinson(acc, order, return_error=False):
+    acc = np.array(acc, dtype=np.double)
+    if acc.ndim == 1:
+        order = min(order, acc.shape[-1]-1)
+    chan = acc.shape[:-1]
+    a = np.zeros(chan + (order+1,), dtype=np.double)
+    k = np.zeros(chan + (order,), dtype=np.double)
+    e = acc[..., 0].copy()
+    a[..., 0] = 1.0
+    for i in range(1, order+1):
+        cc = acc[..., i] + np.sum(a[..., 1:i] * acc[..., i-1:0:-1], axis=-1)
+        k[..., i-1] = -cc / e
+        a[..., i] = k[..., i-1]
+        a[..., 1:i] = a[..., 1:i] + k[..., i-1, np.newaxis] * a[..., i-1:0:-1]
+        e = e * (1 - k[..., i-1]**2)
+    if acc.ndim == 1:
+        e = np.array([e])
+    if return_error:
+        return a, k, e
+    else:
+        return a, k
+
+
+def nlevinson(acc):
+    acc = np.array(acc, dtype=np.double)
+    nsamp = acc.shape[-1]
+    a = np.zeros(acc.shape, dtype=np.double)
+    a[..., 0] = 1 / acc[..., 0]
+    for j in range(1, nsamp):
+        err = np.sum(a[..., :j] * acc[..., j:0:-1], axis=-1)[..., np.newaxis]
+        a[..., :j+1] = (a[..., :j+1] - err * a[..., j::-1]) / (1 - err * err)
+    return a
+
+
+def _phases(sig, tt, fsmp, nsamp, stations=None, weights=None):
+    '''
+        Phases of a stack as a list of (onset, table, active rows), the phase
+        weights (None for 1) and the cell shape of the tables. sig is an onset
+        array with its travel-time index table tt, or a list of (onset, table)
+        pairs, one per phase, with tt None. stations is then None or a list of
+        the active rows of each phase.
+    '''
+    if tt is None:
+        pairs = list(sig)
+        if stations is None:
+            stations = [None] * len(pairs)
+    else:
+        pairs = [(sig, tt)]
+        stations = [stations]
+    if len(pairs) == 0:
+        raise ValueError('No phases to stack.')
+    if len(stations) != len(pairs):
+        raise ValueError('Mismatch between number of phases and station lists, {} - {}.'.format(len(pairs), len(stations)))
+
+    ncell = pairs[0][1].shape[:-1]
+    dtype = pairs[0][0].dtype
+    nrow  = pairs[0][0].shape[-1]
+    phases = []
+    for (psig, ptt), pstn in zip(pairs, stations):
+        nstn = psig.shape[0]
+        if not ptt.shape[-1] == nstn:
+            raise ValueError('Mismatch between number of stations for data and LUT, {} - {}.'.format(
+                nstn, ptt.shape[-1]))
+        if not ptt.shape[:-1] == ncell:
+            raise ValueError('Mismatch between the LUT grids of the phases, {} - {}.'.format(ncell, ptt.shape[:-1]))
+        if psig.dtype != dtype:
+            raise ValueError('Mixed precision arrays, {} - {}.'.format(dtype, psig.dtype))
+        if psig.shape[-1] != nrow:
+            raise ValueError('Mismatch between the onset lengths of the phases, {} - {}.'.format(nrow, psig.shape[-1]))
+        if psig.size < nsamp + fsmp:
+            raise ValueError('Data array smaller than Coalescence array')
+        phases.append((psig, ptt, _stations(pstn, nstn)))
+
+    if weights is not None:
+        weights = np.ascontiguousarray(weights, dtype=dtype).reshape(-1)
+        if weights.size != len(phases):
+            raise ValueError('Mismatch between number of phases and weights, {} - {}.'.format(len(phases), weights.size))
+    return phases, weights, ncell
+
+
+def _stack(phases, weights, fsmp, lsmp, nsamp, cells):
+    '''
+        Coalescence of the listed flat cells, (cells.size, nsamp), stacking the
+        phases and stations in the same order as the compiled kernels.
+    '''
+    stk   = np.zeros((cells.size, nsamp), dtype=phases[0][0].dtype)
+    tm    = np.arange(nsamp)
+    for ip, (sig, tt, stations) in enumerate(phases):
+        nstn  = sig.shape[0]
+        flat  = sig.reshape(-1)
+        ttc   = tt.reshape(-1, nstn)[cells]
+        for st in stations:
+            row = st * (fsmp + lsmp + nsamp) + np.maximum(0, ttc[:, st]) + fsmp
+            if weights is None:
+                stk += flat[row[:, np.newaxis] + tm]
+            else:
+                stk += weights[ip] * flat[row[:, np.newaxis] + tm]
+    return stk
+
+
+def scan(sig, tt, fsmp,lsmp, nsamp, map4d, threads, kernel='direct', cell_tile=16, time_tile=1024, stations=None, layout='cell', weights=None, cells=None):
+    '''
+        Stacking of the onset functions into the 4D coalescence map, see
+        SeisLoclib.scan. Both kernels and layouts are the same stacking here.
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
+    tcell = int(np.prod(ncell))
+    if map4d.size < nsamp*tcell:
+        raise ValueError('4D-Array is too small.')
+    if kernel not in ('direct', 'tiled'):
+        raise ValueError('Unknown scan kernel {}, use direct or tiled.'.format(kernel))
+
+    _map_shape(layout, map4d.shape)
+    cells = _cells(cells, tcell, unique=True)
+    if cells is None:
+        cells = np.arange(tcell, dtype=np.int64)
+
+    mflat = _cell_major(map4d, layout, nsamp, tcell)
+    for c0 in range(0, cells.size, _CHUNK):
+        blk = cells[c0:c0 + _CHUNK]
+        mflat[blk] += _stack(phases, weights, fsmp, lsmp, nsamp, blk)
+
+
+class _Peaks:
+    '''
+        Running peaks of the samples [fsmp, lsmp) of dsnr and dind, updated one
+        cell at a time in the cell order of the compiled kernels.
+    '''
+
+    def __init__(self, dsnr, dind, fsmp, lsmp, nsamp, peaks, grid, separation):
+        self.val  = dsnr.reshape(-1)[:peaks*nsamp].reshape(peaks, nsamp)[:, fsmp:lsmp]
+        self.idx  = dind.reshape(-1)[:peaks*nsamp].reshape(peaks, nsamp)[:, fsmp:lsmp]
+        self.grid = grid
+        self.sep  = separation
+        self.fsmp = fsmp
+        self.lsmp = lsmp
+        self.val[...] = 0.0
+        self.idx[...] = -1
+
+    def add(self, cv, cell):
+        val, idx = self.val, self.idx
+        npeak = val.shape[0]
+        if npeak == 1:
+            upd = cv > val[0]
+            val[0, upd] = cv[upd]
+            idx[0, upd] = np.broadcast_to(cell, cv.shape)[upd]
+            return
+
+        upd = np.where(cv > val[-1])[0]
+        if upd.size == 0:
+            return
+        cv = cv[upd]
+        pv = val[:, upd].copy()
+        pi = idx[:, upd].copy()
+        if self.sep > 0:
+            near = (pi >= 0) & (np.max(np.abs(np.array(np.unravel_index(np.maximum(pi, 0), self.grid))
+                                              - np.array(np.unravel_index(cell, self.grid))[:, np.newaxis, np.newaxis]), axis=0) < self.sep)
+            keep = ~np.any(near & (pv >= cv), axis=0)
+            upd, cv, pv, pi, near = upd[keep], cv[keep], pv[:, keep], pi[:, keep], near[:, keep]
+            pv[near] = 0.0
+            pi[near] = -1
+
+        # Descending order with the candidate after equal peaks and empty peaks last
+        pv = np.vstack((np.where(pi >= 0, pv, -np.inf), cv))
+        pi = np.vstack((pi, np.full(cv.size, cell)))
+        order = np.argsort(-pv, axis=0, kind='stable')[:npeak]
+        pv = np.take_along_axis(pv, order, axis=0)
+        pi = np.take_along_axis(pi, order, axis=0)
+        val[:, upd] = np.where(np.isfinite(pv), pv, 0.0)
+        idx[:, upd] = np.where(np.isfinite(pv), pi, -1)
+
+    def finish(self, sums=None, norm=None):
+        '''
+            Completing the peaks, normalised by the per-sample sums of the map over
+            the cells when norm is given, see SeisLoclib.detect.
+        '''
+        self.idx[0, self.idx[0] < 0] = 0
+        if norm is not None:
+            norm = norm.reshape(-1)[self.fsmp:self.lsmp]
+            norm[...] = sums
+            nz = norm != 0
+            self.val[:, nz] /= norm[nz]
+
+
+def detect(mmap, dsnr, dind, fsmp, lsmp,threads, peaks=1, separation=0, layout='cell', norm=None):
+    '''
+        Maximum coalescence and flat cell index per sample of the map, see
+        SeisLoclib.detect.
+    '''
+    suffix, nsamp, grid = _map_shape(layout, mmap.shape)
+    tcell = int(np.prod(grid))
+    _peaks(dsnr, dind, nsamp, peaks)
+    _norm(norm, nsamp, dsnr.dtype)
+    mflat = _cell_major(mmap, layout, nsamp, tcell)
+    pk = _Peaks(dsnr, dind, fsmp, lsmp, nsamp, peaks, _grid(grid), separation)
+    if peaks == 1:
+        for c0 in range(0, tcell, _CHUNK):
+            blk = mflat[c0:c0 + _CHUNK, fsmp:lsmp]
+            ix  = np.argmax(blk, axis=0)
+            pk.add(blk[ix, np.arange(blk.shape[1])], ix + c0)
+    else:
+        for cell in range(tcell):
+            pk.add(mflat[cell, fsmp:lsmp], cell)
+    pk.finish(None if norm is None else np.sum(mflat[:, fsmp:lsmp], axis=0, dtype=np.float64), norm)
+
+
+def marginal(mmap, mout, fsmp, lsmp, threads, reduce='logsumexp', layout='cell'):
+    '''
+        Reduction of the 4D map over the samples [fsmp, lsmp) into the 3D array
+        mout, see SeisLoclib.marginal.
+    '''
+    suffix, nsamp, grid = _map_shape(layout, mmap.shape)
+    tcell = int(np.prod(grid))
+    if mout.size < tcell:
+        raise ValueError('Ouput array size too small, cell count = {}.'.format(tcell))
+    if not 0 <= fsmp < lsmp <= nsamp:
+        raise ValueError('Sample range [{}, {}) outside of the map, sample count = {}.'.format(fsmp, lsmp, nsamp))
+    if reduce not in ('logsumexp', 'max'):
+        raise ValueError('Unknown reduction {}, use logsumexp or max.'.format(reduce))
+    mflat = _cell_major(mmap, layout, nsamp, tcell)
+    oflat = mout.reshape(-1)
+    for c0 in range(0, tcell, _CHUNK):
+        blk = mflat[c0:c0 + _CHUNK, fsmp:lsmp]
+        if layout == 'time':
+            # Contiguous rows, so the sum is in the same order as for 'cell'
+            blk = np.ascontiguousarray(blk)
+        mv  = np.max(blk, axis=-1)
+        if reduce == 'logsumexp':
+            mv = mv + np.log(np.sum(np.exp(blk - mv[:, np.newaxis]), axis=-1))
+        oflat[c0:c0 + blk.shape[0]] = mv
+
+
+def scan_detect(sig, tt, fsmp, lsmp, nsamp, dsnr, dind, threads, tile=None, cells=None, stations=None, peaks=1, separation=0, norm=None, weights=None):
+    '''
+        Fused scan and detect, see SeisLoclib.scan_detect. The coalescence is
+        stacked for blocks of cells, the 4D map is never allocated.
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
+    tcell = int(np.prod(ncell))
+    _peaks(dsnr, dind, nsamp, peaks)
+    _norm(norm, nsamp, dsnr.dtype)
+    cells = _cells(cells, tcell)
+    if cells is None:
+        cells = np.arange(tcell, dtype=np.int64)
+
+    pk = _Peaks(dsnr, dind, 0, nsamp, nsamp, peaks, _grid(ncell), separation)
+    sums = np.zeros(nsamp)
+    for c0 in range(0, cells.size, _CHUNK):
+        blk = cells[c0:c0 + _CHUNK]
+        stk = _stack(phases, weights, fsmp, lsmp, nsamp, blk)
+        if norm is not None:
+            sums += np.sum(stk, axis=0, dtype=np.float64)
+        if peaks == 1:
+            ix = np.argmax(stk, axis=0)
+            pk.add(stk[ix, np.arange(nsamp)], blk[ix])
+        else:
+            for ic, cell in enumerate(blk):
+                pk.add(stk[ic], cell)
+    pk.finish(sums, norm)
+
+
+def jackknife(sig, tt, fsmp, lsmp, nsamp, t0, t1, dsnr, dind, dsmp, threads, cells=None, stations=None, weights=None):
+    '''
+        Leave-one-station-out maxima of the coalescence over the samples [t0, t1),
+        see SeisLoclib.jackknife. The contributions are stacked for blocks of cells.
+    '''
+    phases, weights, ncell = _phases(sig, tt, fsmp, nsamp, stations, weights)
+    tcell = int(np.prod(ncell))
+    nout  = max(psig.shape[0] for psig, ptt, pstn in phases)
+    if dsnr.size < nout + 1 or dind.size < nout + 1 or dsmp.size < nout + 1:
+        raise ValueError('Ouput array size too small, station count = {}.'.format(nout))
+    if not 0 <= t0 < t1 <= nsamp:
+        raise ValueError('Sample range [{}, {}) outside of the onsets, sample count = {}.'.format(t0, t1, nsamp))
+    cells = _cells(cells, tcell)
+    if cells is None:
+        cells = np.arange(tcell, dtype=np.int64)
+
+    dtype = phases[0][0].dtype
+    tn    = t1 - t0
+    tm    = np.arange(tn)
+    dsnr[:nout + 1] = -np.inf
+    dind[:nout + 1] = -1
+    dsmp[:nout + 1] = -1
+    for c0 in range(0, cells.size, _CHUNK):
+        blk = cells[c0:c0 + _CHUNK]
+        stk = np.zeros((blk.size, nout + 1, tn), dtype=dtype)
+        for ip, (sig, tt, stations) in enumerate(phases):
+            nstn = sig.shape[0]
+            flat = sig.reshape(-1)
+            ttc  = tt.reshape(-1, nstn)[blk]
+            for st in stations:
+                row = st * (fsmp + lsmp + nsamp) + np.maximum(0, ttc[:, st]) + fsmp + t0
+                val = flat[row[:, np.newaxis] + tm]
+                if weights is not None:
+                    val = weights[ip] * val
+                stk[:, nout] += val
+                stk[:, st]   += val
+        stk[:, :nout] = stk[:, nout:] - stk[:, :nout]
+        for o in range(nout + 1):
+            ix = int(np.argmax(stk[:, o]))
+            if stk[:, o].reshape(-1)[ix] > dsnr[o]:
+                dsnr[o] = stk[:, o].reshape(-1)[ix]
+                dind[o] = blk[ix // tn]
+                dsmp[o] = t0 + ix % tn
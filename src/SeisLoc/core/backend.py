@@ -0,0 +1,124 @@
+'''
+    Registry of the compute backends. Every backend is a module with the
+    SeisLoclib API (onset, levinson, nlevinson, scan, detect, scan_detect,
+    marginal and jackknife), and the functions of this module forward to the
+    active backend.
+
+      compiled - SeisLoc.core.SeisLoclib, the OpenMP kernels of lib/SeisLoc.so
+      numpy    - SeisLoc.core.SeisLocnp, the vectorised NumPy reference
+
+    The backend is chosen by set_backend, otherwise by the SEISLOC_BACKEND
+    environment variable. The default 'auto' uses the compiled backend and falls
+    back to NumPy with a warning when the library is missing or does not match.
+
+'''
+import os
+import warnings
+import importlib
+
+
+ENVIRONMENT_VARIABLE = 'SEISLOC_BACKEND'
+
+_BACKENDS = {'compiled': 'SeisLoc.core.SeisLoclib',
+             'numpy':    'SeisLoc.core.SeisLocnp'}
+
+_active = None
+
+
+def register_backend(name, module):
+    '''
+        Adding a backend, module is a module object or its import path.
+    '''
+    _BACKENDS[name] = module
+
+
+def _load(name):
+    if name not in _BACKENDS:
+        raise ValueError('Unknown compute backend {}, use auto or one of {}.'.format(name, ', '.join(_BACKENDS)))
+    module = _BACKENDS[name]
+    if isinstance(module, str):
+        module = importlib.import_module(module)
+    return module
+
+
+def available_backends():
+    '''
+        Names of the backends that can be loaded.
+    '''
+    names = []
+    for name in _BACKENDS:
+        try:
+            _load(name)
+            names.append(name)
+        except (ImportError, OSError, AttributeError):
+            pass
+    return names
+
+
+def set_backend(name=None):
+    '''
+        Selecting the compute backend by name, 'auto' or None for the
+        SEISLOC_BACKEND environment variable (default auto). Returns the name of
+        the active backend.
+    '''
+    global _active
+    if name is None:
+        name = os.environ.get(ENVIRONMENT_VARIABLE, 'auto')
+    name = name.lower()
+
+    if name == 'auto':
+        try:
+            _active = ('compiled', _load('compiled'))
+        except (ImportError, OSError, AttributeError) as err:
+            warnings.warn('Compiled SeisLoc library could not be loaded ({}), using the NumPy backend.'.format(err))
+            _active = ('numpy', _load('numpy'))
+    else:
+        _active = (name, _load(name))
+    return _active[0]
+
+
+def get_backend():
+    '''
+        Name of the active compute backend.
+    '''
+    if _active is None:
+        set_backend()
+    return _active[0]
+
+
+def _module():
+    if _active is None:
+        set_backend()
+    return _active[1]
+
+
+def onset(*args, **kwargs):
+    return _module().onset(*args, **kwargs)
+
+
+def levinson(*args, **kwargs):
+    return _module().levinson(*args, **kwargs)
+
+
+def nlevinson(*args, **kwargs):
+    return _module().nlevinson(*args, **kwargs)
+
+
+def scan(*args, **kwargs):
+    return _module().scan(*args, **kwargs)
+
+
+def detect(*args, **kwargs):
+    return _module().detect(*args, **kwargs)
+
+
+def scan_detect(*args, **kwargs):
+    return _module().scan_detect(*args, **kwargs)
+
+
+def marginal(*args, **kwargs):
+    return _module().marginal(*args, **kwargs)
+
+
+def jackknife(*args, **kwargs):
+    return _module().jackknife(*args, **kwargs)
@@ -19,6 +19,8 @@ import os
 import pandas as pd
 import pickle
 import struct
+import shutil
+import tempfile
 import skfmm
 
 try:
@@ -353,6 +355,16 @@ class Grid3D:
     def xyz2index(self, cord):
         return self.loc2index(self.xyz2loc(cord))
 
+    def xyz2cell(self, cord):
+        '''
+            Flat index of the nearest cell to each point of cord (n, 3), the
+            inverse of index2xyz. Points outside of the grid raise a ValueError.
+        '''
+        loc = np.rint(self.xyz2loc(np.atleast_2d(cord))).astype(np.int64)
+        if np.any(loc < 0) or np.any(loc >= self._cell_count):
+            raise ValueError('Point outside of the grid, cell count = {}.'.format(self._cell_count))
+        return np.ravel_multi_index(loc.transpose(), self._cell_count, order=self.sort_order)
+
     def xyz2coord(self, loc):
         lon, lat = self.xy2lonlat(loc[:,0], loc[:,1])
         return np.array([lon, lat, loc[:,2]]).transpose()
@@ -578,6 +590,8 @@ class LUT(Grid3D,NonLinLoc):
         self.station_data = None
         self._maps = dict()
         self.data = None
+        self._index_cache = dict()
+        self._shared = None
 
     @property
     def maps(self):
@@ -586,13 +600,92 @@ class LUT(Grid3D,NonLinLoc):
     @maps.setter
     def maps(self, maps):
         self._maps = maps
+        self._shared = None
+        self.clear_index_cache()
+
+    def clear_index_cache(self):
+        '''
+            Removing the cached travel-time index tables. Called whenever the maps,
+            the grid or the stations change.
+        '''
+        self._index_cache = dict()
+        if getattr(self, '_shared', None) is not None:
+            self._shared = (self._shared[0], self._shared[1], [])
+
+    def share(self, directory=None):
+        '''
+            Publishing the maps and the cached index tables (see fetch_index_table) as
+            .npy files in directory, default a new directory in /dev/shm (shared
+            memory) or the temporary directory, with the other attributes in lut.pkl.
+
+            Returns a copy of the LUT attached to the files as read-only memory maps.
+            It is pickled without the tables, so the processes it is passed to (or
+            that attach to the directory) map the same buffers instead of copies.
+            The files are removed by unshare.
+        '''
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='seisloc_lut_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        os.makedirs(directory, exist_ok=True)
+
+        maps  = {name: 'map_{}'.format(name) for name in self.maps}
+        index = []
+        for name, map in self.maps.items():
+            np.save(os.path.join(directory, maps[name] + '.npy'), np.ascontiguousarray(map))
+        for n, (key, value) in enumerate(self._index_cache.items()):
+            values = value if isinstance(value, tuple) else (value,)
+            files  = ['index_{}_{}'.format(n, v) for v in range(len(values))]
+            for file, array in zip(files, values):
+                np.save(os.path.join(directory, file + '.npy'), np.ascontiguousarray(array))
+            index.append((key, isinstance(value, tuple), files))
+
+        state = dict(self.__dict__)
+        state['_maps'] = None
+        state['_index_cache'] = None
+        state['_shared'] = (directory, maps, index)
+        with open(os.path.join(directory, 'lut.pkl'), 'wb') as fp:
+            pickle.dump(state, fp, 2)
+
+        lut = LUT.__new__(LUT)
+        lut.attach(directory)
+        return lut
+
+    def attach(self, directory):
+        '''
+            Attaching to a LUT published by share in directory, read-only.
+        '''
+        with open(os.path.join(directory, 'lut.pkl'), 'rb') as fp:
+            self.__setstate__(pickle.load(fp))
+
+    def unshare(self):
+        '''
+            Removing the files of a shared LUT. The LUT and the processes attached to
+            it keep their memory maps, but no process can attach anymore.
+        '''
+        if getattr(self, '_shared', None) is not None:
+            shutil.rmtree(self._shared[0], ignore_errors=True)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if state.get('_shared') is not None:
+            # The tables are attached again from the shared files
+            state['_maps'] = None
+            state['_index_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('_shared') is not None:
+            directory, maps, index = state['_shared']
+            load = lambda file: np.load(os.path.join(directory, file + '.npy'), mmap_mode='r')
+            self._maps = {name: load(file) for name, file in maps.items()}
+            self._index_cache = {key: tuple(load(file) for file in files) if multi else load(files[0]) for key, multi, files in index}
 
     def _select_station(self, station_data):
         if self.station_data is None:
             return station_data
 
         nstn = len(self.station_data)
-        flag = np.array(np.zeros(nstn, dtype=np.bool))
+        flag = np.array(np.zeros(nstn, dtype=bool))
         for i, stn in enumerate(self.station_data['Name']):
             if stn in station_data:
                 flag[i] = True
@@ -609,8 +702,9 @@ class LUT(Grid3D,NonLinLoc):
             self.maps = copy(self.maps)
         else:
             self = self
+        self.clear_index_cache()
 
-        ds = np.array(ds, dtype=np.int)
+        ds = np.array(ds, dtype=int)
         cell_count = 1 + (self.cell_count - 1) // ds
         c1 = (self.cell_count - ds * (cell_count - 1) - 1) // 2
         cn = c1 + ds * (cell_count - 1) + 1
@@ -630,7 +724,7 @@ class LUT(Grid3D,NonLinLoc):
 
     def decimate_array(self,DATA,ds):
         self = self
-        ds = np.array(ds, dtype=np.int)
+        ds = np.array(ds, dtype=int)
         cell_count = 1 + (self.cell_count - 1) // ds
         c1 = (self.cell_count - ds * (cell_count - 1) - 1) // 2
         cn = c1 + ds * (cell_count - 1) + 1
@@ -696,6 +790,72 @@ class LUT(Grid3D,NonLinLoc):
         maps = self.fetch_map(map, station)
         return np.rint(srate * maps).astype(np.int32)
 
+    def fetch_index_table(self, maps, srate, station=None):
+        '''
+            Contiguous int32 travel-time index table of the maps concatenated along
+            the station axis, e.g. maps=['TIME_P','TIME_S'] gives cell_count + (2*nstn,).
+
+            The table is computed once per (maps, sample rate, station set) and kept
+            until the LUT is decimated, or its maps or stations change.
+        '''
+        key = (tuple(maps), float(srate), None if station is None else tuple(station))
+        cache = getattr(self, '_index_cache', None)
+        if cache is None:
+            cache = self._index_cache = dict()
+        if key not in cache:
+            tables = [self.fetch_map(map, station) for map in maps]
+            ncol   = [tab.shape[-1] for tab in tables]
+            table  = np.empty(tables[0].shape[:-1] + (sum(ncol),), dtype=np.int32)
+            c = 0
+            for tab, n in zip(tables, ncol):
+                table[..., c:c + n] = np.rint(srate * tab)
+                c += n
+            cache[key] = table
+        return cache[key]
+
+    def fetch_unique_cells(self, maps, srate, station=None):
+        '''
+            Cells with identical travel-time index vectors, over all stations of the
+            maps at the sample rate srate, e.g. the deep cells far from the network
+            of a decimated LUT. The rows of the index tables are hashed and the groups
+            checked against the rows.
+
+            Returns the group label of every flat cell and the first (lowest) cell of
+            each group, in ascending order so that label g has the cell first[g].
+            Cached with the index tables.
+        '''
+        key = ('unique', tuple(maps), float(srate), None if station is None else tuple(station))
+        cache = getattr(self, '_index_cache', None)
+        if cache is None:
+            cache = self._index_cache = dict()
+        if key not in cache:
+            tables = [self.fetch_index_table([map], srate, station) for map in maps]
+            tables = [tab.reshape(-1, tab.shape[-1]) for tab in tables]
+            ncell  = tables[0].shape[0]
+            chunk  = 65536
+
+            # 64-bit polynomial hash of each row, wrapping on overflow
+            rng  = np.random.RandomState(0)
+            hsh  = np.zeros(ncell, dtype=np.uint64)
+            for tab in tables:
+                mult = rng.randint(1, 2**62, size=tab.shape[1]).astype(np.uint64) | np.uint64(1)
+                for c0 in range(0, ncell, chunk):
+                    hsh[c0:c0 + chunk] = hsh[c0:c0 + chunk] * np.uint64(1000003) + np.sum(tab[c0:c0 + chunk].astype(np.uint64) * mult, axis=1, dtype=np.uint64)
+            hsh, first, label = np.unique(hsh, return_index=True, return_inverse=True)
+
+            # Hash collisions are resolved by the exact (slower) comparison of the rows
+            same = all(np.array_equal(tab[c0:c0 + chunk], tab[first[label[c0:c0 + chunk]]]) for tab in tables for c0 in range(0, ncell, chunk))
+            if not same:
+                rows = np.ascontiguousarray(np.hstack(tables))
+                rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+                rows, first, label = np.unique(rows, return_index=True, return_inverse=True)
+
+            order = np.argsort(first)
+            rank  = np.empty_like(order)
+            rank[order] = np.arange(order.size)
+            cache[key] = (rank[label.ravel()].astype(np.int64), first[order].astype(np.int64))
+        return cache[key]
+
     def set_station(self,loc,units):
         # Changing Pandas to Numpy Array
         nstn = loc.shape[0]
@@ -723,6 +883,7 @@ class LUT(Grid3D,NonLinLoc):
             stn_data['Elevation'] = loc[:, 2]
             stn_data['Name'] = loc[:,3]
         self.station_data = stn_data
+        self.clear_index_cache()
 
 
 
@@ -894,7 +1055,10 @@ class LUT(Grid3D,NonLinLoc):
             Saving the LUT format for future use.
         '''
         file = open('{}'.format(FILENAME),'wb')
-        pickle.dump(self.__dict__,file,2)
+        tmp_dict = dict(self.__dict__)
+        tmp_dict.pop('_index_cache', None)
+        tmp_dict.pop('_shared', None)
+        pickle.dump(tmp_dict,file,2)
         file.close()
 
 
@@ -905,6 +1069,7 @@ class LUT(Grid3D,NonLinLoc):
         file = open('{}'.format(FILENAME),'rb')
         tmp_dict = pickle.load(file)
         self.__dict__.update(tmp_dict)
+        self.clear_index_cache()
 
 
 
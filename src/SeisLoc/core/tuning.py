@@ -0,0 +1,194 @@
+'''
+    Calibration of the thread counts and tile sizes of the compute kernels.
+
+    A short benchmark of every stage is run on a slice of the actual travel-time
+    table and window shape, and the fastest settings are cached in a JSON file
+    per host and grid shape, $SEISLOC_CACHE/tuning.json (default ~/.seisloc).
+    The stages of the map kernels are tuned for both map layouts, the _time
+    stages are the time-major kernels, and 'layout' holds the faster layout for
+    detection only ('detect') and for detection with marginals ('locate').
+
+'''
+import os
+import json
+import time
+import socket
+import warnings
+
+import numpy as np
+
+import SeisLoc.core.backend as ilib
+from SeisLoc.core.SeisLocnp import _phases
+
+
+STAGES = ('scan', 'detect', 'scan_detect', 'marginal', 'scan_time', 'detect_time', 'marginal_time')
+
+CACHE_VARIABLE = 'SEISLOC_CACHE'
+
+# Size of the calibration problem, enough cells and samples to exceed the caches
+CALIBRATION_CELLS   = 4096
+CALIBRATION_SAMPLES = 2000
+
+# Settings already read or calibrated in this process
+_settings = {}
+
+
+def cache_file():
+    return os.path.join(os.environ.get(CACHE_VARIABLE, os.path.join(os.path.expanduser('~'), '.seisloc')), 'tuning.json')
+
+
+def _host():
+    return '{}-{}'.format(socket.gethostname(), os.cpu_count())
+
+
+def _key(shape, nsamp, dtype, backend):
+    return '{}|{}|{}|{}'.format(backend, np.dtype(dtype).name, ','.join(str(n) for n in shape), nsamp)
+
+
+def _read_cache():
+    try:
+        with open(cache_file(), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_cache(cache):
+    fname = cache_file()
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname + '.tmp', 'w') as fp:
+            json.dump(cache, fp, indent=2, sort_keys=True)
+        os.replace(fname + '.tmp', fname)
+    except (IOError, OSError) as err:
+        warnings.warn('Kernel tuning could not be cached in {} ({}).'.format(fname, err))
+
+
+def thread_counts(max_threads=None):
+    '''
+        Candidate thread counts, powers of two up to the number of cores.
+    '''
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1]*2 <= max_threads:
+        counts.append(counts[-1]*2)
+    if counts[-1] != max_threads:
+        counts.append(max_threads)
+    return counts
+
+
+def _time(fn, repeat):
+    best = np.inf
+    for rr in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _best(options, run, repeat):
+    times = [_time(lambda: run(**opt), repeat) for opt in options]
+    return dict(options[int(np.argmin(times))]), min(times)
+
+
+def _fastest(options, run, repeat):
+    return _best(options, run, repeat)[0]
+
+
+def calibrate(sig, tt, fsmp, lsmp, nsamp, stations=None, max_threads=None, repeat=3):
+    '''
+        Benchmark of the kernels of the active backend on the first
+        CALIBRATION_CELLS cells of the tables and CALIBRATION_SAMPLES samples of
+        the onsets. sig, tt and stations are an onset array and its table or a
+        list of phases, as for SeisLoclib.scan.
+        Returns the settings of each stage, e.g. {'scan': {'threads': 8,
+        'kernel': 'tiled', 'cell_tile': 16, 'time_tile': 1024}, ...}.
+    '''
+    phases, weights, shape = _phases(sig, tt, fsmp, nsamp, stations)
+    dtype = phases[0][0].dtype
+    ncell = min(int(np.prod(shape)), CALIBRATION_CELLS)
+    ns    = min(nsamp, CALIBRATION_SAMPLES)
+    cph   = [(np.ascontiguousarray(psig[:, :fsmp + lsmp + ns]), np.ascontiguousarray(ptt.reshape(-1, psig.shape[0])[:ncell]))
+             for psig, ptt, pstn in phases]
+    cstn  = [pstn for psig, ptt, pstn in phases]
+    cmap  = np.zeros((ncell, ns), dtype=dtype)
+    tmap  = np.zeros((ns, ncell), dtype=dtype)
+    dsnr  = np.zeros(ns, dtype=dtype)
+    dind  = np.zeros(ns, dtype=np.int64)
+    mout  = np.zeros(ncell, dtype=dtype)
+    counts = thread_counts(max_threads)
+
+    def scan(**opt):
+        cmap[...] = 0.0
+        ilib.scan(cph, None, fsmp, lsmp, ns, cmap, stations=cstn, **opt)
+
+    def scan_time(**opt):
+        tmap[...] = 0.0
+        ilib.scan(cph, None, fsmp, lsmp, ns, tmap, stations=cstn, layout='time', **opt)
+
+    settings = {}
+    elapsed  = {}
+    settings['scan'] = _fastest([{'threads': n, 'kernel': 'direct'} for n in counts], scan, repeat)
+    tiles = [dict(settings['scan'], kernel='tiled', cell_tile=ct, time_tile=tl) for ct in (8, 16, 32) for tl in (256, 1024)]
+    settings['scan'], elapsed['scan'] = _best([settings['scan']] + tiles, scan, repeat)
+    settings['scan_time'] = _fastest([{'threads': n, 'cell_tile': 16, 'time_tile': 256} for n in counts], scan_time, repeat)
+    tiles = [dict(settings['scan_time'], cell_tile=ct, time_tile=tl) for ct in (16, 64, 128) for tl in (64, 256, 1024)]
+    settings['scan_time'], elapsed['scan_time'] = _best(tiles, scan_time, repeat)
+
+    scan(**settings['scan'])
+    scan_time(**settings['scan_time'])
+    for suffix, mmap, layout in (('', cmap, 'cell'), ('_time', tmap, 'time')):
+        settings['detect' + suffix], elapsed['detect' + suffix] = _best(
+            [{'threads': n} for n in counts], lambda **opt: ilib.detect(mmap, dsnr, dind, 0, ns, opt['threads'], layout=layout), repeat)
+        settings['marginal' + suffix], elapsed['marginal' + suffix] = _best(
+            [{'threads': n} for n in counts], lambda **opt: ilib.marginal(mmap, mout, 0, ns, opt['threads'], layout=layout), repeat)
+
+    detect = {layout: elapsed['scan' + suffix] + elapsed['detect' + suffix] for suffix, layout in (('', 'cell'), ('_time', 'time'))}
+    locate = {layout: detect[layout] + elapsed['marginal' + suffix] for suffix, layout in (('', 'cell'), ('_time', 'time'))}
+    settings['layout'] = {'detect': min(detect, key=detect.get), 'locate': min(locate, key=locate.get)}
+
+    def scan_detect(**opt):
+        ilib.scan_detect(cph, None, fsmp, lsmp, ns, dsnr, dind, opt['threads'], tile=opt.get('tile'), stations=cstn)
+
+    settings['scan_detect'] = _fastest([{'threads': n} for n in counts], scan_detect, repeat)
+    settings['scan_detect'] = _fastest([dict(settings['scan_detect'], tile=tl) for tl in (128, 256, 512, 1024, 2048) if tl <= ns],
+                                       scan_detect, repeat) if ns >= 128 else settings['scan_detect']
+    return settings
+
+
+def kernel_settings(sig, tt, fsmp, lsmp, nsamp, stations=None, max_threads=None):
+    '''
+        Settings of each kernel stage for this host, travel-time table shape
+        (cells and stations of all phases), window length and precision. Read
+        from the cache, or calibrated and cached when not known yet.
+    '''
+    backend = ilib.get_backend()
+    if backend == 'numpy':
+        # The NumPy backend is single threaded, there is nothing to tune
+        settings = {stage: {'threads': 1} for stage in STAGES}
+        settings['scan']['kernel'] = 'direct'
+        settings['layout'] = {'detect': 'cell', 'locate': 'cell'}
+        return settings
+
+    phases, weights, shape = _phases(sig, tt, fsmp, nsamp, stations)
+    host  = _host()
+    key   = _key(shape + (sum(psig.shape[0] for psig, ptt, pstn in phases),), nsamp, phases[0][0].dtype, backend)
+    if (host, key) in _settings:
+        return _settings[(host, key)]
+    cache = _read_cache()
+    cached = cache.get(host, {}).get(key, {})
+    if all(stage in cached for stage in STAGES + ('layout',)):
+        _settings[(host, key)] = cached
+        return cached
+
+    tic = time.perf_counter()
+    settings = calibrate(sig, tt, fsmp, lsmp, nsamp, stations, max_threads)
+    print('   Kernel tuning for {} - {} ({:.1f} s)'.format(key, ', '.join(
+        '{}: {}'.format(stage, settings[stage]) for stage in STAGES + ('layout',)), time.perf_counter() - tic))
+
+    cache = _read_cache()
+    cache.setdefault(host, {})[key] = settings
+    _write_cache(cache)
+    _settings[(host, key)] = settings
+    return settings
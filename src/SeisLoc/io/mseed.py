@@ -46,11 +46,15 @@ class MSEED():
         self.FilteredSignal      = None
         self.StationAvaliability = None
 
-        lut = cmod.LUT()
-        lut.load(LUT)
+        if isinstance(LUT, cmod.LUT):
+            lut = LUT
+        else:
+            lut = cmod.LUT()
+            lut.load(LUT)
         self.StationInformation  = lut.station_data
         del lut
         self.st                  = None
+        self._buffer             = dict()   # Data read ahead by read_mseed, shared by the copies of the reader
 
 
     def _stationAvaliability(self,st):
@@ -165,10 +169,35 @@ class MSEED():
         self.FILES = FILES
 
 
-    def read_mseed(self,starttime,endtime,sampling_rate):
+    def _read_ahead(self,read_ahead):
+        '''
+            Raw data between startTime and endTime sliced from the data read ahead by the
+            previous calls. The files are only read again, from startTime to read_ahead
+            seconds after endTime, when the data read ahead does not cover the period.
+            The slice is trimmed to the nearest samples as obspy.read trims, so it holds
+            the same samples as a read of the period from the files.
+        '''
+        buf = self._buffer
+        if buf.get('files') != set(self.FILES) or buf['start'] > self.startTime or buf['end'] < self.endTime:
+            buf.clear()
+            st = obspy.Stream()
+            for f in self.FILES:
+              try:
+                st += obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime + timedelta(seconds=read_ahead)))
+              except:
+                continue
+            buf.update(files=set(self.FILES),start=self.startTime,end=self.endTime + timedelta(seconds=read_ahead),st=st)
+
+        return buf['st'].slice(UTCDateTime(self.startTime),UTCDateTime(self.endTime),nearest_sample=True).copy()
+
+
+    def read_mseed(self,starttime,endtime,sampling_rate,read_ahead=0.0):
         ''' 
             Reading the required mseed files for all stations between two times and return 
             station avaliability of the seperate stations during this period
+
+            With read_ahead > 0 the files are read read_ahead seconds beyond endtime and
+            the data is kept for the following calls (see _read_ahead).
         '''
 
 
@@ -179,19 +208,24 @@ class MSEED():
 
         if len(self.FILES) > 0:
 		# Loading the required mseed data
-                c=0
-                for f in self.FILES:
-                  try:
-                    if c==0:
-                      self.st     = obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
-                      self.st_org = obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
-                      c +=1
-                    else:
-                      self.st += obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
-                      self.st_org += obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
-                  except:
-                    continue
-                    print('Station File not MSEED - {}'.format(f))
+                if read_ahead > 0:
+                  self.st     = self._read_ahead(read_ahead)
+                  self.st_org = self.st.copy()
+                else:
+                  self._buffer.clear()
+                  c=0
+                  for f in self.FILES:
+                    try:
+                      if c==0:
+                        self.st     = obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
+                        self.st_org = obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
+                        c +=1
+                      else:
+                        self.st += obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
+                        self.st_org += obspy.read(f,starttime=UTCDateTime(self.startTime),endtime=UTCDateTime(self.endTime))
+                    except:
+                      continue
+                      print('Station File not MSEED - {}'.format(f))
 
                 # Removing all the stations with gaps greater than 10.0 milliseconds
                 #print(self.st)
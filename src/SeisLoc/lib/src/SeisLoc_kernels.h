@@ -0,0 +1,621 @@
+/* Coalescence kernels. This file is included by SeisLoc.c once for each
+   precision: FLOAT=double with no suffix and FLOAT=float with the suffix _f,
+   e.g. scan4d and scan4d_f. */
+
+/* Phases. The stack is the sum over nphase phases of the onsets sigPts[ip]
+   (rows of fsmp + lsmp + nsamp samples) at the travel-time indices of the
+   table indPts[ip] (ncell x nstnPt[ip]). Only the nactPt[ip] rows listed in
+   stnPts[ip] are stacked, so unavailable stations cost nothing. Each phase is
+   weighted by wgtPt[ip], or 1 if wgtPt is NULL. The phases are separate
+   buffers, stacked in order without concatenating them.
+   If cellPt is not NULL the map kernels stack only the ncell distinct cells
+   listed, into their rows of the full map, and leave the other cells as they
+   are, e.g. for a region of interest of the LUT. */
+static inline void KERNEL(stack_onset)(FLOAT *stkPt, FLOAT *sigStPt, int32_t tn, FLOAT *wgtPt, int32_t ip)
+{
+	FLOAT	 w;
+	int32_t  tm;
+
+	if (wgtPt == NULL)
+	{
+		for(tm=0; tm<tn; tm++)
+			stkPt[tm] += sigStPt[tm];
+	}
+	else
+	{
+		w = wgtPt[ip];
+		for(tm=0; tm<tn; tm++)
+			stkPt[tm] += w * sigStPt[tm];
+	}
+}
+
+EXPORT void KERNEL(scan4d)(FLOAT **sigPts, int32_t **indPts, int32_t **stnPts, int32_t *nstnPt, int32_t *nactPt, FLOAT *wgtPt, int32_t nphase, int64_t *cellPt, FLOAT *mapPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int64_t threads)
+{
+	FLOAT	 *sigStPt, *stkPt;
+	int32_t  ttp;
+	int32_t  ip, is, st;
+	int64_t  ic, cell;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for private(ic,cell,ip,is,st,sigStPt,stkPt,ttp) /* shared(mapPt) */
+	for (ic=0; ic<ncell; ic++)
+	{
+		cell  = (cellPt == NULL) ? ic : cellPt[ic];
+		stkPt = &mapPt[cell * (int64_t) nsamp];
+		for(ip=0; ip<nphase; ip++)
+		{
+			for(is=0; is<nactPt[ip]; is++)
+			{
+				st      = stnPts[ip][is];
+				ttp     = MAX(0,indPts[ip][cell * (int64_t) nstnPt[ip] + st]);
+				sigStPt = &sigPts[ip][st * (int64_t) (fsmp + lsmp + nsamp) + ttp + fsmp];
+				KERNEL(stack_onset)(stkPt, sigStPt, nsamp, wgtPt, ip);
+			}
+		}
+	}
+}
+
+
+/* Cache-blocked scan4d. Blocks of ctile adjacent cells are stacked against a
+   time tile of ttile samples of each station onset, so the onset segment is
+   reused across the block while it is still in cache. Each map element sums
+   the stations in the same order as scan4d, so the output is bit-identical. */
+EXPORT void KERNEL(scan4d_tiled)(FLOAT **sigPts, int32_t **indPts, int32_t **stnPts, int32_t *nstnPt, int32_t *nactPt, FLOAT *wgtPt, int32_t nphase, int64_t *cellPt, FLOAT *mapPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t ctile, int32_t ttile, int64_t threads)
+{
+	FLOAT	 *sigStPt, *stkPt;
+	int32_t  ttp, t0, tn, ip, is, st;
+	int64_t  ic, cell, c0, cn, blk, nblk;
+
+	nblk = (ncell + ctile - 1) / ctile;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for schedule(dynamic) private(blk,c0,cn,ic,cell,t0,tn,ip,is,st,sigStPt,stkPt,ttp)
+	for (blk=0; blk<nblk; blk++)
+	{
+		c0 = blk * (int64_t) ctile;
+		cn = MIN(ncell, c0 + ctile);
+		for (t0=0; t0<nsamp; t0+=ttile)
+		{
+			tn = MIN(ttile, nsamp - t0);
+			for(ip=0; ip<nphase; ip++)
+			{
+				for(is=0; is<nactPt[ip]; is++)
+				{
+					st = stnPts[ip][is];
+					for (ic=c0; ic<cn; ic++)
+					{
+						cell    = (cellPt == NULL) ? ic : cellPt[ic];
+						ttp     = MAX(0,indPts[ip][cell * (int64_t) nstnPt[ip] + st]);
+						sigStPt = &sigPts[ip][st * (int64_t) (fsmp + lsmp + nsamp) + ttp + fsmp + t0];
+						stkPt   = &mapPt[cell * (int64_t) nsamp + t0];
+						KERNEL(stack_onset)(stkPt, sigStPt, tn, wgtPt, ip);
+					}
+				}
+			}
+		}
+	}
+}
+
+
+/* Normalisation of the detected peaks of sample tm by the sum sm of the map
+   over all cells, which is also stored in sumPt[tm]. The peaks are positions of
+   the maximum, so with a positive sum they are those of the normalised map. */
+static void KERNEL(normalise_peaks)(FLOAT *snrPt, FLOAT *sumPt, int32_t tm, int32_t nsamp, int32_t npeak, double sm)
+{
+	int32_t  k;
+
+	sumPt[tm] = (FLOAT) sm;
+	if (sumPt[tm] == 0.0)
+		return;
+	for (k=0; k<npeak; k++)
+		snrPt[k * (int64_t) nsamp + tm] /= sumPt[tm];
+}
+
+/* If sumPt is not NULL the per-sample sums of the map over the cells are
+   accumulated in the same pass and stored in sumPt, and snrPt holds the
+   maximum of the normalised map, map / sum, without a normalised copy. */
+EXPORT void KERNEL(detect4d)(FLOAT *mapPt, FLOAT *snrPt, int64_t *indPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int64_t threads)
+{
+	FLOAT	   mv, cv;
+	double   sm;
+	int32_t  tm;
+	int64_t  cell, ix;
+
+	/* stack data.... */
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for private(cell,tm,mv,ix,cv,sm) /* shared(mapPt) */
+	for (tm=fsmp; tm<lsmp; tm++)
+	{
+	    mv = 0.0;
+	    ix = 0;
+	    sm = 0.0;
+	    for (cell=0; cell<ncell; cell++)
+	    {
+	        cv = mapPt[cell * (int64_t) nsamp + (int64_t) tm];
+	        sm += cv;
+	        if (cv > mv)
+	        {
+	            mv = cv;
+	            ix = cell;
+	        }
+	    }
+	    snrPt[tm] = mv;
+	    indPt[tm] = ix;
+	    if (sumPt != NULL)
+	        KERNEL(normalise_peaks)(snrPt, sumPt, tm, nsamp, 1, sm);
+	}
+}
+
+/* Reduction of every cell of the map over the samples [fsmp, lsmp) into
+   outPt. mode 0 is the log-sum-exp, computed about the maximum of the cell so
+   it does not overflow, mode 1 is the maximum. */
+EXPORT void KERNEL(marginal4d)(FLOAT *mapPt, FLOAT *outPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t mode, int64_t threads)
+{
+	FLOAT	 *cellPt, mv;
+	double   sm;
+	int32_t  tm;
+	int64_t  cell;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for private(cell,cellPt,tm,mv,sm)
+	for (cell=0; cell<ncell; cell++)
+	{
+		cellPt = &mapPt[cell * (int64_t) nsamp];
+		mv = cellPt[fsmp];
+		for (tm=fsmp+1; tm<lsmp; tm++)
+			mv = MAX(mv, cellPt[tm]);
+		if (mode == 1)
+		{
+			outPt[cell] = mv;
+			continue;
+		}
+		sm = 0.0;
+		for (tm=fsmp; tm<lsmp; tm++)
+			sm += exp((double) (cellPt[tm] - mv));
+		outPt[cell] = mv + (FLOAT) log(sm);
+	}
+}
+
+/* Insertion of the candidate cell with coalescence cv into the npeak peaks of
+   one sample, held at valPt[k*stride] and idxPt[k*stride] in descending order
+   with empty entries at value 0 and index -1. A candidate closer than sep cells
+   (Chebyshev distance on the grid dimPt) to a peak at least as large is
+   suppressed, otherwise it replaces the smaller peaks within sep. Equal values
+   keep the first cell visited, so the first peak is the detect4d maximum. */
+static void KERNEL(peak_insert)(FLOAT *valPt, int64_t *idxPt, int64_t stride, int32_t npeak, FLOAT cv, int64_t cell, int32_t *dimPt, int32_t sep)
+{
+	int32_t  k, n;
+	int64_t  cx, cy, cz, pix, dx, dy, dz;
+
+	if (sep > 0)
+	{
+		cz = cell % dimPt[2];
+		cy = (cell / dimPt[2]) % dimPt[1];
+		cx = cell / ((int64_t) dimPt[2] * dimPt[1]);
+		n  = 0;
+		for (k=0; k<npeak; k++)
+		{
+			pix = idxPt[k*stride];
+			if (pix < 0)
+				break;
+			dz = pix % dimPt[2] - cz;
+			dy = (pix / dimPt[2]) % dimPt[1] - cy;
+			dx = pix / ((int64_t) dimPt[2] * dimPt[1]) - cx;
+			if (MAX(MAX(dx,-dx), MAX(MAX(dy,-dy), MAX(dz,-dz))) < sep)
+			{
+				/* The list is sorted, so no peak has been removed yet */
+				if (valPt[k*stride] >= cv)
+					return;
+				continue;
+			}
+			valPt[n*stride] = valPt[k*stride];
+			idxPt[n*stride] = pix;
+			n++;
+		}
+		for (k=n; k<npeak && idxPt[k*stride] >= 0; k++)
+		{
+			valPt[k*stride] = 0.0;
+			idxPt[k*stride] = -1;
+		}
+	}
+
+	for (k=npeak-1; k>0 && valPt[(k-1)*stride] < cv; k--)
+	{
+		valPt[k*stride] = valPt[(k-1)*stride];
+		idxPt[k*stride] = idxPt[(k-1)*stride];
+	}
+	valPt[k*stride] = cv;
+	idxPt[k*stride] = cell;
+}
+
+/* The npeak best spatially separated cells per sample of a map with element
+   (cell, tm) at mapPt[cell*cstride + tm*tstride], shared by both map layouts. */
+static void KERNEL(peaks4d)(FLOAT *mapPt, int64_t cstride, int64_t tstride, FLOAT *snrPt, int64_t *indPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t *dimPt, int32_t npeak, int32_t sep, int64_t threads)
+{
+	FLOAT	 cv, *lowPt, *rowPt;
+	double   sm;
+	int32_t  tm, k;
+	int64_t  cell;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for private(cell,tm,k,cv,sm,lowPt,rowPt)
+	for (tm=fsmp; tm<lsmp; tm++)
+	{
+		sm = 0.0;
+		for (k=0; k<npeak; k++)
+		{
+			snrPt[k * (int64_t) nsamp + tm] = 0.0;
+			indPt[k * (int64_t) nsamp + tm] = -1;
+		}
+		lowPt = &snrPt[(npeak - 1) * (int64_t) nsamp + tm];
+		rowPt = &mapPt[tm * tstride];
+		for (cell=0; cell<ncell; cell++)
+		{
+			cv  = rowPt[cell * cstride];
+			sm += cv;
+			if (cv > *lowPt)
+				KERNEL(peak_insert)(&snrPt[tm], &indPt[tm], nsamp, npeak, cv, cell, dimPt, sep);
+		}
+		if (indPt[tm] < 0)
+			indPt[tm] = 0;
+		if (sumPt != NULL)
+			KERNEL(normalise_peaks)(snrPt, sumPt, tm, nsamp, npeak, sm);
+	}
+}
+
+/* The npeak best spatially separated cells per sample, in the same pass over
+   the map as detect4d. snrPt and indPt are npeak x nsamp, the first row is the
+   detect4d result and missing peaks are 0 with index -1. */
+EXPORT void KERNEL(detect4d_peaks)(FLOAT *mapPt, FLOAT *snrPt, int64_t *indPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t *dimPt, int32_t npeak, int32_t sep, int64_t threads)
+{
+	KERNEL(peaks4d)(mapPt, nsamp, 1, snrPt, indPt, sumPt, fsmp, lsmp, nsamp, ncell, dimPt, npeak, sep, threads);
+}
+
+/* Fused scan and detect. The coalescence map is never stored, each thread stacks
+   a tile of samples for one cell at a time and keeps the running maximum and
+   location for every sample of the tile. Scratch memory is threads*tile.
+   The phases are stacked as in scan4d.
+   If cellPt is not NULL only the ncell listed cells are stacked, in the order
+   given, and the returned locations are the listed cell indices.
+   With npeak > 1, snrPt and idxPt are npeak x nsamp and hold the peaks of
+   detect4d_peaks for the cells of the grid dimPt separated by sep.
+   If sumPt is not NULL the stacks are also summed per sample while they are
+   stacked, and the peaks are normalised as in detect4d. */
+EXPORT void KERNEL(scandetect4d)(FLOAT **sigPts, int32_t **indPts, int32_t **stnPts, int32_t *nstnPt, int32_t *nactPt, FLOAT *wgtPt, int32_t nphase, int64_t *cellPt, FLOAT *snrPt, int64_t *idxPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t *dimPt, int32_t npeak, int32_t sep, int32_t tile, int64_t threads)
+{
+	FLOAT	 *sigStPt, *stkPt, *mvPt, *lowPt;
+	double   *smPt;
+	int32_t  ttp, tm, t0, tn, ip, is, st, k;
+	int64_t  ic, cell, *ixPt;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel private(ic,cell,tm,t0,tn,ip,is,st,k,sigStPt,stkPt,smPt,mvPt,lowPt,ixPt,ttp)
+	{
+		stkPt = (FLOAT *) malloc(sizeof(FLOAT) * (size_t) tile);
+		smPt  = (double *) malloc(sizeof(double) * (size_t) tile);
+
+		#pragma omp for schedule(dynamic)
+		for (t0=0; t0<nsamp; t0+=tile)
+		{
+			tn    = MIN(tile, nsamp - t0);
+			mvPt  = &snrPt[t0];
+			ixPt  = &idxPt[t0];
+			lowPt = &mvPt[(npeak - 1) * (int64_t) nsamp];
+			for (k=0; k<npeak; k++)
+			{
+				for(tm=0; tm<tn; tm++)
+				{
+					mvPt[k * (int64_t) nsamp + tm] = 0.0;
+					ixPt[k * (int64_t) nsamp + tm] = -1;
+				}
+			}
+			for(tm=0; tm<tn; tm++)
+				smPt[tm] = 0.0;
+			for (ic=0; ic<ncell; ic++)
+			{
+				cell  = (cellPt == NULL) ? ic : cellPt[ic];
+				for(tm=0; tm<tn; tm++)
+					stkPt[tm] = 0.0;
+				for(ip=0; ip<nphase; ip++)
+				{
+					for(is=0; is<nactPt[ip]; is++)
+					{
+						st      = stnPts[ip][is];
+						ttp     = MAX(0,indPts[ip][cell * (int64_t) nstnPt[ip] + st]);
+						sigStPt = &sigPts[ip][st * (int64_t) (fsmp + lsmp + nsamp) + ttp + fsmp + t0];
+						KERNEL(stack_onset)(stkPt, sigStPt, tn, wgtPt, ip);
+					}
+				}
+				if (sumPt != NULL)
+				{
+					for(tm=0; tm<tn; tm++)
+						smPt[tm] += stkPt[tm];
+				}
+				if (npeak == 1)
+				{
+					for(tm=0; tm<tn; tm++)
+					{
+						if (stkPt[tm] > mvPt[tm])
+						{
+							mvPt[tm] = stkPt[tm];
+							ixPt[tm] = cell;
+						}
+					}
+				}
+				else
+				{
+					for(tm=0; tm<tn; tm++)
+					{
+						if (stkPt[tm] > lowPt[tm])
+							KERNEL(peak_insert)(&mvPt[tm], &ixPt[tm], nsamp, npeak, stkPt[tm], cell, dimPt, sep);
+					}
+				}
+			}
+			for(tm=0; tm<tn; tm++)
+			{
+				if (ixPt[tm] < 0)
+					ixPt[tm] = 0;
+				if (sumPt != NULL)
+					KERNEL(normalise_peaks)(snrPt, sumPt, t0 + tm, nsamp, npeak, smPt[tm]);
+			}
+		}
+
+		free(stkPt);
+		free(smPt);
+	}
+}
+
+
+/* Leave-one-station-out coalescence of the samples [t0, t1). Every cell is
+   stacked once, keeping the contribution of each of the nout onset rows
+   (stations, summed over the phases) next to the total stack. For o < nout
+   snrPt[o] is the maximum over the cells and samples of the stack without row
+   o, total minus contribution, idxPt[o] its cell and smpPt[o] its sample, and
+   entry nout is the maximum of the total stack. Ties keep the lowest cell and
+   sample. Scratch memory is threads*(nout + 1)*(t1 - t0). */
+EXPORT void KERNEL(jackknife4d)(FLOAT **sigPts, int32_t **indPts, int32_t **stnPts, int32_t *nstnPt, int32_t *nactPt, FLOAT *wgtPt, int32_t nphase, int64_t *cellPt, FLOAT *snrPt, int64_t *idxPt, int32_t *smpPt, int32_t nout, int32_t fsmp, int32_t lsmp, int32_t nsamp, int32_t t0, int32_t t1, int64_t ncell, int64_t threads)
+{
+	FLOAT	 *sigStPt, *stkPt, *conPt, *bvPt, v;
+	int32_t  *btPt, ttp, tm, tn, ip, is, st, o, th, nbest;
+	int64_t  *bxPt, ic, cell, k;
+
+	tn    = t1 - t0;
+	nbest = (int32_t) threads * (nout + 1);
+	bvPt  = (FLOAT *) malloc(sizeof(FLOAT) * (size_t) nbest);
+	bxPt  = (int64_t *) malloc(sizeof(int64_t) * (size_t) nbest);
+	btPt  = (int32_t *) malloc(sizeof(int32_t) * (size_t) nbest);
+	for (k=0; k<nbest; k++)
+	{
+		bvPt[k] = -INFINITY;
+		bxPt[k] = -1;
+		btPt[k] = -1;
+	}
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel private(ic,cell,k,tm,ip,is,st,o,th,v,ttp,sigStPt,stkPt,conPt)
+	{
+		th    = omp_get_thread_num();
+		stkPt = (FLOAT *) malloc(sizeof(FLOAT) * (size_t) tn * (size_t) (nout + 1));
+		conPt = &stkPt[tn];
+
+		#pragma omp for schedule(static)
+		for (ic=0; ic<ncell; ic++)
+		{
+			cell = (cellPt == NULL) ? ic : cellPt[ic];
+			for (tm=0; tm<tn*(nout + 1); tm++)
+				stkPt[tm] = 0.0;
+			for(ip=0; ip<nphase; ip++)
+			{
+				for(is=0; is<nactPt[ip]; is++)
+				{
+					st      = stnPts[ip][is];
+					ttp     = MAX(0,indPts[ip][cell * (int64_t) nstnPt[ip] + st]);
+					sigStPt = &sigPts[ip][st * (int64_t) (fsmp + lsmp + nsamp) + ttp + fsmp + t0];
+					for(tm=0; tm<tn; tm++)
+					{
+						v = (wgtPt == NULL) ? sigStPt[tm] : wgtPt[ip] * sigStPt[tm];
+						stkPt[tm] += v;
+						conPt[st * (int64_t) tn + tm] += v;
+					}
+				}
+			}
+			for (o=0; o<=nout; o++)
+			{
+				k = th * (int64_t) (nout + 1) + o;
+				for(tm=0; tm<tn; tm++)
+				{
+					v = (o == nout) ? stkPt[tm] : stkPt[tm] - conPt[o * (int64_t) tn + tm];
+					if (v > bvPt[k])
+					{
+						bvPt[k] = v;
+						bxPt[k] = cell;
+						btPt[k] = t0 + tm;
+					}
+				}
+			}
+		}
+
+		free(stkPt);
+	}
+
+	/* Reduction of the thread maxima, a tie keeps the lower cell and sample */
+	for (o=0; o<=nout; o++)
+	{
+		snrPt[o] = bvPt[o];
+		idxPt[o] = bxPt[o];
+		smpPt[o] = btPt[o];
+		for (th=1; th<threads; th++)
+		{
+			k = th * (int64_t) (nout + 1) + o;
+			if (bxPt[k] < 0)
+				continue;
+			if (idxPt[o] < 0 || bvPt[k] > snrPt[o] ||
+			    (bvPt[k] == snrPt[o] && (bxPt[k] < idxPt[o] || (bxPt[k] == idxPt[o] && btPt[k] < smpPt[o]))))
+			{
+				snrPt[o] = bvPt[k];
+				idxPt[o] = bxPt[k];
+				smpPt[o] = btPt[k];
+			}
+		}
+	}
+
+	free(bvPt);
+	free(bxPt);
+	free(btPt);
+}
+
+
+/* Time-major kernels. The map element (cell, tm) is mapPt[tm*ncell + cell], so
+   all cells of one sample are contiguous and detection streams through memory
+   instead of reading one value every nsamp elements. The results are
+   bit-identical to the cell-major kernels on the transposed map. */
+
+/* Time-major scan4d. A block of ctile cells is stacked for ttile samples into a
+   cell-major scratch tile as in scan4d_tiled, then added to the map one sample
+   row at a time. Scratch memory is threads*ctile*ttile. nmap is the number of
+   cells of a map row, ncell unless a list of cells is given. */
+EXPORT void KERNEL(scan4d_t)(FLOAT **sigPts, int32_t **indPts, int32_t **stnPts, int32_t *nstnPt, int32_t *nactPt, FLOAT *wgtPt, int32_t nphase, int64_t *cellPt, FLOAT *mapPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int64_t nmap, int32_t ctile, int32_t ttile, int64_t threads)
+{
+	FLOAT	 *sigStPt, *stkPt, *bufPt, *rowPt;
+	int32_t  ttp, tm, t0, tn, ip, is, st;
+	int64_t  ic, cell, c0, cn, blk, nblk;
+
+	nblk = (ncell + ctile - 1) / ctile;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel private(blk,c0,cn,ic,cell,t0,tn,tm,ip,is,st,sigStPt,stkPt,bufPt,rowPt,ttp)
+	{
+		bufPt = (FLOAT *) malloc(sizeof(FLOAT) * (size_t) ctile * (size_t) ttile);
+
+		#pragma omp for schedule(dynamic)
+		for (blk=0; blk<nblk; blk++)
+		{
+			c0 = blk * (int64_t) ctile;
+			cn = MIN(ncell, c0 + ctile);
+			for (t0=0; t0<nsamp; t0+=ttile)
+			{
+				tn = MIN(ttile, nsamp - t0);
+				for (tm=0; tm<(cn - c0)*tn; tm++)
+					bufPt[tm] = 0.0;
+				for(ip=0; ip<nphase; ip++)
+				{
+					for(is=0; is<nactPt[ip]; is++)
+					{
+						st = stnPts[ip][is];
+						for (ic=c0; ic<cn; ic++)
+						{
+							cell    = (cellPt == NULL) ? ic : cellPt[ic];
+							ttp     = MAX(0,indPts[ip][cell * (int64_t) nstnPt[ip] + st]);
+							sigStPt = &sigPts[ip][st * (int64_t) (fsmp + lsmp + nsamp) + ttp + fsmp + t0];
+							stkPt   = &bufPt[(ic - c0) * tn];
+							KERNEL(stack_onset)(stkPt, sigStPt, tn, wgtPt, ip);
+						}
+					}
+				}
+				for(tm=0; tm<tn; tm++)
+				{
+					rowPt = &mapPt[(t0 + tm) * nmap];
+					for (ic=c0; ic<cn; ic++)
+						rowPt[(cellPt == NULL) ? ic : cellPt[ic]] += bufPt[(ic - c0) * tn + tm];
+				}
+			}
+		}
+
+		free(bufPt);
+	}
+}
+
+
+EXPORT void KERNEL(detect4d_t)(FLOAT *mapPt, FLOAT *snrPt, int64_t *indPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int64_t threads)
+{
+	FLOAT	 *rowPt, mv, cv;
+	double   sm;
+	int32_t  tm;
+	int64_t  cell, ix;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for private(cell,tm,mv,ix,cv,sm,rowPt)
+	for (tm=fsmp; tm<lsmp; tm++)
+	{
+		mv    = 0.0;
+		ix    = 0;
+		sm    = 0.0;
+		rowPt = &mapPt[tm * (int64_t) ncell];
+		for (cell=0; cell<ncell; cell++)
+		{
+			cv  = rowPt[cell];
+			sm += cv;
+			if (cv > mv)
+			{
+				mv = cv;
+				ix = cell;
+			}
+		}
+		snrPt[tm] = mv;
+		indPt[tm] = ix;
+		if (sumPt != NULL)
+			KERNEL(normalise_peaks)(snrPt, sumPt, tm, nsamp, 1, sm);
+	}
+}
+
+
+EXPORT void KERNEL(detect4d_peaks_t)(FLOAT *mapPt, FLOAT *snrPt, int64_t *indPt, FLOAT *sumPt, int32_t fsmp, int32_t lsmp, int32_t nsamp, int64_t ncell, int32_t *dimPt, int32_t npeak, int32_t sep, int64_t threads)
+{
+	KERNEL(peaks4d)(mapPt, 1, ncell, snrPt, indPt, sumPt, fsmp, lsmp, nsamp, ncell, dimPt, npeak, sep, threads);
+}
+
+
+/* Time-major marginal4d. Each thread reduces a block of MBLOCK cells, reading
+   the contiguous block of every sample row once for the maximum and once for
+   the sum, in the same sample order as marginal4d. */
+#define MBLOCK 512
+EXPORT void KERNEL(marginal4d_t)(FLOAT *mapPt, FLOAT *outPt, int32_t fsmp, int32_t lsmp, int64_t ncell, int32_t mode, int64_t threads)
+{
+	FLOAT	 *rowPt;
+	double   sm[MBLOCK];
+	int32_t  tm;
+	int64_t  cell, c0, cn, blk, nblk;
+
+	nblk = (ncell + MBLOCK - 1) / MBLOCK;
+
+	omp_set_num_threads(threads);
+
+	#pragma omp parallel for schedule(dynamic) private(blk,c0,cn,cell,tm,rowPt,sm)
+	for (blk=0; blk<nblk; blk++)
+	{
+		c0 = blk * (int64_t) MBLOCK;
+		cn = MIN(ncell, c0 + MBLOCK);
+		rowPt = &mapPt[fsmp * (int64_t) ncell];
+		for (cell=c0; cell<cn; cell++)
+			outPt[cell] = rowPt[cell];
+		for (tm=fsmp+1; tm<lsmp; tm++)
+		{
+			rowPt = &mapPt[tm * (int64_t) ncell];
+			for (cell=c0; cell<cn; cell++)
+				outPt[cell] = MAX(outPt[cell], rowPt[cell]);
+		}
+		if (mode == 1)
+			continue;
+		for (cell=c0; cell<cn; cell++)
+			sm[cell - c0] = 0.0;
+		for (tm=fsmp; tm<lsmp; tm++)
+		{
+			rowPt = &mapPt[tm * (int64_t) ncell];
+			for (cell=c0; cell<cn; cell++)
+				sm[cell - c0] += exp((double) (rowPt[cell] - outPt[cell]));
+		}
+		for (cell=c0; cell<cn; cell++)
+			outPt[cell] = outPt[cell] + (FLOAT) log(sm[cell - c0]);
+	}
+}
+#undef MBLOCK
@@ -1,4 +1,3 @@
 #!/bin/bash
 
-gcc -shared -fPIC -std=gnu99 onset.c cmscan.c levinson.c -fopenmp -O0 -o ../cmslib.so
-
+gcc -shared -fPIC -std=gnu99 onset.c SeisLoc.c levinson.c -fopenmp -O3 -o ../SeisLoc.so
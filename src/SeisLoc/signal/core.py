@@ -2,7 +2,7 @@
 import numpy as np
 import scipy.signal as ssp
 from scipy.signal import butter, lfilter, detrend
-from ..core import cmslib
+from ..core import backend
 
 
 def nextpow2(n):
@@ -49,7 +49,7 @@ def detrend(sig, mean=False):
 
 def filter(sig, srate, lc, hc, order=3):
     b1, a1 = butter(order, [2.0*lc/srate, 2.0*hc/srate], btype='bandpass')
-    indx = np.zeros((sig.shape[-1],), dtype=np.int)
+    indx = np.zeros((sig.shape[-1],), dtype=int)
     fsig = sig - sig[..., indx]
     fsig = lfilter(b1, a1, fsig)
     return fsig
@@ -57,7 +57,7 @@ def filter(sig, srate, lc, hc, order=3):
 
 def filtfilt(sig, srate, lc, hc, order=3):
     b1, a1 = butter(order, [2.0*lc/srate, 2.0*hc/srate], btype='bandpass')
-    indx = np.zeros((sig.shape[-1],), dtype=np.int)
+    indx = np.zeros((sig.shape[-1],), dtype=int)
     fsig = sig - sig[..., indx]
     fsig = lfilter(b1, a1, fsig[..., ::-1])
     fsig = lfilter(b1, a1, fsig[..., ::-1])
@@ -97,7 +97,7 @@ def onset(sig, stw, ltw, srate=1, gap=0, log=False):
     env = np.abs(complex_env(sig))
     stw = int(stw*srate + 0.5)
     ltw = int(ltw*srate + 0.5)
-    snr = cmslib.onset(env, stw, ltw, gap)
+    snr = backend.onset(env, stw, ltw, gap)
     if log:
         np.clip(1+snr, 0.8, np.inf, snr)
         np.log(snr, snr)
@@ -110,7 +110,7 @@ def onset2(sig1, sig2, stw, ltw, srate=1, gap=0, log=False):
     env = np.sqrt(np.abs(env1 * env1 + env2 * env2))
     stw = int(stw*srate + 0.5)
     ltw = int(ltw*srate + 0.5)
-    snr = cmslib.onset(env, stw, ltw, gap)
+    snr = backend.onset(env, stw, ltw, gap)
     if log:
         np.clip(1+snr, 0.8, np.inf, snr)
         np.log(snr, snr)
@@ -130,7 +130,7 @@ def onset_s(sig, stw, ltw, srate=1, gap=0, log=True):
     stw = int(stw*srate + 0.5)
     ltw = int(ltw*srate + 0.5)
     env = np.sqrt(np.abs(enx*enx + eny*eny))
-    snr = cmslib.onset(env, stw, ltw, gap)
+    snr = backend.onset(env, stw, ltw, gap)
     if log:
         np.clip(1+snr, 0.8, np.inf, snr)
         np.log(snr, snr)
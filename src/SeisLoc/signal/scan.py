@@ -19,14 +19,22 @@ from scipy.signal import butter, lfilter
 from scipy.optimize import curve_fit
 from scipy import stats
 
-import SeisLoc.core.SeisLoclib as ilib
+import SeisLoc.core.backend as ilib
+import SeisLoc.core.tuning as tuning
 
 import obspy
-import re
 
 import os
 import os.path as path
 import pickle
+import copy
+import json
+import queue
+import hashlib
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 
@@ -102,7 +110,7 @@ def sta_lta_centred(a, nsta, nlta):
     sta = np.cumsum(a ** 2)
 
     # Convert to float
-    sta = np.require(sta, dtype=np.float)
+    sta = np.require(sta, dtype=np.float64)
 
     # Copy for LTA
     lta = sta.copy()
@@ -152,6 +160,25 @@ def onset(sig, stw, ltw):
     return snr_raw,snr
 
 
+def max_pool(sig, factor, offset=0, length=None):
+    '''
+        Temporal max-pooling of the onset functions sig (nchan, nsamp). Sample j
+        of the output is the maximum of sig[:, offset + j*factor : offset + (j+1)*factor],
+        ignoring NaN, and samples beyond the end of sig are 0. The output has length
+        samples, default all blocks of sig.
+
+    '''
+    nchan, nsamp = sig.shape
+    starts = np.arange(offset, nsamp, factor)
+    if length is None:
+        length = starts.size
+    pooled = np.zeros((nchan, length), dtype=sig.dtype)
+    nblk   = min(length, starts.size)
+    if nblk > 0:
+        pooled[:, :nblk] = np.fmax.reduceat(sig, starts, axis=1)[:, :nblk]
+    return pooled
+
+
 def filter(sig,srate,lc,hc,order=3):
     '''
 
@@ -172,6 +199,21 @@ def filter(sig,srate,lc,hc,order=3):
 
 
 
+def _available_memory():
+    '''
+        Available memory in bytes, MemAvailable of /proc/meminfo, or None where it
+        is not known.
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
 def _find(obj, name, default=None):
     if isinstance(name, str):
         if name in obj:
@@ -187,12 +229,59 @@ def _find(obj, name, default=None):
         return default
 
 
+def _map_layout(MAP):
+    '''
+        Contiguous array and layout of a coalescence map indexed [x, y, z, t]. A
+        time-major map of SeisScan is the transposed view of a (t, x, y, z) array,
+        which is the array the kernels are given.
+    '''
+    if MAP.flags['C_CONTIGUOUS']:
+        return MAP, 'cell'
+    tmap = np.moveaxis(MAP, -1, 0)
+    if tmap.flags['C_CONTIGUOUS']:
+        return tmap, 'time'
+    return np.ascontiguousarray(MAP), 'cell'
+
+
+def _scan_columns(npeak=1):
+    '''
+        Columns of a .scn file. The maximum coalescence is followed by
+        COA_k,X_k,Y_k,Z_k for each further peak k = 2..npeak of the extended format.
+    '''
+    columns = ['DT','COA','X','Y','Z']
+    for k in range(2, npeak + 1):
+        columns += ['COA_{}'.format(k), 'X_{}'.format(k), 'Y_{}'.format(k), 'Z_{}'.format(k)]
+    return columns
+
+
 def _read_scan(fname):
-    CoaVal = pd.read_csv(fname,names=['DT','COA','X','Y','Z'])
+    with open(fname, 'r') as fp:
+        ncol = len(fp.readline().split(','))
+    CoaVal = pd.read_csv(fname,names=_scan_columns(1 + max(0, ncol - 5)//4))
     CoaVal['DT'] = pd.to_datetime(CoaVal['DT'])
     return CoaVal
 
 
+def _scan_peak(CoaVal, peak):
+    '''
+        DT,COA,X,Y,Z frame of peak number peak (1 is the maximum coalescence) of
+        a .scn file in the extended format.
+    '''
+    if peak == 1:
+        return CoaVal[['DT','COA','X','Y','Z']]
+    CoaPeak = CoaVal[['DT'] + ['{}_{}'.format(c, peak) for c in ('COA','X','Y','Z')]]
+    CoaPeak.columns = ['DT','COA','X','Y','Z']
+    return CoaPeak
+
+
+def _trigger_frame():
+    '''
+        Empty frame of triggered events, returned when the coalescence does not
+        exceed the DetectionThreshold.
+    '''
+    return pd.DataFrame(columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime','EventID','Peak'])
+
+
 
 
 
@@ -261,15 +350,24 @@ class SeisOutFile:
            os.system('rm {}'.format(fname))
 
 
-    def write_scan(self,daten,dsnr,dloc):
+    def write_scan(self,daten,dsnr,dloc,peaks=None):
+        '''
+            Appending the maximum coalescence to the .scn file. peaks is an optional
+            list of (coalescence, coordinates) for the further peaks, written as
+            extra columns of the extended format (see _scan_columns).
+
+        '''
         # Defining the ouput filename
         fname = path.join(self.path,self.name + '.scn')
+        if peaks is None:
+            peaks = []
+        columns = _scan_columns(1 + len(peaks))
 
         # Defining the array to save
         ARRAY = np.array((daten,dsnr,dloc[:,0],dloc[:,1],dloc[:,2]))
         # # if 
         if self.FileSampleRate == None:
-            DF        = pd.DataFrame(columns=['DT','COA','X','Y','Z'])
+            DF        = pd.DataFrame(columns=columns)
             DF['DT']  = daten
             DF['DT']  = pd.to_datetime(DF['DT'])
             DF['DT']  = DF['DT'].astype(str)
@@ -277,15 +375,19 @@ class SeisOutFile:
             DF['X']   = dloc[:,0]
             DF['Y']   = dloc[:,1]
             DF['Z']   = dloc[:,2]
+            for k, (pcoa, ploc) in enumerate(peaks, 2):
+                DF[columns[4*k-3:4*k+1]] = np.column_stack((pcoa, ploc))
 
         else:
             # Resampling the data on save
-            DF = pd.DataFrame(columns=['DT','COA','X','Y','Z'])
+            DF = pd.DataFrame(columns=columns)
             DF['DT']  = daten
             DF['COA'] = dsnr
             DF['X']   = dloc[:,0]
             DF['Y']   = dloc[:,1]
             DF['Z']   = dloc[:,2]
+            for k, (pcoa, ploc) in enumerate(peaks, 2):
+                DF[columns[4*k-3:4*k+1]] = np.column_stack((pcoa, ploc))
             DF['DT'] = pd.to_datetime(DF['DT'])
             #DF = DF.set_index(pd.DatetimeIndex(DF['DT']))
             DF = DF.set_index(DF['DT'])
@@ -303,7 +405,7 @@ class SeisOutFile:
 
         with open(fname, append_write) as fp:
             for ii in range(ARRAY.shape[0]):
-                fp.write('{},{},{},{},{}\n'.format(ARRAY[ii,0],ARRAY[ii,1],ARRAY[ii,2],ARRAY[ii,3],ARRAY[ii,4]))
+                fp.write(','.join('{}'.format(val) for val in ARRAY[ii,:]) + '\n')
 
 
     def write_TriggerEvents(self,DF):
@@ -387,7 +489,7 @@ class SeisPlot:
             CoalescenceMarginalizeLocation - 
 
     '''
-    def __init__(self,lut,MAP,CoaMAP,DATA,EVENT,StationPick,MarginalWindow,PlotOptions=None):
+    def __init__(self,lut,MAP,CoaMAP,DATA,EVENT,StationPick,MarginalWindow,PlotOptions=None,NumberOfCores=1):
         '''
             This is the initial variatiables
         '''
@@ -398,6 +500,7 @@ class SeisPlot:
         self.CoaMAP      = CoaMAP
         self.StationPick = StationPick
         self.RangeOrder  = True
+        self.NumberOfCores = NumberOfCores
 
 
         if PlotOptions == None:
@@ -428,7 +531,16 @@ class SeisPlot:
 
         self.logoPath = '{}/SeisLoc.png'.format('/'.join(ilib.__file__.split('/')[:-2]))
 
-        self.MAPmax   = np.max(MAP)
+        MAPmax = np.zeros(MAP.shape[:-1], dtype=MAP.dtype)
+        kmap, layout = _map_layout(MAP)
+        ilib.marginal(kmap, MAPmax, 0, MAP.shape[-1], self.NumberOfCores, reduce='max', layout=layout)
+        self.MAPmax   = np.max(MAPmax)
+
+        # Marginal coalescence over the whole map if not given
+        if self.CoaMAP is None:
+            CoaMAP = np.zeros(MAP.shape[:-1], dtype=MAP.dtype)
+            ilib.marginal(kmap, CoaMAP, 0, MAP.shape[-1], self.NumberOfCores, layout=layout)
+            self.CoaMAP = CoaMAP/np.max(CoaMAP)
         self.MarginalWindow = MarginalWindow
 
 
@@ -1029,7 +1141,7 @@ class SeisScanParam:
         self.station_p1 = None
         self.station_s1 = None
         self.detection_threshold = 3.0
-        self.detection_downsample = 5
+        self.detection_downsample = 1
         self.detection_window = 3.0
         self.minimum_velocity = 3000.0
         self.marginal_window = [0.5, 3000.0]
@@ -1038,6 +1150,7 @@ class SeisScanParam:
         self.StartDateTime=None
         self.EndDateTime=None
         self.Decimate=[1,1,1]
+        self.backend = None
 
         if param:
             self.load(param)
@@ -1101,6 +1214,7 @@ class SeisScanParam:
             self.minimum_velocity     = _find(scn,"MinimumVelocity",self.minimum_velocity)
             self.marginal_window      = _find(scn,"MarginalWindow",self.marginal_window)
             self.location_method      = _find(scn,"LocationMethod",self.location_method)
+            self.backend              = _find(scn,"Backend",self.backend)
 
     def _load_json(self, json_file):
         param = None
@@ -1113,12 +1227,64 @@ class SeisScanParam:
         self._set_param(param)
 
 
+# ----- Parallel Detect workers -----
+
+_worker = None
+
+def _part_name(name, k):
+    return '{}.part{:05d}'.format(name, k)
+
+
+def _merge_part(output, k):
+    '''
+        Appending part k of the .scn of output to the .scn, and removing the part.
+
+    '''
+    part = path.join(output.path, _part_name(output.name, k) + '.scn')
+    if not path.exists(part):
+        return
+    with open(path.join(output.path, output.name + '.scn'), 'ab') as fp, open(part, 'rb') as fq:
+        shutil.copyfileobj(fq, fp)
+    os.remove(part)
+
+
+def _detect_worker(scan, models, depth, nproc):
+    '''
+        Initialising a Detect worker process with its copy of the scan (and its DATA
+        reader), the LUTs and outputs of the models and the prefetch depth. With
+        NumberOfCores 'auto' the cores are shared between the processes.
+
+    '''
+    global _worker
+    if scan.NumberOfCores == 'auto':
+        scan.NumberOfCores = max(1, (os.cpu_count() or 1) // nproc)
+    scan._set_backend()
+    _worker = (scan, models, depth)
+
+
+def _detect_shard(k, windows):
+    '''
+        Scanning a shard of windows in a worker, into the part k of each output.
+
+    '''
+    scan, models, depth = _worker
+    parts = [(lut, SeisOutFile(output.path, _part_name(output.name, k))) for lut, output in models]
+    for lut, part in parts:
+        part.del_scan()
+    scan._screened = [0, 0]
+    return k, scan._scan_windows(windows, parts, depth)
+
+
 class SeisScan:
 
     def __init__(self, DATA, LUT, reader=None, param=None, output_path=None, output_name=None):
         
-        lut = cmod.LUT()
-        lut.load(LUT)
+        # A LUT file, or a LUT object (e.g. attached to a shared LUT) used as is
+        if isinstance(LUT, cmod.LUT):
+            lut = LUT
+        else:
+            lut = cmod.LUT()
+            lut.load(LUT)
         self.sample_rate = 1000.0
         self.seis_reader = None
         self.lookup_table = lut
@@ -1132,7 +1298,7 @@ class SeisScan:
 
         ttmax = np.max(lut.fetch_map('TIME_S'))
         self.pre_pad   = None
-        self.post_pad  = round(ttmax + ttmax*0.05)
+        self.post_pad  = int(np.ceil(ttmax + ttmax*0.05))
         self.time_step = 10.0
 
         self.daten = None
@@ -1170,13 +1336,58 @@ class SeisScan:
         self._map = None
         self._daten = None
         self._dsnr = None
+        self._dpeaks = None
+        self._kernel = None
+        self._layout = 'cell'
+        self._screened = [0, 0]
+        self._stack = None
+        self._table_rate = None
+        self._unique = {}
+        self._nbatch = 1
+        self._models = None
+        self._cell_size = np.array(lut.cell_size, dtype=float)
         self.snr = None 
         self._data = None
 
 
-        self.NumberOfCores = 1
+        self.NumberOfCores = 'auto'             # Threads of the kernels, 'auto' calibrates them per host and grid
+        self.ScanKernel    = None               # 'direct' or cache-blocked 'tiled' scan4d, None for tuned/direct
+        self.Backend       = param.backend      # 'compiled', 'numpy' or None for $SEISLOC_BACKEND (default auto)
+        self.MapLayout     = 'auto'             # 'cell' or 'time'-major 4D map, 'auto' for the faster (tuned) layout
+        self.PhaseWeights  = None               # Weights of the P and S onsets in the stack, e.g. [1.0, 0.5], None for 1
+        self.DetectionDownsample = param.detection_downsample   # Max-pooling factor of the onsets in Detect, 1 for the full sample_rate
+        self.DeduplicateCells    = False        # Stack the cells with identical travel-time index vectors once
+        self.BatchWindows        = 1            # Consecutive Detect windows (time_step) computed by one kernel call, sharing their pads (see _batch_windows)
+        self.BatchMemory         = 0.5          # Fraction of the available memory a batch of windows may use
+        self.ReadAhead           = 0.0          # Seconds of data read from the files beyond each window and kept for the next windows
+        self.PrefetchWindows     = 0            # Windows read and turned into onsets ahead by a background thread while one is stacked
+        self.PrefetchMemory      = 0.25         # Fraction of the available memory the prefetched windows may use
+        self.DetectProcesses     = 1            # Processes scanning shards of consecutive windows, merged into the .scn in time order
+        self.DetectShards        = 4            # Shards per process, for the balance of the processes
+        self.ShareLUT            = True         # The processes attach to the LUT tables in shared memory instead of copies
+        self.DetectCheckpoint    = True         # Recording the last window written to the .scn in <name>.scn.ckpt
+        self.DetectResume        = False        # Continuing an interrupted Detect from its checkpoint, keeping the .scn
+
+        # Further velocity models scanned by Detect with the onsets of the scan LUT, (LUT, output name)
+        # pairs with a LUT file or object on the same stations, each written to <output name>.scn
+        self.Models        = []
+
+        # Region of interest, only these cells of the scan LUT (after Decimate) are stacked
+        self.ScanMask      = None               # Boolean array of the LUT cell_count, True for the cells to scan
+        self.ScanPoints    = None               # Candidate source points (n, 3) in the LUT xyz coordinates, scanned at their nearest cell
+
+        # Coarse-to-fine Detect, e.g. [[8,8,8],[4,4,4],[2,2,2]] relative to the scan LUT
+        self.HierarchicalDecimate = None
+        self.HierarchicalCells    = 2           # Best cells of every sample refined on the next level
+
+        # Cascade Detect, each window is first scanned on the LUT decimated by ScreenDecimate,
+        # e.g. [4,4,4], and only scanned in full if it reaches ScreenMargin*DetectionThreshold
+        self.ScreenDecimate = None
+        self.ScreenMargin   = 0.8
 
         self.DetectionThreshold = 1
+        self.DetectionPeaks     = 1             # Spatially separated coalescence peaks per sample in the .scn
+        self.PeakSeparation     = 5             # Minimum separation of the peaks in cells of the scan grid
         self.MarginalWindow     = 30
         self.MinimumRepeat      = 30
         self.PercentageTT       = 0.1
@@ -1187,7 +1398,12 @@ class SeisScan:
         self.CutMSEED           = False
         self.PickingType        = 'Gaussian'
         self.LocationError      = 0.95
+        self.StationJackknife   = False         # Leave-one-station-out influence of each station in the .event output
+        self.JackknifeWindow    = 0.1           # Half-width (s) about the event time searched for the jackknife maxima
         self.NormaliseCoalescence = False
+        self.Precision            = 'float64'   # 'float64' or 'float32' for the onsets, map and kernels
+        self.PrecisionValidate    = False       # Compare each float32 window against the float64 path
+        self.PrecisionDeviation   = None
 
         self.Output_SampleRate = None 
 
@@ -1241,7 +1457,23 @@ class SeisScan:
         return snr_raw,snr
 
 
-    def _compute(self, cstart,cend, samples,station_avaliability):
+    def _compute(self, cstart,cend, samples,station_avaliability,return_map=True,downsample=1,reuse_onsets=False):
+        '''
+            Coalescence of the onset functions over the LUT. When return_map is False
+            the fused scan-and-detect kernel is used, also with NormaliseCoalescence,
+            and the 4D coalescence map is never allocated (_map = None). With
+            reuse_onsets the onsets of the previous call on the same window (DATA.SNR_P
+            and DATA.SNR_S) are stacked again, e.g. over the LUT of another model.
+
+            With downsample > 1 the onsets are max-pooled over blocks of downsample
+            samples and stacked with the index tables of the coarse rate. The blocks lie
+            on one grid from StartDateTime for all windows, so the coarse samples are
+            evenly spaced also when downsample does not divide the window. daten, dsnr
+            and dloc are then the blocks starting in the window, each time being the
+            start of its block, followed by the first block of the next window (in place
+            of the last sample at the full rate, dropped when writing the .scn).
+
+        '''
 
         srate = self.sample_rate
 
@@ -1256,48 +1488,83 @@ class SeisScan:
         #sign = sign - np.mean(sign,axis=1)
         #sigz = sigz - np.mean(sigz,axis=1)
 
-        snr_p1_raw,snr_p1 = self._compute_onset_p1(sigz, srate)
-        snr_s1_raw,snr_s1 = self._compute_onset_s1(sige, sign, srate)
-        self.DATA.SNR_P = snr_p1
-        self.DATA.SNR_S = snr_s1
-        self.DATA.SNR_P_raw = snr_p1_raw
-        self.DATA.SNR_S_raw = snr_s1_raw
+        if not reuse_onsets:
+            snr_p1_raw,snr_p1 = self._compute_onset_p1(sigz, srate)
+            snr_s1_raw,snr_s1 = self._compute_onset_s1(sige, sign, srate)
+            self.DATA.SNR_P = snr_p1
+            self.DATA.SNR_S = snr_s1
+            self.DATA.SNR_P_raw = snr_p1_raw
+            self.DATA.SNR_S_raw = snr_s1_raw
 
         #self._Gaussian_Coalescence()
 
 
-        snr = np.concatenate((self.DATA.SNR_P, self.DATA.SNR_S))
-        snr[np.isnan(snr)] = 0
-        
-        
-        ttp = self.lookup_table.fetch_index('TIME_P', srate)
-        tts = self.lookup_table.fetch_index('TIME_S', srate)
-        tt = np.c_[ttp, tts]
-        del ttp,tts
+        dtype = np.dtype(self.Precision)
+        # One (onset, travel-time index table) pair per phase, stacked by the kernels
+        # as separate buffers. The tables are cached by the LUT.
+        onsets = [self.DATA.SNR_P, self.DATA.SNR_S]
 
-        nchan, tsamp = snr.shape
+        nchan, tsamp = onsets[0].shape
 
         pre_smp = int(round(self.pre_pad * int(srate)))
         pos_smp = int(round(self.post_pad * int(srate)))
         nsamp = tsamp - pre_smp - pos_smp
         daten = 0.0 - pre_smp / srate
 
-        ncell = tuple(self.lookup_table.cell_count)
-
-        _map = np.zeros(ncell + (nsamp,), dtype=np.float64)
+        # Temporal downsampling on one grid of blocks from StartDateTime. The window
+        # starts s0 samples after StartDateTime and its first block starts first samples
+        # later. The pooled onsets keep at least the post-pad of the coarse travel times
+        # (rounded up) behind the last block.
+        ds = max(1, int(downsample or 1))
+        if ds > 1:
+            s0     = int(round((cstart + timedelta(seconds=self.pre_pad) - self.StartDateTime).total_seconds() * srate))
+            first  = -s0 % ds
+            block  = -(-s0 // ds)
+            nblock = -(-(s0 + nsamp - 1) // ds) - block + 1
+            offset = (pre_smp + first) % ds
+            pre_smp, nsamp, pos_smp = (pre_smp + first) // ds, nblock, -(-pos_smp // ds)
+            onsets = [max_pool(onset, ds, offset, pre_smp + nsamp + pos_smp) for onset in onsets]
+        tables = [self.lookup_table.fetch_index_table(['TIME_P'], srate / ds), self.lookup_table.fetch_index_table(['TIME_S'], srate / ds)]
+        self._table_rate = srate / ds
+        phases = [(self._phase_onset(onset, dtype), table) for onset, table in zip(onsets, tables)]
 
-        dind = np.zeros(nsamp, np.int64)
-        dsnr = np.zeros(nsamp, np.double)
+        ncell = tuple(self.lookup_table.cell_count)
 
-        ilib.scan(snr, tt, pre_smp, pos_smp, nsamp, _map, self.NumberOfCores)
-        if self.NormaliseCoalescence == True:
-            _map =  _map / np.sum(_map,axis=(0,1,2))[np.newaxis,np.newaxis,np.newaxis,:]
-        ilib.detect(_map, dsnr, dind, 0,nsamp, self.NumberOfCores)
-        daten = np.arange((cstart+timedelta(seconds=self.pre_pad)), (cend + timedelta(seconds=-self.post_pad) + timedelta(seconds=1/srate)),timedelta(seconds=1/srate))
-        if self.NormaliseCoalescence == False:
-            dsnr  = np.exp((dsnr / (len(avaInd)*2)) - 1.0)
+        # Onset rows of the available (and selected) stations of each phase, the other
+        # stations are skipped by the kernels and excluded from the normalisation
+        stations = [self._phase_stations(avaInd, self.station_p1), self._phase_stations(avaInd, self.station_s1)]
+        weights  = np.ones(len(phases)) if self.PhaseWeights is None else np.asarray(self.PhaseWeights, dtype=float)
+        nstack   = np.sum(weights * np.array([stn.size for stn in stations]))
+        self._stack = (phases, pre_smp, pos_smp, nsamp, ncell, stations)
+
+        # Windows that fail the cascade pre-screen keep the screening resolution result
+        _map   = None
+        screen = None
+        if not return_map and self.ScreenDecimate is not None:
+            screen = self._screen(phases, pre_smp, pos_smp, nsamp, ncell, stations, nstack)
+
+        if screen is not None:
+            dsnr, dind = screen
+        else:
+            dsnr, dind, _map = self._coalesce(phases, pre_smp, pos_smp, nsamp, ncell, return_map, stations)
+            if self.PrecisionValidate == True and dtype != np.float64:
+                phases64 = [(self._phase_onset(onset, np.float64), table) for onset, table in zip(onsets, tables)]
+                self._validate_precision(phases64, pre_smp, pos_smp, nsamp, ncell, return_map, stations, dsnr, dind)
+            cells = self._scan_cells(ncell)
+            dsnr  = self._coalescence_value(dsnr, nstack, np.prod(ncell) if cells is None else cells.size)
+
+        if ds > 1:
+            daten = np.datetime64(self.StartDateTime) + np.rint((block + np.arange(nsamp)) * ds * 1e6 / srate).astype(np.int64) * np.timedelta64(1, 'us')
         else:
-            dsnr  = dsnr * _map.shape[0] * _map.shape[1] * _map.shape[2]
+            daten = np.arange((cstart+timedelta(seconds=self.pre_pad)), (cend + timedelta(seconds=-self.post_pad) + timedelta(seconds=1/srate)),timedelta(seconds=1/srate))
+
+        # All peaks are kept for the .scn and Trigger, missing peaks are NaN
+        self._dpeaks = None
+        if self.DetectionPeaks > 1:
+            dsnr[dind < 0] = np.nan
+            self._dpeaks = (dsnr, dind)
+        dsnr  = dsnr[0]
+        dind  = dind[0]
         dloc  = self.lookup_table.index2xyz(dind)
         
         self._dsnr = dsnr
@@ -1306,6 +1573,383 @@ class SeisScan:
         return daten, dsnr, dloc, _map
 
 
+    def _coalescence_value(self, dsnr, nstack, nscan):
+        '''
+            Coalescence value of the kernel output, exp(dsnr/nstack - 1) with nstack the
+            weighted station count, or with NormaliseCoalescence the normalised
+            coalescence times the number of scanned cells nscan.
+
+        '''
+        dsnr = dsnr.astype(np.float64)
+        if self.NormaliseCoalescence == False:
+            return np.exp((dsnr / nstack) - 1.0)
+        return dsnr * nscan
+
+
+    def _screen(self, phases, pre_smp, pos_smp, nsamp, ncell, stations, nstack):
+        '''
+            Cascade pre-screen of a Detect window. The window is scanned on the LUT grid
+            decimated by ScreenDecimate (within the region of interest) by the fused
+            kernel. If the maximum coalescence stays below ScreenMargin times the
+            DetectionThreshold the window is skipped and the screening dsnr and dind
+            are returned for the .scn, otherwise None for a full scan.
+
+        '''
+        kernel = self._kernel_settings(phases, pre_smp, pos_smp, nsamp, stations)
+        roi    = self._scan_cells(ncell)
+        cells  = self._hierarchical_cells(self.ScreenDecimate, ncell)
+        if roi is not None:
+            cells = np.intersect1d(cells, roi, assume_unique=True)
+            cells = roi if cells.size == 0 else cells
+
+        npeak = max(1, self.DetectionPeaks)
+        dind  = np.zeros((npeak, nsamp), np.int64)
+        dsnr  = np.zeros((npeak, nsamp), phases[0][0].dtype)
+        norm  = np.zeros(nsamp, dsnr.dtype) if self.NormaliseCoalescence == True else None
+        ilib.scan_detect(phases, None, pre_smp, pos_smp, nsamp, dsnr, dind, cells=cells, stations=stations, norm=norm, weights=self.PhaseWeights,
+                         peaks=npeak, separation=self.PeakSeparation, **kernel['scan_detect'])
+        dsnr  = self._coalescence_value(dsnr, nstack, cells.size)
+
+        cmax  = np.max(dsnr[0]) if nsamp > 0 else 0.0
+        limit = self.ScreenMargin * self.DetectionThreshold
+        skip  = bool(cmax < limit)
+        self._screened[0] += int(skip) * self._nbatch
+        self._screened[1] += self._nbatch
+        print('   Screening - Max coalescence {:.3f} on {} cells, limit {:.3f} - {}'.format(cmax, cells.size, limit, 'skipped' if skip else 'full scan'))
+        return (dsnr, dind) if skip else None
+
+
+    def _jackknife(self, tm):
+        '''
+            Leave-one-station-out influence at sample tm of the last _compute, from one
+            pass of the jackknife kernel over the window of JackknifeWindow seconds about
+            tm. For each station of the LUT, Jackknife_COA_<name> is the maximum
+            coalescence of the stack without the station and Jackknife_Shift_<name> the
+            distance of its location from the location with all stations (Jackknife_COA),
+            NaN for stations that are not stacked. The coalescence is that of the
+            stack, exp(stack/nstack - 1), also with NormaliseCoalescence.
+
+        '''
+        phases, pre_smp, pos_smp, nsamp, ncell, stations = self._stack
+        win    = int(round(self.JackknifeWindow * self.sample_rate))
+        t0, t1 = max(0, tm - win), min(nsamp, tm + win + 1)
+        nstn   = max(onset.shape[0] for onset, table in phases)
+        dsnr   = np.zeros(nstn + 1, phases[0][0].dtype)
+        dind   = np.zeros(nstn + 1, np.int64)
+        dsmp   = np.zeros(nstn + 1, np.int32)
+        ilib.jackknife(phases, None, pre_smp, pos_smp, nsamp, t0, t1, dsnr, dind, dsmp, self._threads('scan_detect'),
+                       cells=self._scan_cells(ncell), stations=stations, weights=self.PhaseWeights)
+
+        # Weighted number of onsets in each stack, the total less the phases of the station
+        weights = np.ones(len(phases)) if self.PhaseWeights is None else np.asarray(self.PhaseWeights, dtype=float)
+        wstn    = np.array([np.sum(weights * np.array([np.isin(st, stn) for stn in stations])) for st in range(nstn)])
+        nstack  = np.sum(weights * np.array([stn.size for stn in stations]))
+        coa     = np.exp(dsnr.astype(np.float64) / np.append(nstack - wstn, nstack) - 1.0)
+        xyz     = self.lookup_table.index2xyz(dind)
+        shift   = np.linalg.norm(xyz[:-1] - xyz[-1], axis=1)
+        coa[:-1][wstn == 0]   = np.nan
+        shift[wstn == 0]      = np.nan
+
+        names = np.asarray(self.lookup_table.station_data['Name']).astype(str)[:nstn]
+        JK = pd.DataFrame([[coa[-1]] + list(coa[:-1]) + list(shift)],
+                          columns=['Jackknife_COA'] + ['Jackknife_COA_{}'.format(n) for n in names] + ['Jackknife_Shift_{}'.format(n) for n in names])
+        return JK
+
+
+    def _phase_onset(self, onset, dtype):
+        '''
+            Onset of a phase in the kernel precision, with gaps (NaN) set to 0.
+
+        '''
+        onset = onset.astype(dtype)
+        onset[np.isnan(onset)] = 0
+        return onset
+
+
+    def _phase_stations(self, avaInd, select):
+        '''
+            Onset rows of the available stations used for a phase, restricted to the
+            station names in select (StationSelectP/StationSelectS) if not None.
+
+        '''
+        if select is not None:
+            names  = np.asarray(self.lookup_table.station_data['Name']).astype(str)
+            avaInd = avaInd[np.isin(names[avaInd], np.asarray(select).astype(str))]
+        return np.asarray(avaInd).astype(np.int32)
+
+
+    def _coalesce(self, phases, pre_smp, pos_smp, nsamp, ncell, return_map, stations=None):
+        '''
+            Stacking of the onset functions and detection of the maximum coalescence
+            per sample. phases is a list of (onset, travel-time index table) pairs and
+            stations the active onset rows of each phase, the phases are weighted by
+            PhaseWeights. The precision of the map and kernels follows the onsets.
+            dsnr and dind are (DetectionPeaks, nsamp), the first row is the maximum.
+            The returned map is indexed [x, y, z, t], for MapLayout 'time' it is a
+            view of the time-major array. With ScanMask or ScanPoints only those cells
+            are stacked, the other cells of the map are 0, and dind holds flat indices
+            of the full LUT grid. With DeduplicateCells the cells sharing a travel-time
+            index vector are stacked once and copied into the map, the fused kernel
+            stacks them once for a single unnormalised peak, with identical results.
+
+        '''
+        dtype = phases[0][0].dtype
+        npeak = max(1, self.DetectionPeaks)
+        peak  = dict(peaks=npeak, separation=self.PeakSeparation)
+        dind  = np.zeros((npeak, nsamp), np.int64)
+        dsnr  = np.zeros((npeak, nsamp), dtype)
+        kernel = self._kernel_settings(phases, pre_smp, pos_smp, nsamp, stations)
+
+        # With NormaliseCoalescence the kernels sum the coalescence over the cells per
+        # sample while detecting, and return the maximum of the normalised map
+        norm = np.zeros(nsamp, dtype) if self.NormaliseCoalescence == True else None
+        cells  = self._scan_cells(ncell)
+        unique = self._unique_cells(ncell, cells) if self.DeduplicateCells == True else None
+
+        if return_map:
+            layout = self._select_layout(kernel, return_map)
+            if layout == 'time':
+                _map = np.zeros((nsamp,) + ncell, dtype=dtype)
+                ilib.scan(phases, None, pre_smp, pos_smp, nsamp, _map, stations=stations, layout='time', weights=self.PhaseWeights,
+                          cells=cells if unique is None else unique[0], **kernel['scan_time'])
+                self._scatter_duplicates(_map.reshape(nsamp, -1).T, unique)
+                ilib.detect(_map, dsnr, dind, 0,nsamp, kernel['detect_time']['threads'], layout='time', norm=norm, **peak)
+                if norm is not None:
+                    np.divide(_map, norm[:,np.newaxis,np.newaxis,np.newaxis], out=_map, where=(norm != 0)[:,np.newaxis,np.newaxis,np.newaxis])
+                _map = np.moveaxis(_map, 0, -1)
+            else:
+                _map = np.zeros(ncell + (nsamp,), dtype=dtype)
+                ilib.scan(phases, None, pre_smp, pos_smp, nsamp, _map, stations=stations, weights=self.PhaseWeights,
+                          cells=cells if unique is None else unique[0], **kernel['scan'])
+                self._scatter_duplicates(_map.reshape(-1, nsamp), unique)
+                ilib.detect(_map, dsnr, dind, 0,nsamp, kernel['detect']['threads'], norm=norm, **peak)
+                if norm is not None:
+                    np.divide(_map, norm, out=_map, where=(norm != 0))
+        elif self.HierarchicalDecimate is not None and norm is None:
+            _map = None
+            self._coalesce_hierarchical(phases, pre_smp, pos_smp, nsamp, ncell, dsnr, dind, stations, cells)
+        else:
+            _map = None
+            # The first cell of a group wins the ties of the detection, so its duplicates
+            # can only be skipped for the maximum and without the sums of the normalisation
+            if unique is not None and npeak == 1 and norm is None:
+                cells = unique[0]
+            ilib.scan_detect(phases, None, pre_smp, pos_smp, nsamp, dsnr, dind, cells=cells, stations=stations, norm=norm, weights=self.PhaseWeights,
+                             **peak, **kernel['scan_detect'])
+
+        return dsnr, dind, _map
+
+
+    def _scan_cells(self, ncell):
+        '''
+            Flat LUT indices of the region of interest, the cells of ScanMask and the
+            cells nearest to ScanPoints, or None to scan the whole grid.
+
+        '''
+        if self.ScanMask is None and self.ScanPoints is None:
+            return None
+        cells = []
+        if self.ScanMask is not None:
+            mask = np.asarray(self.ScanMask, dtype=bool)
+            if mask.shape != tuple(ncell):
+                raise ValueError('Mismatch between ScanMask shape {} and LUT cell count {}.'.format(mask.shape, tuple(ncell)))
+            cells.append(np.flatnonzero(mask.ravel(order=self.lookup_table.sort_order)))
+        if self.ScanPoints is not None:
+            cells.append(self.lookup_table.xyz2cell(np.asarray(self.ScanPoints, dtype=float).reshape(-1, 3)))
+        cells = np.unique(np.concatenate(cells)).astype(np.int64)
+        if cells.size == 0:
+            raise ValueError('ScanMask and ScanPoints select no cells of the LUT.')
+        return cells
+
+
+    def _unique_cells(self, ncell, cells=None):
+        '''
+            Cells with distinct P and S travel-time index vectors at the rate of the
+            current tables, among the cells to scan (all if None). Returns the first
+            cell of each vector in ascending order, and the other cells with the cell
+            whose stack they share. The compression is reported once per LUT and rate.
+
+        '''
+        key = (id(self.lookup_table), self._table_rate, None if cells is None else hash(cells.tobytes()))
+        if key in self._unique:
+            return self._unique[key]
+
+        label, first = self.lookup_table.fetch_unique_cells(['TIME_P', 'TIME_S'], self._table_rate)
+        if cells is None:
+            cells = np.arange(label.size, dtype=np.int64)
+        group, pos, inv = np.unique(label[cells], return_index=True, return_inverse=True)
+        source = cells[pos[inv.ravel()]]
+        dup    = source != cells
+        unique = (np.sort(cells[pos]), cells[dup], source[dup])
+
+        print('   Cell deduplication - {} distinct travel-time vectors of {} cells at {} Hz (compression {:.2f}x)'.format(
+            unique[0].size, cells.size, self._table_rate, cells.size / max(1, unique[0].size)))
+        self._unique[key] = unique
+        return unique
+
+
+    def _scatter_duplicates(self, mflat, unique):
+        '''
+            Copying the stacks of the first cells to their duplicates, mflat is a
+            (cells, samples) view of the map.
+
+        '''
+        if unique is None:
+            return
+        cells, dups, source = unique
+        for c0 in range(0, dups.size, 4096):
+            mflat[dups[c0:c0 + 4096]] = mflat[source[c0:c0 + 4096]]
+
+
+    def _kernel_settings(self, phases, pre_smp, pos_smp, nsamp, stations):
+        '''
+            Threads and tile sizes of each kernel stage. With NumberOfCores 'auto' they
+            are calibrated on the LUT and window shape and cached per host and grid shape
+            (see SeisLoc.core.tuning), otherwise NumberOfCores is used for every stage.
+            An explicit ScanKernel overrides the tuned scan kernel.
+
+        '''
+        if self.NumberOfCores == 'auto':
+            kernel = tuning.kernel_settings(phases, None, pre_smp, pos_smp, nsamp, stations)
+        else:
+            kernel = {stage: {'threads': int(self.NumberOfCores)} for stage in tuning.STAGES}
+            kernel['layout'] = {'detect': 'cell', 'locate': 'cell'}
+        kernel = {stage: dict(opt) for stage, opt in kernel.items()}
+        if self.ScanKernel is not None:
+            kernel['scan'] = {'threads': kernel['scan']['threads'], 'kernel': self.ScanKernel}
+        self._kernel = kernel
+        return kernel
+
+
+    def _select_layout(self, kernel, return_map):
+        '''
+            Layout of the 4D map, MapLayout or with 'auto' the faster tuned layout for
+            detection only, or for detection and the marginals of the location when
+            the map is returned.
+
+        '''
+        if self.MapLayout == 'auto':
+            layout = kernel['layout']['locate' if return_map else 'detect']
+        elif self.MapLayout in ('cell', 'time'):
+            layout = self.MapLayout
+        else:
+            raise ValueError('Unknown MapLayout {}, use auto, cell or time.'.format(self.MapLayout))
+        self._layout = layout
+        return layout
+
+
+    def _threads(self, stage):
+        '''
+            Thread count of a kernel stage from the last _kernel_settings. The map
+            stages follow the layout of the last map.
+
+        '''
+        if self._kernel is not None:
+            if self._layout == 'time' and stage in ('scan', 'detect', 'marginal'):
+                stage = stage + '_time'
+            return self._kernel[stage]['threads']
+        if self.NumberOfCores == 'auto':
+            return os.cpu_count() or 1
+        return int(self.NumberOfCores)
+
+
+    def _hierarchical_cells(self, ds, ncell, parents=None, pds=None):
+        '''
+            Flat indices of the cells of the LUT grid decimated by ds, using the same
+            cell selection as LUT.decimate. With parents, the cell indices kept from the
+            previous level decimated by pds, only the cells within one coarse cell
+            spacing of a parent are returned.
+
+        '''
+        cc   = np.array(ncell)
+        ds   = np.array(ds, dtype=int)
+        n    = 1 + (cc - 1) // ds
+        c1   = (cc - ds * (n - 1) - 1) // 2
+        axes = [c1[i] + ds[i]*np.arange(n[i]) for i in range(3)]
+
+        if parents is None:
+            grids = [axes]
+        else:
+            ploc  = np.vstack(np.unravel_index(parents, ncell)).transpose()
+            grids = [[ax[np.abs(ax - loc[i]) <= pds[i]] for i, ax in enumerate(axes)] for loc in ploc]
+
+        cells = [np.ravel_multi_index(np.meshgrid(*g, indexing='ij'), ncell).ravel() for g in grids]
+        return np.unique(np.concatenate(cells)).astype(np.int64)
+
+
+    def _coalesce_hierarchical(self, phases, pre_smp, pos_smp, nsamp, ncell, dsnr, dind, stations=None, roi=None):
+        '''
+            Coarse-to-fine search. The grid decimated by the first entry of
+            HierarchicalDecimate is scanned in full, then only the neighbourhoods of the
+            HierarchicalCells best scoring cells of every sample are scanned on each finer
+            level, ending on the full LUT grid. A sample keeps the peaks of the level with
+            its largest coalescence, so refining never lowers dsnr. With DetectionPeaks
+            the cells of every peak are refined. With a region of interest roi (flat cell
+            indices) each level is restricted to it, a level without cells in the roi
+            scans all of its cells.
+
+        '''
+        levels = [np.array(ds, dtype=int) for ds in self.HierarchicalDecimate] + [np.array([1, 1, 1])]
+        npeak  = dsnr.shape[0]
+        ncand  = max(npeak, int(self.HierarchicalCells))
+        cells  = None
+        pds    = None
+        best   = None
+        for lv, ds in enumerate(levels):
+            cells = self._hierarchical_cells(ds, ncell, cells, pds)
+            if roi is not None:
+                cells = np.intersect1d(cells, roi, assume_unique=True)
+                cells = roi if cells.size == 0 else cells
+
+            # The coarse levels keep the ncand best cells of every sample as candidates
+            last = lv == len(levels) - 1
+            lsnr = dsnr if last else np.zeros((ncand, nsamp), dsnr.dtype)
+            lind = dind if last else np.zeros((ncand, nsamp), np.int64)
+            ilib.scan_detect(phases, None, pre_smp, pos_smp, nsamp, lsnr, lind, cells=cells, stations=stations, **self._kernel['scan_detect'],
+                             peaks=lsnr.shape[0], separation=self.PeakSeparation, weights=self.PhaseWeights)
+
+            # A finer grid does not hold the coarse cells, the peaks of a sample are
+            # replaced only when its maximum coalescence increases
+            if best is None:
+                best = (lsnr[:npeak].copy(), lind[:npeak].copy())
+            else:
+                up = lsnr[0] > best[0][0]
+                best[0][:, up] = lsnr[:npeak, up]
+                best[1][:, up] = lind[:npeak, up]
+            if last:
+                dsnr[:] = best[0]
+                dind[:] = best[1]
+                break
+
+            # Refining the candidate cells of every sample
+            cells = np.unique(lind[lind >= 0])
+            pds   = ds
+
+
+    def _validate_precision(self, phases, pre_smp, pos_smp, nsamp, ncell, return_map, stations, dsnr, dind):
+        '''
+            Repeating the coalescence for the float64 phases and reporting the deviation
+            of the reduced precision maximum coalescence (dsnr) and location index (dind).
+
+        '''
+        dsnr64, dind64, _ = self._coalesce(phases, pre_smp, pos_smp, nsamp, ncell, return_map, stations)
+        dev  = np.max(np.abs(dsnr.astype(np.float64) - dsnr64)) if nsamp > 0 else 0.0
+        rel  = dev / max(np.max(np.abs(dsnr64)), np.finfo(np.float64).tiny) if nsamp > 0 else 0.0
+        nind = int(np.sum(dind != dind64))
+        self.PrecisionDeviation = {'dsnr': dev, 'dsnr_relative': rel, 'dind': nind}
+        print('   Precision {} - Max deviation dsnr = {:.3e} (relative {:.3e}), dind differs for {} of {} samples'.format(
+            self.Precision, dev, rel, nind, dind.size))
+
+
+    def _set_backend(self):
+        '''
+            Selecting the compute backend from Backend, or $SEISLOC_BACKEND if None.
+            Returns the name of the active backend.
+
+        '''
+        return ilib.set_backend(self.Backend)
+
+
     def _continious_compute(self,starttime,endtime):
         ''' 
             Continious seismic compute from 
@@ -1321,8 +1965,10 @@ class SeisScan:
         self.StartDateTime = datetime.strptime(starttime,'%Y-%m-%dT%H:%M:%S.%f')
         self.EndDateTime   = datetime.strptime(endtime,'%Y-%m-%dT%H:%M:%S.%f')
 
-        # Deleting the scan if it exists alreadys
-        self.output.del_scan()
+        # The scan LUT and the further velocity models, all stacking the same onsets
+        models = self._models if self._models is not None else [(self.lookup_table, self.output)]
+
+        backend = self._set_backend()
 
         
         # ------- Continious Seismic Detection ------
@@ -1330,6 +1976,17 @@ class SeisScan:
         print('   SeisLoc - Coalescence Scanning : PATH:{} - NAME:{}'.format(self.output.path, self.output.name))
         print('======================================================================')
         print('   Continious Seismic Processing for {} to {}'.format(datetime.strftime(self.StartDateTime,'%Y-%m-%dT%H:%M:%S.%f'),datetime.strftime(self.EndDateTime,'%Y-%m-%dT%H:%M:%S.%f')))
+        print('   Compute backend - {}'.format(backend))
+        if self.ReadAhead > 0:
+            print('   Read ahead - {} s of data read beyond each window and kept for the next windows'.format(self.ReadAhead))
+        if len(models) > 1:
+            print('   Velocity models - {} ({} scans per window)'.format(', '.join(output.name for lut, output in models), len(models)))
+        if self.DetectionDownsample is not None and int(self.DetectionDownsample) > 1:
+            print('   Detection downsample - {} ({} Hz)'.format(int(self.DetectionDownsample), self.sample_rate / int(self.DetectionDownsample)))
+        roi = self._scan_cells(tuple(self.lookup_table.cell_count))
+        if roi is not None:
+            ncell = np.prod(self.lookup_table.cell_count)
+            print('   Region of interest - {} of {} cells ({:.1f} %)'.format(roi.size, ncell, 100.0 * roi.size / ncell))
         print('==============================================================================================================================')
 
         # adding pre- and post-pad to remove affect from taper
@@ -1337,34 +1994,485 @@ class SeisScan:
         self.pre_pad  = self.pre_pad + round(timeLen*0.06)
         self.post_pad = self.post_pad + round(timeLen*0.06)
 
-        i = 0 
-        while self.EndDateTime >= (self.StartDateTime + timedelta(seconds=self.time_step*(i+1))):
-            cstart =  self.StartDateTime + timedelta(seconds=self.time_step*i) + timedelta(seconds=-self.pre_pad)
-            cend   =  self.StartDateTime + timedelta(seconds=self.time_step*(i+1)) + timedelta(seconds=self.post_pad)
+        nbatch = self._batch_windows()
+        if nbatch > 1:
+            print('   Batches of up to {} windows per kernel call'.format(nbatch))
+
+        self._screened = [0, 0]
+
+        # Resuming after the last window of the checkpoint, otherwise deleting the scan if it exists alreadys
+        phash = self._detect_hash(models)
+        done  = self._resume(models, phash) if self.DetectResume == True else None
+        if done is None:
+            for lut, output in models:
+                output.del_scan()
+            if path.exists(self._checkpoint_file()):
+                os.remove(self._checkpoint_file())
+            windows = self._detect_windows(nbatch)
+        else:
+            # The windows are laid out again from the end of the checkpoint, so a batch
+            # size other than that of the interrupted run leaves no gap in the .scn
+            first   = int(round((done - self.StartDateTime).total_seconds() / self.time_step))
+            windows = self._detect_windows(nbatch, first)
+            print('   Resuming after {} - {} windows left'.format(datetime.strftime(done,'%Y-%m-%dT%H:%M:%S.%f'), sum(win[2] for win in windows)))
+        checkpoint = (lambda end: self._write_checkpoint(models, phash, end)) if self.DetectCheckpoint == True else None
+
+        depth          = self._prefetch_depth(windows)
+        if depth > 0:
+            print('   Prefetch of up to {} windows by a background thread'.format(depth))
+
+        wall = time.perf_counter()
+        if int(self.DetectProcesses) > 1 and len(windows) > 1:
+            stats = self._parallel_windows(windows, models, depth, checkpoint)
+        else:
+            stats = self._scan_windows(windows, models, depth, checkpoint)
+        wall = time.perf_counter() - wall
+        self._screened = stats['screened']
+
+        timings = stats['timings']
+        if stats['windows'] > 0:
+            scanned = stats['windows'] * self.time_step
+            print('   Processed {:.1f} s of data for {:.1f} s of scan ({:.2f}x)'.format(stats['processed'], scanned, stats['processed'] / scanned))
+            busy = timings['read'] + timings['onsets'] + timings['stack'] + timings['write']
+            print('   Stage timings - read {:.2f} s, onsets {:.2f} s, stack {:.2f} s, write {:.2f} s, waiting for data {:.2f} s, wall {:.2f} s (overlap {:.2f} s)'.format(
+                timings['read'], timings['onsets'], timings['stack'], timings['write'], timings['wait'], wall, max(0.0, busy - wall)))
+
+        if self._screened[1] > 0:
+            print('   Screening - {} of {} windows skipped ({:.1f} %)'.format(self._screened[0], self._screened[1], 100.0 * self._screened[0] / self._screened[1]))
 
+
+    def _scan_windows(self, windows, models, depth, checkpoint=None):
+        '''
+            Scanning the windows of _detect_windows in order over the LUT of each model,
+            appending to the .scn of its output. checkpoint is called with the end of
+            the scan after each window. Returns the seconds of data processed, the
+            number of time_step windows, the stage timings and the screening counts.
+
+        '''
+        timings   = dict(read=0.0, onsets=0.0, stack=0.0, write=0.0, wait=0.0)
+        processed = 0.0
+        i = 0
+        for cstart, cend, self._nbatch, prepared in self._prepared_windows(windows, depth, timings):
             print('~~~~~~~~~~~~~ Processing - {} to {} ~~~~~~~~~~~~~'.format(datetime.strftime(cstart,'%Y-%m-%dT%H:%M:%S.%f'),datetime.strftime(cend,'%Y-%m-%dT%H:%M:%S.%f'))) 
 
-            self.DATA.read_mseed(datetime.strftime(cstart,'%Y-%m-%dT%H:%M:%S.%f'),datetime.strftime(cend,'%Y-%m-%dT%H:%M:%S.%f'),self.sample_rate)
-            #daten, dsnr, dloc = self._compute_s1(0.0, DATA.signal)
-            daten, dsnr, dloc, _map = self._compute(cstart,cend, self.DATA.signal,self.DATA.station_avaliability)
+            avail      = self._window_onsets(prepared)
+            processed += (cend - cstart).total_seconds()
 
-            dcoord = self.lookup_table.xyz2coord(dloc)
-            self.output.FileSampleRate = self.Output_SampleRate
+            #daten, dsnr, dloc = self._compute_s1(0.0, DATA.signal)
+            # The onsets are computed once per window and stacked over the LUT of each model
+            for m, (lut, output) in enumerate(models):
+                self.lookup_table, self.output = lut, output
+                tic = time.perf_counter()
+                daten, dsnr, dloc, _map = self._compute(cstart,cend, self.DATA.signal,avail,return_map=self.keep_map,
+                                                        downsample=self.DetectionDownsample,reuse_onsets=True)
+                timings['stack'] += time.perf_counter() - tic
+
+                tic    = time.perf_counter()
+                dcoord = self.lookup_table.xyz2coord(dloc)
+                self.output.FileSampleRate = self.Output_SampleRate
+
+                peaks = None
+                if self._dpeaks is not None:
+                    peaks = [(pcoa[:-1], self._peak_coord(pind)[:-1,:]) for pcoa, pind in zip(self._dpeaks[0][1:], self._dpeaks[1][1:])]
+
+                self.output.write_scan(daten[:-1],dsnr[:-1],dcoord[:-1,:],peaks)
+                timings['write'] += time.perf_counter() - tic
+
+                del daten, dsnr, dloc, _map
+            self.lookup_table, self.output = models[0]
+            i += self._nbatch
+            if checkpoint is not None:
+                checkpoint(cstart + timedelta(seconds=self.pre_pad + self.time_step*self._nbatch))
+        self._nbatch = 1
+        return dict(processed=processed, windows=i, timings=timings, screened=list(self._screened))
+
+
+    def _parallel_windows(self, windows, models, depth, checkpoint=None):
+        '''
+            Scanning the windows on DetectProcesses processes. The windows are split into
+            shards of consecutive windows (DetectShards per process), each scanned by a
+            worker with its own copy of the scan and DATA reader (pickled, so the scan
+            must be picklable) into part files of the outputs. The parts are appended to
+            the .scn files in time order as soon as all earlier shards are done, whatever
+            the order the workers finish in. With ShareLUT the workers attach to the
+            tables of the LUTs in shared memory (see LUT.share) instead of copies.
+            checkpoint is called after each merged shard. Returns the summed statistics
+            of _scan_windows.
 
-            self.output.write_scan(daten[:-1],dsnr[:-1],dcoord[:-1,:])
-            
-            del daten, dsnr, dloc, _map
-            i += 1
+        '''
+        nproc  = min(int(self.DetectProcesses), len(windows))
+        nshard = min(len(windows), nproc * max(1, int(self.DetectShards)))
+        shards = [[windows[w] for w in ws] for ws in np.array_split(np.arange(len(windows)), nshard)]
+        print('   Parallel scan - {} shards of {} windows on {} processes'.format(nshard, len(windows), nproc))
+
+        stats = dict(processed=0.0, windows=0, timings=dict(read=0.0, onsets=0.0, stack=0.0, write=0.0, wait=0.0), screened=[0, 0])
+        done  = dict()
+        merged = 0
+        worker = copy.copy(self)
+        shared = self._share_models(models) if self.ShareLUT == True else models
+        worker.lookup_table, worker._models, worker._unique = shared[0][0], shared, dict()
+        worker._stack = worker._dpeaks = worker._map = None
+        try:
+            # Spawned rather than forked workers, OpenMP is not fork safe once the kernels ran
+            with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_detect_worker, initargs=(worker, shared, depth, nproc)) as pool:
+                futures = [pool.submit(_detect_shard, k, shard) for k, shard in enumerate(shards)]
+                for future in as_completed(futures):
+                    k, sstat = future.result()
+                    done[k] = sstat
+                    # Merging the completed shards that continue the .scn files
+                    while merged in done:
+                        sstat = done.pop(merged)
+                        for lut, output in models:
+                            _merge_part(output, merged)
+                        stats['processed'] += sstat['processed']
+                        stats['windows']   += sstat['windows']
+                        stats['screened']   = [a + b for a, b in zip(stats['screened'], sstat['screened'])]
+                        for stage in stats['timings']:
+                            stats['timings'][stage] += sstat['timings'][stage]
+                        if checkpoint is not None:
+                            cstart, cend, nb = shards[merged][-1]
+                            checkpoint(cstart + timedelta(seconds=self.pre_pad + self.time_step*nb))
+                        merged += 1
+        finally:
+            if shared is not models:
+                for lut, output in shared:
+                    lut.unshare()
+            for k in range(merged, nshard):
+                for lut, output in models:
+                    fname = path.join(output.path, _part_name(output.name, k) + '.scn')
+                    if path.exists(fname):
+                        os.remove(fname)
+        return stats
 
         
-    def _Trigger_scn(self,CoaVal,starttime,endtime):
+    def _checkpoint_file(self):
+        return path.join(self.output.path, self.output.name + '.scn.ckpt')
+
+
+    def _detect_hash(self, models):
+        '''
+            Hash of the parameters that define the .scn of a Detect run, its start and
+            window steps, pads, sample rates, onsets, stacking and detection, and the
+            grid and stations of each model. The end time is left out, so a resumed run
+            may also be extended.
+
+        '''
+        cells = self._scan_cells(tuple(self.lookup_table.cell_count))
+        param = dict(start=datetime.strftime(self.StartDateTime,'%Y-%m-%dT%H:%M:%S.%f'), time_step=self.time_step,
+                     pads=[self.pre_pad, self.post_pad], sample_rate=self.sample_rate, output_rate=self.Output_SampleRate,
+                     downsample=self.DetectionDownsample, filters=[self.bp_filter_p1, self.bp_filter_s1],
+                     onsets=[self.onset_win_p1, self.onset_win_s1], stations=[self.station_p1, self.station_s1],
+                     weights=self.PhaseWeights, peaks=[self.DetectionPeaks, self.PeakSeparation],
+                     normalise=self.NormaliseCoalescence, precision=self.Precision,
+                     screen=[self.ScreenDecimate, self.ScreenMargin], hierarchical=[self.HierarchicalDecimate, self.HierarchicalCells],
+                     cells=None if cells is None else hashlib.sha256(cells.tobytes()).hexdigest(),
+                     models=[[output.name, lut.cell_count, lut.cell_size, lut.grid_center, list(np.asarray(lut.station_data['Name']).astype(str)),
+                              {name: map.shape for name, map in lut.maps.items()}] for lut, output in models])
+        text  = json.dumps(param, sort_keys=True, default=lambda val: np.asarray(val).tolist())
+        return hashlib.sha256(text.encode()).hexdigest()
+
+
+    def _write_checkpoint(self, models, phash, end):
+        '''
+            Recording in the checkpoint that the .scn of every model is complete up to
+            end, with their sizes. Written to a temporary file and renamed, so the
+            checkpoint is always complete.
+
+        '''
+        scn   = dict()
+        for lut, output in models:
+            fname = path.join(output.path, output.name + '.scn')
+            scn[output.name] = path.getsize(fname) if path.exists(fname) else 0
+        fname = self._checkpoint_file()
+        with open(fname + '.tmp', 'w') as fp:
+            json.dump(dict(parameters=phash, end=datetime.strftime(end,'%Y-%m-%dT%H:%M:%S.%f'), scn=scn), fp, indent=2, sort_keys=True)
+        os.replace(fname + '.tmp', fname)
+
+
+    def _resume(self, models, phash):
+        '''
+            End of the scan recorded in the checkpoint, after truncating the .scn of each
+            model to its recorded size, which removes a partly written window. None if
+            there is no checkpoint, the scan then starts again.
 
+        '''
+        fname = self._checkpoint_file()
+        if not path.exists(fname):
+            print('   No checkpoint {} - starting a new scan'.format(fname))
+            return None
+        with open(fname, 'r') as fp:
+            state = json.load(fp)
+        if state['parameters'] != phash:
+            raise ValueError('Mismatch between the Detect parameters and the checkpoint {}, remove it to start a new scan.'.format(fname))
+
+        for lut, output in models:
+            scn  = path.join(output.path, output.name + '.scn')
+            size = state['scn'].get(output.name, 0)
+            if size > (path.getsize(scn) if path.exists(scn) else 0):
+                raise ValueError('Scan file {} is shorter than its checkpoint {}.'.format(scn, fname))
+            if path.exists(scn):
+                os.truncate(scn, size)
+        return datetime.strptime(state['end'],'%Y-%m-%dT%H:%M:%S.%f')
+
+
+    def _share_models(self, models):
+        '''
+            The models with their LUTs published in shared memory, with the index tables
+            (and with DeduplicateCells the groups of cells) of the Detect rate.
+
+        '''
+        rate   = self.sample_rate / max(1, int(self.DetectionDownsample or 1))
+        shared = []
+        for lut, output in models:
+            for phase in ('TIME_P', 'TIME_S'):
+                lut.fetch_index_table([phase], rate)
+            if self.DeduplicateCells == True:
+                lut.fetch_unique_cells(['TIME_P', 'TIME_S'], rate)
+            shared.append((lut.share(), output))
+        nbyte = sum(map.nbytes for lut, output in shared for map in lut.maps.values())
+        print('   Shared LUT - {:.1f} MB of travel-time maps and their index tables in {}'.format(nbyte / 2**20, ', '.join(lut._shared[0] for lut, output in shared)))
+        return shared
+
+
+    def _detect_windows(self, nbatch, first=0):
+        '''
+            Windows of the continuous scan, (cstart, cend, nbatch) with the padded
+            window and the number of time_step windows batched. The scan starts after
+            the first time_step windows from StartDateTime.
+
+        '''
+        windows = []
+        i = first
+        while self.EndDateTime >= (self.StartDateTime + timedelta(seconds=self.time_step*(i+1))):
+            # Consecutive windows are read and stacked as one, the pads are shared
+            nb = 1
+            while nb < nbatch and self.EndDateTime >= (self.StartDateTime + timedelta(seconds=self.time_step*(i+nb+1))):
+                nb += 1
+
+            cstart =  self.StartDateTime + timedelta(seconds=self.time_step*i) + timedelta(seconds=-self.pre_pad)
+            cend   =  self.StartDateTime + timedelta(seconds=self.time_step*(i+nb)) + timedelta(seconds=self.post_pad)
+            windows.append((cstart, cend, nb))
+            i += nb
+        return windows
+
+
+    def _prefetch_depth(self, windows):
+        '''
+            Number of windows prepared ahead, PrefetchWindows limited to the windows whose
+            data, filtered data and onsets fit in PrefetchMemory times the available memory.
+
+        '''
+        depth  = max(0, int(self.PrefetchWindows))
+        memory = _available_memory()
+        if depth == 0 or memory is None or len(windows) == 0:
+            return depth
+
+        # Bytes per sample as in _batch_windows, for the longest window read
+        nstn   = self.lookup_table.fetch_map('TIME_P').shape[-1]
+        span   = max((cend - cstart).total_seconds() for cstart, cend, nb in windows)
+        window = nstn * 11 * 8 * span * self.sample_rate
+        return int(max(1, min(depth, (memory * self.PrefetchMemory) // window)))
+
+
+    def _prepare_window(self, cstart, cend):
+        '''
+            Reading the data from cstart to cend into a copy of DATA and computing its
+            onsets (SNR_P, SNR_S and the raw onsets), on a copy of the scan so it can run
+            in the background. Returns the data, the filtered data and onsets of the copy
+            and the read and onset times.
+
+        '''
+        data = copy.copy(self.DATA)
+        scan = copy.copy(self)
+        scan.DATA       = data
+        scan.filt_data  = dict()
+        scan.onset_data = dict()
+
+        tic = time.perf_counter()
+        data.read_mseed(datetime.strftime(cstart,'%Y-%m-%dT%H:%M:%S.%f'),datetime.strftime(cend,'%Y-%m-%dT%H:%M:%S.%f'),self.sample_rate,read_ahead=self.ReadAhead)
+        toc = time.perf_counter()
+        sige, sign, sigz = data.signal
+        data.SNR_P_raw, data.SNR_P = scan._compute_onset_p1(sigz, self.sample_rate)
+        data.SNR_S_raw, data.SNR_S = scan._compute_onset_s1(sige, sign, self.sample_rate)
+        return data, scan.filt_data, scan.onset_data, toc - tic, time.perf_counter() - toc
+
+
+    def _prepared_windows(self, windows, depth, timings):
+        '''
+            The windows with their prepared data (see _prepare_window), in order. With
+            depth > 0 a background thread prepares up to depth windows ahead while the
+            current one is stacked, otherwise each window is prepared when it is reached.
+            The read and onset times are added to timings, and the time spent waiting
+            for the background thread to timings['wait'].
+
+        '''
+        def count(prepared):
+            timings['read']   += prepared[3]
+            timings['onsets'] += prepared[4]
+            return prepared
+
+        if depth == 0:
+            for cstart, cend, nb in windows:
+                yield cstart, cend, nb, count(self._prepare_window(cstart, cend))
+            return
+
+        fifo = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    fifo.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer():
+            try:
+                for cstart, cend, nb in windows:
+                    if not put(self._prepare_window(cstart, cend)):
+                        return
+            except Exception as err:
+                put(err)
+
+        thread = threading.Thread(target=producer, name='SeisLoc-prefetch', daemon=True)
+        thread.start()
+        try:
+            for cstart, cend, nb in windows:
+                tic = time.perf_counter()
+                prepared = fifo.get()
+                timings['wait'] += time.perf_counter() - tic
+                if isinstance(prepared, Exception):
+                    raise prepared
+                yield cstart, cend, nb, count(prepared)
+        finally:
+            stop.set()
+            thread.join()
+
+
+    def _window_onsets(self, prepared):
+        '''
+            The prepared data of a window (see _prepare_window) becomes that of DATA,
+            and the stations available over the window are returned.
+
+        '''
+        data, filt_data, onset_data = prepared[:3]
+        self.DATA.__dict__.update(data.__dict__)
+        self.filt_data  = filt_data
+        self.onset_data = onset_data
+        return np.asarray(data.station_avaliability)
+
+
+    def _scan_models(self):
+        '''
+            The scan LUT with its output, followed by the LUTs of Models decimated by
+            Decimate, each with an output of its name in the path of the scan output.
+            The LUTs must hold the stations of the scan LUT in the same order, as
+            they stack the same onset rows.
+
+        '''
+        names  = np.asarray(self.lookup_table.station_data['Name']).astype(str)
+        models = [(self.lookup_table, self.output)]
+        for lut, name in self.Models:
+            if not isinstance(lut, cmod.LUT):
+                fname = lut
+                lut   = cmod.LUT()
+                lut.load(fname)
+            if not np.array_equal(np.asarray(lut.station_data['Name']).astype(str), names):
+                raise ValueError('Mismatch between the stations of model {} and the scan LUT.'.format(name))
+            models.append((lut.decimate(self.Decimate), SeisOutFile(self.output.path, name)))
+        return models
+
+
+    def _batch_windows(self):
+        '''
+            Number of Detect windows per batch, BatchWindows limited to the windows whose
+            onsets, coalescence and (with keep_map) 4D map fit in BatchMemory times the
+            available memory, next to the shared pads.
+
+            The data of a batch is detrended, tapered and filtered, and its onsets are
+            computed, over the span of the whole batch. The windows inside a batch do not
+            see the edge transients of their own pads, so the .scn is not identical to
+            the unbatched scan. On the icequake example BatchWindows = 4 changes the
+            coalescence by up to 1.9 % and the location of 21 of 12375 samples, none
+            above the detection threshold.
+
+        '''
+        nmax   = max(1, int(self.BatchWindows))
+        memory = _available_memory()
+        if nmax == 1 or memory is None:
+            return nmax
+
+        # Bytes per sample: the three components and about eight derived traces
+        # (filtered, onsets, kernel copies) of each station, the peaks, and the map
+        models = self._models if self._models is not None else [(self.lookup_table, None)]
+        nstn   = self.lookup_table.fetch_map('TIME_P').shape[-1]
+        ncell  = max(np.prod(lut.cell_count) for lut, output in models) if self.keep_map else 0
+        npeak  = max(1, self.DetectionPeaks)
+        bsmp   = nstn * 11 * 8 + npeak * 16 + ncell * np.dtype(self.Precision).itemsize
+        window = bsmp * self.time_step * self.sample_rate
+        pads   = bsmp * (self.pre_pad + self.post_pad) * self.sample_rate
+        return int(max(1, min(nmax, (memory * self.BatchMemory - pads) // window)))
+
+
+    def _peak_coord(self, dind):
+        '''
+            Coordinates of the cell indices of a peak, NaN where there is no peak.
+
+        '''
+        dcoord = self.lookup_table.xyz2coord(self.lookup_table.index2xyz(np.maximum(dind, 0)))
+        dcoord[dind < 0, :] = np.nan
+        return dcoord
+
+
+    def _Trigger_scn(self,CoaVal,starttime,endtime,peak=None):
+        '''
+            Triggered events of the .scn coalescence. For the extended .scn format
+            every peak is triggered on its own (peak = 1,2,...) and the events of the
+            further peaks are kept when they are not the same event as a larger peak,
+            i.e. overlapping in time and within PeakSeparation cells. Their EventID
+            has the suffix _k and the Peak column holds k.
+
+        '''
+        if peak is None:
+            npeak = 1 + (len(CoaVal.columns) - 5)//4
+            if npeak == 1:
+                return self._Trigger_scn(CoaVal,starttime,endtime,peak=1)
+
+            # Cell size of the .scn grid, Detect and Trigger decimate the lookup_table in place
+            sep = self.PeakSeparation * self._cell_size * np.array(self.Decimate)
+            EVENTS = _trigger_frame()
+            for k in range(1, npeak + 1):
+                CoaPeak = _scan_peak(CoaVal, k)
+                if np.sum(CoaPeak['COA'] > self.DetectionThreshold) < 2:
+                    continue
+                PEAKS = self._Trigger_scn(CoaPeak,starttime,endtime,peak=k)
+                if len(EVENTS) > 0:
+                    xyz  = np.vstack([self.lookup_table.coord2xyz(coord[np.newaxis, :]) for coord in np.array(EVENTS[['COA_X','COA_Y','COA_Z']], dtype=float)])
+                    keep = np.ones(len(PEAKS), dtype=bool)
+                    for ee in range(len(PEAKS)):
+                        pxyz    = self.lookup_table.coord2xyz(np.array(PEAKS[['COA_X','COA_Y','COA_Z']].iloc[[ee]], dtype=float))
+                        overlap = (EVENTS['MinTime'] <= PEAKS['MaxTime'].iloc[ee]) & (EVENTS['MaxTime'] >= PEAKS['MinTime'].iloc[ee])
+                        near    = np.all(np.abs(xyz - pxyz) < sep, axis=1)
+                        keep[ee] = not np.any(np.array(overlap) & near)
+                    PEAKS = pd.concat([EVENTS, PEAKS[keep]], ignore_index=True)
+                EVENTS = PEAKS
+            return EVENTS.sort_values('CoaTime').reset_index(drop=True)
+
+
+        # Sample interval of the .scn, coarser than sample_rate after a DetectionDownsample
+        step = CoaVal['DT'].diff().median() if len(CoaVal) > 1 else timedelta(seconds=1/self.sample_rate)
 
         # Defining when exceeded threshold
         CoaVal = CoaVal[CoaVal['COA'] > self.DetectionThreshold] 
         CoaVal = CoaVal[(CoaVal['DT'] >= datetime.strptime(starttime,'%Y-%m-%dT%H:%M:%S.%f')) & (CoaVal['DT'] <= datetime.strptime(endtime,'%Y-%m-%dT%H:%M:%S.%f'))]
         
         CoaVal = CoaVal.reset_index(drop=True)
+        if len(CoaVal) < 2:
+            return _trigger_frame()
+
         # ----------- Determining the initial triggered events, not inspecting overlaps ------
         c = 0
         e = 1
@@ -1373,7 +2481,7 @@ class SeisScan:
             # Determining the index when above the level and maximum value
             d=c
 
-            while CoaVal['DT'].iloc[d] + timedelta(seconds=1/self.sample_rate) == CoaVal['DT'].iloc[d+1]:
+            while CoaVal['DT'].iloc[d] + step == CoaVal['DT'].iloc[d+1]:
                 d+=1
                 if d+1 >= len(CoaVal)-2:
                     d=len(CoaVal)-2
@@ -1383,7 +2491,7 @@ class SeisScan:
 
             indmin = c
             indmax = d    
-            indVal = np.argmax(CoaVal['COA'].iloc[np.arange(c,d+1)])
+            indVal = c + np.argmax(CoaVal['COA'].iloc[np.arange(c,d+1)].values)
 
             # Determining the times for min,max and max coalescence value
             TimeMin = CoaVal['DT'].iloc[indmin]
@@ -1408,7 +2516,7 @@ class SeisScan:
                 IntEvents = pd.DataFrame([[e,TimeVal,COA_V,COA_X,COA_Y,COA_Z,TimeMin,TimeMax]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime'])
             else:
                 dat       = pd.DataFrame([[e,TimeVal,COA_V,COA_X,COA_Y,COA_Z,TimeMin,TimeMax]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime'])
-                IntEvents = IntEvents.append(dat,ignore_index=True)
+                IntEvents = pd.concat([IntEvents,dat],ignore_index=True)
                 
 
 
@@ -1435,20 +2543,19 @@ class SeisScan:
         for ee in range(1,np.max(IntEvents['EventNum'])+1):
             tmp = IntEvents[IntEvents['EventNum'] == ee].reset_index(drop=True)
             if d==0:
-                EVENTS = pd.DataFrame([[ee, tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])], np.max(tmp['COA_V']), tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])],tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=-self.MarginalWindow),tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=self.MarginalWindow)]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime'])
+                EVENTS = pd.DataFrame([[ee, tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])], np.max(tmp['COA_V']), tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_Y'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_Z'].iloc[np.argmax(tmp['COA_V'])],tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=-self.MarginalWindow),tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=self.MarginalWindow)]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime'])
                 d+=1
             else:
-                EVENTS = EVENTS.append(pd.DataFrame([[ee, tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])], np.max(tmp['COA_V']), tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])],tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=-self.MarginalWindow),tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=self.MarginalWindow)]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime']),ignore_index=True)
+                EVENTS = pd.concat([EVENTS,pd.DataFrame([[ee, tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])], np.max(tmp['COA_V']), tmp['COA_X'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_Y'].iloc[np.argmax(tmp['COA_V'])], tmp['COA_Z'].iloc[np.argmax(tmp['COA_V'])],tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=-self.MarginalWindow),tmp['CoaTime'].iloc[np.argmax(tmp['COA_V'])] + timedelta(seconds=self.MarginalWindow)]],columns=['EventNum','CoaTime','COA_V','COA_X','COA_Y','COA_Z','MinTime','MaxTime'])],ignore_index=True)
 
 
 
 
 
         # Defining an event id based on maximum coalescence
-        EVID = np.chararray(len(EVENTS),17)
-        for e in range(len(EVENTS)):
-            EVID[e] = str(re.sub(r"\D", "",EVENTS['CoaTime'].astype(str).iloc[e]))
-        EVENTS['EventID'] = EVID
+        suffix = '' if (peak is None or peak == 1) else '_{}'.format(peak)
+        EVENTS['EventID'] = [CoaTime.strftime('%Y%m%d%H%M%S%f')[:17] + suffix for CoaTime in EVENTS['CoaTime']]
+        EVENTS['Peak']    = 1 if peak is None else peak
 
 
 
@@ -1470,8 +2577,7 @@ class SeisScan:
         if path.exists(fname):
 
             # Loading the .scn file
-            DATA = pd.read_csv(fname,names=['DT','COA','X','Y','Z'])
-            DATA['DT'] = pd.to_datetime(DATA['DT'])
+            DATA = _read_scan(fname)
 
             if stations == None:
                 # Plotting the .scn file
@@ -1536,6 +2642,12 @@ class SeisScan:
         '''
         # Conduct the continious compute on the decimated grid
         self.lookup_table = self.lookup_table.decimate(self.Decimate)
+        self._models = self._scan_models()
+
+        # The post-pad covers the longest S travel time of every model
+        for lut, output in self._models[1:]:
+            ttmax = np.max(lut.fetch_map('TIME_S'))
+            self.post_pad = max(self.post_pad, int(np.ceil(ttmax + ttmax*0.05)))
         
         # Define pre-pad as a function of the onset windows
         if self.pre_pad is None:
@@ -1798,7 +2910,7 @@ class SeisScan:
         exceedence_value = np.percentile(SNR,self.PickThreshold*100)
         
 
-        if SNR[maxSNR] >= exceedence_value and (SNR_trim - exceedence_value).any() > 0:
+        if SNR[maxSNR] >= exceedence_value and np.any(SNR_trim > exceedence_value):
             # Fitting only around the exceedence vaue
             gauidxmin = np.where((SNR_trim - exceedence_value) > 0)[0][0] + idxmin
             gauidxmax = np.where((SNR_trim - exceedence_value) > 0)[0][-1] + idxmin
@@ -1902,7 +3014,7 @@ class SeisScan:
                 GAUP = np.hstack((GAUP,GauInfoP))
             
             tmpSTATION_pick = pd.DataFrame([[self.lookup_table.station_data['Name'][s],'P',stationEventPT,Mn,Err,maxSNR_P]],columns=['Name','Phase','ModelledTime','PickTime','PickError','PickSNR'])
-            STATION_pickS = STATION_pickS.append(tmpSTATION_pick)
+            STATION_pickS = pd.concat([STATION_pickS,tmpSTATION_pick])
 
 
             if self.PickingType == 'Gaussian':
@@ -1916,7 +3028,7 @@ class SeisScan:
                 GAUS = np.hstack((GAUS,GauInfoS))
 
             tmpSTATION_pick = pd.DataFrame([[self.lookup_table.station_data['Name'][s],'S',stationEventST,Mn,Err,maxSNR_S]],columns=['Name','Phase','ModelledTime','PickTime','PickError','PickSNR'])
-            STATION_pickS = STATION_pickS.append(tmpSTATION_pick)
+            STATION_pickS = pd.concat([STATION_pickS,tmpSTATION_pick])
 
         #print(STATION_pickS)
         # Saving the output from the triggered events
@@ -1956,7 +3068,7 @@ class SeisScan:
         w2 = (win-1)//2
         x1, y1, z1 = np.clip(ii - w2, 0 * nn, nn)
         x2, y2, z2 = np.clip(ii + w2 + 1, 0 * nn, nn)
-        mask = np.zeros(nn, dtype=np.bool)
+        mask = np.zeros(nn, dtype=bool)
         mask[x1:x2, y1:y2, z1:z2] = True
         return mask
 
@@ -2078,7 +3190,10 @@ class SeisScan:
         '''
 
         # Determining the coalescence 3D map
-        CoaMap = np.log(np.sum(np.exp(Map4D),axis=-1))
+        CoaMap = np.zeros(Map4D.shape[:-1], dtype=Map4D.dtype)
+        kmap, layout = _map_layout(Map4D)
+        ilib.marginal(kmap, CoaMap, 0, Map4D.shape[-1], self._threads('marginal'), layout=layout)
+        CoaMap = CoaMap.astype(np.float64)
 
         CoaMap = CoaMap/np.max(CoaMap)
         CoaMap_Cutoff = 0.88
@@ -2156,12 +3271,44 @@ class SeisScan:
 
 
 
+    def _track_peak(self, EVENT, Map4D):
+        '''
+            Coalescence of an event triggered on a further peak of the .scn. For each
+            sample the peak nearest to the triggered location is kept, and the cells
+            of Map4D nearer to the maximum coalescence location than to the triggered
+            location are set to the map minimum, so the location error describes the
+            triggered event only. Requires DetectionPeaks > 1 for the _compute call.
+
+        '''
+        if self._dpeaks is None:
+            raise ValueError('Triggered event on peak {} requires DetectionPeaks > 1.'.format(EVENT['Peak']))
+        lut  = self.lookup_table
+        dsnr, dind = self._dpeaks
+
+        target = lut.xyz2loc(lut.coord2xyz(np.array([[EVENT['COA_X'], EVENT['COA_Y'], EVENT['COA_Z']]], dtype=float)))[0]
+        loc    = np.array(np.unravel_index(np.maximum(dind, 0), lut.cell_count), dtype=float)
+        dist   = np.max(np.abs(loc - target[:, np.newaxis, np.newaxis]), axis=0)
+        dist[dind < 0] = np.inf
+        rank   = np.argmin(dist, axis=0)
+        smp    = np.arange(dind.shape[1])
+
+        if Map4D is not None:
+            main = loc[:, 0, np.argmax(dsnr[0])]
+            grid = np.array(np.meshgrid(*[np.arange(n) for n in lut.cell_count], indexing='ij'), dtype=float)
+            near = np.sum((grid - target[:, None, None, None])**2, axis=0) <= np.sum((grid - main[:, None, None, None])**2, axis=0)
+            Map4D[~near] = np.min(Map4D)
+
+        return dsnr[rank, smp], lut.index2xyz(dind[rank, smp])
+
+
     def Trigger(self,starttime,endtime):
         '''
         
 
         '''
 
+        print('Compute backend - {}'.format(self._set_backend()))
+
         # Intial Detection of the events from .scn file
         CoaVal = self.output.read_scan()
         EVENTS = self._Trigger_scn(CoaVal,starttime,endtime)
@@ -2177,7 +3324,7 @@ class SeisScan:
         Triggered = pd.DataFrame(columns=['DT','COA','X','Y','Z','ErrX','ErrY','ErrZ'])
         for e in range(len(EVENTS)):
 
-            print('--Processing for Event {} of {} - {}'.format(e+1,len(EVENTS),(EVENTS['EventID'].iloc[e]).astype(str)))
+            print('--Processing for Event {} of {} - {}'.format(e+1,len(EVENTS),EVENTS['EventID'].iloc[e]))
             tic()
 
             # WTF WTF WTF
@@ -2194,6 +3341,8 @@ class SeisScan:
             self.DATA.read_mseed(cstart.strftime('%Y-%m-%dT%H:%M:%S.%f'),cend.strftime('%Y-%m-%dT%H:%M:%S.%f'),self.sample_rate)
 
             daten, dsnr, dloc, self.MAP = self._compute(cstart,cend,self.DATA.signal,self.DATA.station_avaliability)
+            if EVENTS['Peak'].iloc[e] > 1:
+                dsnr, dloc = self._track_peak(EVENTS.iloc[e], self.MAP)
 
             dcoord = self.lookup_table.xyz2coord(np.array(dloc).astype(int))
             EventCoaVal = pd.DataFrame(np.array((daten,dsnr,dcoord[:,0],dcoord[:,1],dcoord[:,2])).transpose(),columns=['DT','COA','X','Y','Z'])
@@ -2202,7 +3351,7 @@ class SeisScan:
             self.EVENT_max = self.EVENT.iloc[EventCoaVal['COA'].astype('float').idxmax()]
 
             # Determining the hypocentral location from the maximum over the marginal window.
-            Picks,GAUP,GAUS = self._ArrivalTrigger(self.EVENT_max,(EVENTS['EventID'].iloc[e].astype(str)))
+            Picks,GAUP,GAUS = self._ArrivalTrigger(self.EVENT_max,EVENTS['EventID'].iloc[e])
 
             StationPick = {}
             StationPick['Pick'] = Picks
@@ -2217,39 +3366,41 @@ class SeisScan:
 
 
             EV = pd.DataFrame([[self.EVENT_max['DT'],self.EVENT_max['COA'],EVENTS['COA_V'].iloc[e],self.EVENT_max['X'],self.EVENT_max['Y'],self.EVENT_max['Z'],LOC[0],LOC[1],LOC[2],LOC_ERR[0],LOC_ERR[1],LOC_ERR[2],LOC_Cov[0],LOC_Cov[1],LOC_Cov[2],LOC_ERR_Cov[0],LOC_ERR_Cov[1],LOC_ERR_Cov[2]]],columns=['DT','DecCOA','COA','X','Y','Z','Gaussian_X','Gaussian_Y','Gaussian_Z','Gaussian_ErrX','Gaussian_ErrY','Gaussian_ErrZ','Covariance_X','Covariance_Y','Covariance_Z','Covariance_ErrX','Covariance_ErrY','Covariance_ErrZ'])
-            self.output.write_event(EV,str(EVENTS['EventID'].iloc[e].astype(str)))
+            if self.StationJackknife == True:
+                EV = pd.concat([EV, self._jackknife(int(EventCoaVal['COA'].astype('float').idxmax()))], axis=1)
+            self.output.write_event(EV,EVENTS['EventID'].iloc[e])
             if self.CutMSEED == True:
                 print('Creating cut Mini-SEED')
                 tic()
-                self.output.cut_mseed(self.DATA,str(EVENTS['EventID'].iloc[e].astype(str)))
+                self.output.cut_mseed(self.DATA,EVENTS['EventID'].iloc[e])
                 toc()
 
             # Outputting coalescence grids and triggered events
             if self.CoalescenceTrace == True:
                 tic()
                 print('Creating Station Traces')
-                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow)
-                SeisPLT.CoalescenceTrace(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e].astype(str)))
+                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow,NumberOfCores=self._threads('marginal'))
+                SeisPLT.CoalescenceTrace(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e]))
                 toc()
 
             if self.CoalescenceGrid == True:
                 tic()
                 print('Creating 4D Coalescence Grids')
-                self.output.write_coal4D(self.MAP,EVENTS['EventID'].iloc[e].astype(str),cstart,cend)
+                self.output.write_coal4D(self.MAP,EVENTS['EventID'].iloc[e],cstart,cend)
                 toc()
 
             if self.CoalescenceVideo == True:
                 tic()
                 print('Creating Seismic Videos')
-                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow)
-                SeisPLT.CoalescenceVideo(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e].astype(str)))
+                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow,NumberOfCores=self._threads('marginal'))
+                SeisPLT.CoalescenceVideo(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e]))
                 toc()
 
             if self.CoalescencePicture == True:
                 tic()
                 print('Creating Seismic Picture')
-                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow)
-                SeisPLT.CoalescenceMarginal(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e].astype(str)),Earthquake=EV)
+                SeisPLT = SeisPlot(self.lookup_table,self.MAP,self.CoaMAP,self.DATA,self.EVENT,StationPick,self.MarginalWindow,NumberOfCores=self._threads('marginal'))
+                SeisPLT.CoalescenceMarginal(SaveFilename='{}_{}'.format(path.join(self.output.path, self.output.name),EVENTS['EventID'].iloc[e]),Earthquake=EV)
                 toc()
 
             self.MAP    = None
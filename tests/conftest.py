@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package is laid out under src, run the tests on the working tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,142 @@
+'''
+    Parity of the compiled kernels (SeisLoclib) with the NumPy reference backend
+    (SeisLocnp), for both map layouts and both precisions.
+
+'''
+import numpy as np
+import pytest
+
+import SeisLoc.core.SeisLocnp as npk
+from SeisLoc.core.backend import available_backends
+
+if 'compiled' not in available_backends():
+    pytest.skip('The compiled backend lib/SeisLoc.so is not built.', allow_module_level=True)
+
+import SeisLoc.core.SeisLoclib as clk
+
+
+NCELL  = (7, 6, 5)
+NSTN   = 6
+FSMP   = 12
+LSMP   = 30
+NSAMP  = 160
+PEAKS  = [(1, 0), (3, 0), (3, 2)]
+DTYPES = [np.float64, np.float32]
+
+
+def _tol(dtype):
+    ''' Tolerance of the coalescence, the float32 kernels sum in another order. '''
+    return dict(rtol=1e-12, atol=0.0) if dtype == np.float64 else dict(rtol=2e-5, atol=1e-5)
+
+
+def _onsets(dtype, seed=0):
+    ''' P and S onsets with their travel-time index tables. '''
+    rng  = np.random.RandomState(seed)
+    nrow = FSMP + LSMP + NSAMP
+    sigp = (rng.rand(NSTN, nrow)**3).astype(dtype)
+    sigs = (rng.rand(NSTN, nrow)**3).astype(dtype)
+    ttp  = rng.randint(-2, LSMP, NCELL + (NSTN,)).astype(np.int32)
+    tts  = np.minimum(LSMP, ttp + rng.randint(0, 6, ttp.shape)).astype(np.int32)
+    return [(sigp, ttp), (sigs, tts)]
+
+
+def _map(mod, phases, layout='cell', **kwargs):
+    dtype = phases[0][0].dtype
+    shape = NCELL + (NSAMP,) if layout == 'cell' else (NSAMP,) + NCELL
+    map4d = np.zeros(shape, dtype=dtype)
+    mod.scan(phases, None, FSMP, LSMP, NSAMP, map4d, 2, layout=layout, **kwargs)
+    return map4d
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('layout,kernel', [('cell', 'direct'), ('cell', 'tiled'), ('time', 'direct')])
+def test_scan(dtype, layout, kernel):
+    phases = _onsets(dtype)
+    opts   = dict(kernel=kernel, stations=[[0, 2, 3, 5], [1, 2, 4]], weights=[1.0, 0.5])
+    np.testing.assert_allclose(_map(clk, phases, layout, **opts), _map(npk, phases, layout, **opts), **_tol(dtype))
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('layout', ['cell', 'time'])
+def test_scan_cells(dtype, layout):
+    phases = _onsets(dtype)
+    cells  = np.sort(np.random.RandomState(1).choice(np.prod(NCELL), 40, replace=False)).astype(np.int64)
+    cmap   = _map(clk, phases, layout, cells=cells)
+    np.testing.assert_allclose(cmap, _map(npk, phases, layout, cells=cells), **_tol(dtype))
+
+    # The cells outside the region of interest are left unchanged
+    flat = (cmap if layout == 'cell' else np.moveaxis(cmap, 0, -1)).reshape(-1, NSAMP)
+    assert not np.any(np.delete(flat, cells, axis=0))
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('layout', ['cell', 'time'])
+@pytest.mark.parametrize('peaks,separation', PEAKS)
+def test_detect(dtype, layout, peaks, separation):
+    map4d = _map(clk, _onsets(dtype), layout)
+    out   = []
+    for mod in (clk, npk):
+        dsnr = np.zeros((peaks, NSAMP), dtype)
+        dind = np.zeros((peaks, NSAMP), np.int64)
+        norm = np.zeros(NSAMP, dtype)
+        mod.detect(map4d, dsnr, dind, 0, NSAMP, 2, peaks=peaks, separation=separation, layout=layout, norm=norm)
+        out.append((dsnr, dind, norm))
+    np.testing.assert_allclose(out[0][0], out[1][0], **_tol(dtype))
+    np.testing.assert_allclose(out[0][2], out[1][2], **_tol(dtype))
+    np.testing.assert_array_equal(out[0][1], out[1][1])
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('peaks,separation', PEAKS)
+def test_scan_detect(dtype, peaks, separation):
+    phases = _onsets(dtype)
+    cells  = np.sort(np.random.RandomState(2).choice(np.prod(NCELL), 120, replace=False)).astype(np.int64)
+    out    = []
+    for mod in (clk, npk):
+        dsnr = np.zeros((peaks, NSAMP), dtype)
+        dind = np.zeros((peaks, NSAMP), np.int64)
+        mod.scan_detect(phases, None, FSMP, LSMP, NSAMP, dsnr, dind, 2, cells=cells, stations=[[0, 1, 3, 4], [0, 2, 5]],
+                        weights=[0.7, 1.3], peaks=peaks, separation=separation)
+        out.append((dsnr, dind))
+    np.testing.assert_allclose(out[0][0], out[1][0], **_tol(dtype))
+    np.testing.assert_array_equal(out[0][1], out[1][1])
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_scan_detect_matches_scan(dtype):
+    ''' The fused kernel returns the maximum of the map of scan. '''
+    phases = _onsets(dtype)
+    map4d  = _map(clk, phases)
+    dsnr   = np.zeros(NSAMP, dtype)
+    dind   = np.zeros(NSAMP, np.int64)
+    clk.scan_detect(phases, None, FSMP, LSMP, NSAMP, dsnr, dind, 2)
+    np.testing.assert_allclose(dsnr, map4d.reshape(-1, NSAMP).max(axis=0), **_tol(dtype))
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('layout', ['cell', 'time'])
+@pytest.mark.parametrize('reduce', ['logsumexp', 'max'])
+def test_marginal(dtype, layout, reduce):
+    map4d = _map(clk, _onsets(dtype), layout)
+    out   = []
+    for mod in (clk, npk):
+        mout = np.zeros(NCELL, dtype)
+        mod.marginal(map4d, mout, 10, 120, 2, reduce=reduce, layout=layout)
+        out.append(mout)
+    np.testing.assert_allclose(out[0], out[1], **_tol(dtype))
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_jackknife(dtype):
+    phases = _onsets(dtype)
+    cells  = np.arange(0, np.prod(NCELL), 3, dtype=np.int64)
+    out    = []
+    for mod in (clk, npk):
+        dsnr = np.zeros(NSTN + 1, dtype)
+        dind = np.zeros(NSTN + 1, np.int64)
+        dsmp = np.zeros(NSTN + 1, np.int32)
+        mod.jackknife(phases, None, FSMP, LSMP, NSAMP, 20, 140, dsnr, dind, dsmp, 2, cells=cells, weights=[1.0, 0.5])
+        out.append((dsnr, dind, dsmp))
+    np.testing.assert_allclose(out[0][0], out[1][0], **_tol(dtype))
+    np.testing.assert_array_equal(out[0][1], out[1][1])
+    np.testing.assert_array_equal(out[0][2], out[1][2])
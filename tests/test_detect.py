@@ -0,0 +1,422 @@
+'''
+    Detect on a short synthetic record of three events, written as MSEED in the
+    YEAR/JD/STATION structure. The .scn of each option is compared with the plain
+    windowed scan.
+
+'''
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import SeisLoc.core.model as cmod
+import SeisLoc.io.mseed as cmseed
+import SeisLoc.signal.scan as cscan
+from SeisLoc.signal.scan import _read_scan
+
+obspy = pytest.importorskip('obspy')
+
+
+STATIONS    = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Examples', 'SeisLoc_inputs', 'Stations.txt')
+SAMPLE_RATE = 100.0
+RECORD      = '2014-06-29T18:40:00.0'
+START       = '2014-06-29T18:40:03.0'
+END         = '2014-06-29T18:40:27.0'
+EVENTS      = [(8.3, (3, 4, 12)), (15.6, (8, 2, 6)), (21.1, (5, 9, 20))]
+THRESHOLD   = 5.0
+
+
+def _ricker(freq, t):
+    a = (np.pi * freq * t)**2
+    return (1.0 - 2.0*a) * np.exp(-a)
+
+
+def _homogeneous(root, name, vp, vs):
+    ''' LUT of the example stations over a small homogeneous grid. '''
+    lut = cmod.LUT(center=[0.0, 0.0, 0.0], cell_count=[12, 12, 30], cell_size=[200, 200, 100], azimuth=0.0)
+    lut.set_lonlat(-17.224, 64.328)
+    lut.lcc_standard_parallels = (64.32, 64.335)
+    lut.setproj_wgs84('LCC')
+    lut.set_station(pd.read_csv(STATIONS, delimiter=',').values, units='lat_lon_elev')
+    lut.compute_Homogeous(vp, vs)
+    lut.save(os.path.join(root, name))
+    return lut
+
+
+@pytest.fixture(scope='module')
+def record(tmp_path_factory):
+    '''
+        Homogeneous LUT of the example stations and 35 s of noise with the P (Z)
+        and S (E, N) wavelets of EVENTS.
+    '''
+    root = str(tmp_path_factory.mktemp('detect'))
+    lut  = _homogeneous(root, 'synthetic.LUT', 3630, 1833)
+
+    rng   = np.random.RandomState(11)
+    t0    = obspy.UTCDateTime(RECORD)
+    tm    = np.arange(int(35*SAMPLE_RATE)) / SAMPLE_RATE
+    ttp   = lut.fetch_map('TIME_P')
+    tts   = lut.fetch_map('TIME_S')
+    mseed = os.path.join(root, 'MSEED', '2014', '180')
+    os.makedirs(mseed)
+    for st, name in enumerate(lut.station_data['Name']):
+        data = {comp: rng.normal(0.0, 1.0, tm.size) for comp in 'ENZ'}
+        for te, cell in EVENTS:
+            data['Z'] += 12.0 * _ricker(8.0, tm - te - ttp[cell + (st,)])
+            data['E'] += 12.0 * _ricker(6.0, tm - te - tts[cell + (st,)])
+            data['N'] += 12.0 * _ricker(6.0, tm - te - tts[cell + (st,)])
+        for comp in 'ENZ':
+            tr = obspy.Trace(data[comp].astype(np.float32), header=dict(network='SY', station=name, channel='HH' + comp,
+                                                                         sampling_rate=SAMPLE_RATE, starttime=t0))
+            tr.write(os.path.join(mseed, '2014180_{}_{}.m'.format(name, comp)), format='MSEED')
+    return root
+
+
+def _scan(record, name, lut='synthetic.LUT', **options):
+    DATA = cmseed.MSEED(os.path.join(record, lut), HOST_PATH=os.path.join(record, 'MSEED'))
+    DATA.path_structure(TYPE='YEAR/JD/STATION')
+    scn  = cscan.SeisScan(DATA, os.path.join(record, lut), output_path=record, output_name=name)
+    scn.sample_rate   = SAMPLE_RATE
+    scn.bp_filter_p1  = [5, 20, 3]
+    scn.bp_filter_s1  = [5, 20, 3]
+    scn.onset_win_p1  = [0.1, 0.5]
+    scn.onset_win_s1  = [0.1, 0.5]
+    scn.time_step     = 1.0
+    scn.Decimate      = [1, 1, 1]
+    scn.NumberOfCores = 2
+    for key, value in options.items():
+        setattr(scn, key, value)
+    return scn
+
+
+def _detect(record, name, **options):
+    _scan(record, name, **options).Detect(START, END)
+    return _read_scan(os.path.join(record, name + '.scn'))
+
+
+@pytest.fixture(scope='module')
+def windowed(record):
+    return _detect(record, 'windowed')
+
+
+def _trigger_scan(record, name, **options):
+    scn = _scan(record, name, **options)
+    scn.DetectionThreshold = THRESHOLD
+    scn.MarginalWindow     = 1.0
+    scn.MinimumRepeat      = 1.0
+    return scn
+
+
+def _assert_close(scn, ref):
+    '''
+        Same samples, and above THRESHOLD the same coalescence and locations. Below
+        it the coalescence depends on the edges of the windows read, which differ
+        for BatchWindows.
+    '''
+    np.testing.assert_array_equal(scn['DT'].values, ref['DT'].values)
+    assert np.all(np.isfinite(scn['COA'].values))
+    event = ref['COA'].values > THRESHOLD
+    assert np.sum(event) > 0
+    np.testing.assert_allclose(scn['COA'].values[event], ref['COA'].values[event], rtol=1e-3)
+    np.testing.assert_array_equal(scn[['X', 'Y', 'Z']].values[event], ref[['X', 'Y', 'Z']].values[event])
+
+
+def test_windowed_events(windowed):
+    assert len(windowed) == 24 * SAMPLE_RATE
+    for te, cell in EVENTS:
+        near = np.abs((windowed['DT'] - pd.Timestamp(RECORD)).dt.total_seconds() - te) < 0.5
+        assert windowed['COA'][near].max() > THRESHOLD
+
+
+def test_precision_validate(record, windowed):
+    scn = _scan(record, 'float32', Precision='float32', PrecisionValidate=True)
+    scn.Detect(START, END)
+    assert scn.PrecisionDeviation['dsnr_relative'] < 1e-5
+    assert scn.PrecisionDeviation['dind'] == 0
+    np.testing.assert_allclose(_read_scan(os.path.join(record, 'float32.scn'))['COA'].values, windowed['COA'].values, rtol=1e-5)
+
+
+def test_precision_validate_deviation(record, monkeypatch):
+    # A float32 path off by 1% and one cell must be reported against the float64 path
+    coalesce = cscan.SeisScan._coalesce
+
+    def shifted(self, phases, *args):
+        dsnr, dind, _map = coalesce(self, phases, *args)
+        if phases[0][0].dtype == np.float32:
+            dsnr, dind = dsnr * np.float32(1.01), dind + 1
+        return dsnr, dind, _map
+
+    monkeypatch.setattr(cscan.SeisScan, '_coalesce', shifted)
+    scn = _scan(record, 'float32_shifted', Precision='float32', PrecisionValidate=True)
+    scn.Detect(START, END)
+    np.testing.assert_allclose(scn.PrecisionDeviation['dsnr_relative'], 0.01, rtol=1e-3)
+    assert scn.PrecisionDeviation['dind'] > SAMPLE_RATE * scn.time_step // 2
+
+
+def test_hierarchical(record, windowed):
+    scn = _detect(record, 'hierarchical', HierarchicalDecimate=[[4, 4, 4], [2, 2, 2]])
+    np.testing.assert_array_equal(scn['DT'].values, windowed['DT'].values)
+    assert np.all(scn['COA'].values <= windowed['COA'].values * (1 + 1e-12))
+    event = windowed['COA'].values > THRESHOLD
+    np.testing.assert_array_equal(scn[['X', 'Y', 'Z']].values[event], windowed[['X', 'Y', 'Z']].values[event])
+
+
+def _lut(record):
+    lut = cmod.LUT()
+    lut.load(os.path.join(record, 'synthetic.LUT'))
+    return lut
+
+
+def _cells(lut, scn):
+    ''' Grid cells (x, y, z) of the .scn locations. '''
+    index   = np.arange(np.prod(lut.cell_count))
+    grid    = lut.xyz2coord(lut.index2xyz(index))
+    coords, inverse = np.unique(scn[['X', 'Y', 'Z']].values, axis=0, return_inverse=True)
+    match   = np.all(np.isclose(grid[:, np.newaxis, :], coords[np.newaxis, :, :], rtol=0.0, atol=1e-9), axis=2)
+    assert np.all(np.sum(match, axis=0) == 1)
+    return lut.index2loc(index[np.argmax(match, axis=0)])[inverse.ravel()]
+
+
+def test_scan_mask(record, windowed):
+    lut  = _lut(record)
+    mask = np.zeros(lut.cell_count, dtype=bool)
+    for te, (x, y, z) in EVENTS:
+        mask[max(x - 2, 0):x + 3, max(y - 2, 0):y + 3, max(z - 2, 0):z + 3] = True
+    scn = _detect(record, 'mask', ScanMask=mask)
+    assert np.all(mask[tuple(_cells(lut, scn).T)])
+
+    # The samples located inside the region of interest by the full scan are unchanged
+    event = mask[tuple(_cells(lut, windowed).T)]
+    assert windowed['COA'][event].max() == windowed['COA'].max()
+    np.testing.assert_allclose(scn['COA'].values[event], windowed['COA'].values[event], rtol=1e-12)
+    np.testing.assert_array_equal(scn[['X', 'Y', 'Z']].values[event], windowed[['X', 'Y', 'Z']].values[event])
+    assert np.all(scn['COA'].values <= windowed['COA'].values * (1 + 1e-12))
+
+
+def test_scan_points(record, windowed):
+    lut    = _lut(record)
+    points = lut.loc2xyz(np.array([cell for te, cell in EVENTS], dtype=float))
+    scn    = _detect(record, 'points', ScanPoints=points)
+    cells  = {tuple(cell) for te, cell in EVENTS}
+    assert {tuple(cell) for cell in _cells(lut, scn)} <= cells
+    assert np.all(scn['COA'].values <= windowed['COA'].values * (1 + 1e-12))
+    with pytest.raises(ValueError):
+        _detect(record, 'points_outside', ScanPoints=lut.loc2xyz(np.array([[-3.0, 0.0, 0.0]])))
+
+
+def test_screen(record, windowed):
+    scn = _scan(record, 'screen', ScreenDecimate=[3, 3, 3], DetectionThreshold=THRESHOLD)
+    scn.Detect(START, END)
+    assert 0 < scn._screened[0] < scn._screened[1]
+
+    # The windows of the events are scanned in full, the skipped ones keep the screening result
+    CoaVal = _read_scan(os.path.join(record, 'screen.scn'))
+    np.testing.assert_array_equal(CoaVal['DT'].values, windowed['DT'].values)
+    event  = windowed['COA'].values > THRESHOLD
+    np.testing.assert_allclose(CoaVal['COA'].values[event], windowed['COA'].values[event], rtol=1e-12)
+    np.testing.assert_array_equal(CoaVal[['X', 'Y', 'Z']].values[event], windowed[['X', 'Y', 'Z']].values[event])
+    assert np.all(CoaVal['COA'].values <= windowed['COA'].values * (1 + 1e-12))
+    assert np.sum(CoaVal['COA'].values < windowed['COA'].values) > 0
+
+    events = _trigger_scan(record, 'screen')._Trigger_scn(CoaVal, START, END)
+    pd.testing.assert_frame_equal(events, _trigger_scan(record, 'windowed')._Trigger_scn(windowed, START, END))
+    assert len(events) == len(EVENTS)
+
+
+@pytest.mark.parametrize('downsample', [3, 5])
+def test_downsample(record, windowed, downsample):
+    # 3 does not divide the 100 samples of a window, the blocks continue across windows
+    CoaVal = _detect(record, 'downsample{}'.format(downsample), DetectionDownsample=downsample)
+    step   = np.timedelta64(int(1e6 * downsample / SAMPLE_RATE), 'us')
+    assert np.all(np.diff(CoaVal['DT'].values) == step)
+    assert CoaVal['DT'].iloc[0] == pd.Timestamp(START)
+    assert len(CoaVal) == -(-len(windowed) // downsample)
+
+    # Trigger finds the same events, within a block in time and a cell in space
+    lut    = _lut(record)
+    events = _trigger_scan(record, 'downsample')._Trigger_scn(CoaVal, START, END)
+    single = _trigger_scan(record, 'windowed')._Trigger_scn(windowed, START, END)
+    assert len(events) == len(single) == len(EVENTS)
+    lag = (events['CoaTime'] - single['CoaTime']).dt.total_seconds().abs()
+    assert np.all(lag <= 1.5 * downsample / SAMPLE_RATE)
+    cells = [_cells(lut, frame[['COA_X', 'COA_Y', 'COA_Z']].set_axis(['X', 'Y', 'Z'], axis=1)) for frame in (events, single)]
+    assert np.all(np.abs(cells[0] - cells[1]) <= 1)
+
+
+def test_deduplicate_cells(record, windowed):
+    pd.testing.assert_frame_equal(_detect(record, 'deduplicate', DeduplicateCells=True), windowed)
+
+
+def test_batch_windows(record, windowed):
+    # The onsets of a batch are computed over its whole span (see _batch_windows)
+    _assert_close(_detect(record, 'batch', BatchWindows=3), windowed)
+
+
+def test_models(record, monkeypatch):
+    slow  = _homogeneous(record, 'slow.LUT', 3300, 1650)
+    ttmax = np.max(slow.fetch_map('TIME_S'))
+    pad   = int(np.ceil(ttmax + ttmax*0.05))
+
+    # The onsets are computed once per window for both models
+    onset = cscan.SeisScan._compute_onset_p1
+    calls = []
+
+    def count(self, *args):
+        calls.append(args)
+        return onset(self, *args)
+
+    monkeypatch.setattr(cscan.SeisScan, '_compute_onset_p1', count)
+    scn = _scan(record, 'models', Models=[(os.path.join(record, 'slow.LUT'), 'models_slow')])
+    scn.Detect(START, END)
+    assert len(calls) == 24
+    assert scn.post_pad >= pad
+    monkeypatch.undo()
+
+    # Each .scn is that of a scan of its model alone, over the same windows
+    for name, lut in (('models', 'synthetic.LUT'), ('models_slow', 'slow.LUT')):
+        single = _detect(record, name + '_single', lut=lut, post_pad=pad)
+        pd.testing.assert_frame_equal(_read_scan(os.path.join(record, name + '.scn')), single)
+
+
+def test_read_ahead(record, windowed, monkeypatch):
+    read  = obspy.read
+    files = []
+
+    def count(fname, *args, **kwargs):
+        files.append(fname)
+        return read(fname, *args, **kwargs)
+
+    monkeypatch.setattr(obspy, 'read', count)
+    scn = _detect(record, 'read_ahead', ReadAhead=10.0)
+    pd.testing.assert_frame_equal(scn, windowed)
+
+    # Each file is read for the first window and again every ReadAhead seconds,
+    # rather than twice for each of the 24 windows
+    nfile = len(set(files))
+    assert len(files) == 3 * nfile
+
+
+def test_prefetch(record, windowed):
+    pd.testing.assert_frame_equal(_detect(record, 'prefetch', PrefetchWindows=2), windowed)
+
+
+def test_prefetch_error(record, monkeypatch):
+    # An error of the background thread is raised by Detect
+    def fail(self, *args, **kwargs):
+        raise IOError('unreadable')
+
+    monkeypatch.setattr(cmseed.MSEED, 'read_mseed', fail)
+    with pytest.raises(IOError, match='unreadable'):
+        _detect(record, 'prefetch_error', PrefetchWindows=2)
+
+
+def test_processes(record, windowed):
+    scn = _detect(record, 'processes', DetectProcesses=2, DetectShards=3, ShareLUT=False)
+    pd.testing.assert_frame_equal(scn, windowed)
+    # The part files of the shards are merged and removed
+    assert not [fname for fname in os.listdir(record) if fname.startswith('processes.part')]
+
+
+def test_share_lut(record, windowed, monkeypatch):
+    directories = []
+    share       = cmod.LUT.share
+
+    def record_share(self, *args):
+        shared = share(self, *args)
+        directories.append(shared._shared[0])
+        return shared
+
+    monkeypatch.setattr(cmod.LUT, 'share', record_share)
+    scn = _detect(record, 'share_lut', DetectProcesses=2, DetectShards=2, ShareLUT=True, DeduplicateCells=True)
+    pd.testing.assert_frame_equal(scn, windowed)
+    # The shared tables are removed from /dev/shm after the scan
+    assert len(directories) == 1
+    assert not os.path.exists(directories[0])
+
+
+class _Interrupt(Exception):
+    pass
+
+
+def _interrupted(record, name, monkeypatch, reads, **options):
+    ''' Detect stopped by an exception at the read of window reads + 1. '''
+    read  = cmseed.MSEED.read_mseed
+    count = [0]
+
+    def fail(self, *args, **kwargs):
+        count[0] += 1
+        if count[0] > reads:
+            raise _Interrupt()
+        return read(self, *args, **kwargs)
+
+    with monkeypatch.context() as mp:
+        mp.setattr(cmseed.MSEED, 'read_mseed', fail)
+        with pytest.raises(_Interrupt):
+            _scan(record, name, **options).Detect(START, END)
+
+
+def test_resume(record, windowed, monkeypatch):
+    # A window partly written when the run stopped is truncated from the .scn
+    _interrupted(record, 'resume', monkeypatch, 9)
+    with open(os.path.join(record, 'resume.scn'), 'a') as fp:
+        fp.write('2014-06-29 18:40:12.000,1.0')
+    scn = _detect(record, 'resume', DetectResume=True)
+    pd.testing.assert_frame_equal(scn, windowed)
+
+
+def test_resume_batches(record, windowed, monkeypatch):
+    # Interrupted in the middle of a batch of three windows, resumed with batches of two
+    _interrupted(record, 'resume_batches', monkeypatch, 3, BatchWindows=3)
+    scn = _detect(record, 'resume_batches', DetectResume=True, BatchWindows=2)
+    _assert_close(scn, windowed)
+
+
+def test_resume_mismatch(record, monkeypatch):
+    _interrupted(record, 'resume_mismatch', monkeypatch, 2)
+    with pytest.raises(ValueError, match='Mismatch between the Detect parameters'):
+        _detect(record, 'resume_mismatch', DetectResume=True, time_step=2.0)
+
+def test_trigger_peaks(record, windowed):
+    CoaVal = _detect(record, 'peaks', DetectionPeaks=2)
+    pd.testing.assert_frame_equal(CoaVal[['DT', 'COA', 'X', 'Y', 'Z']], windowed)
+
+    # A second event at 18:40:12 on the further peak only, at the location of the third event
+    t     = (CoaVal['DT'] - pd.Timestamp(RECORD)).dt.total_seconds()
+    inset = (t >= 12.0) & (t < 12.3)
+    third = windowed['COA'][np.abs(t - EVENTS[2][0]) < 0.5].idxmax()
+    CoaVal.loc[inset, 'COA_2'] = 2 * THRESHOLD
+    CoaVal.loc[inset, ['X_2', 'Y_2', 'Z_2']] = windowed.loc[third, ['X', 'Y', 'Z']].values
+
+    scn    = _trigger_scan(record, 'peaks', DetectionPeaks=2)
+    single = scn._Trigger_scn(windowed, START, END)
+    events = scn._Trigger_scn(CoaVal, START, END)
+    assert len(single) == len(EVENTS)
+    pd.testing.assert_frame_equal(events[events['Peak'] == 1].drop(columns='EventNum').reset_index(drop=True),
+                                  single.drop(columns='EventNum'))
+    assert all(isinstance(evid, str) for evid in events['EventID'])
+    assert '20140629184012000_2' in list(events['EventID'][events['Peak'] == 2])
+
+
+def test_trigger_jackknife(record, windowed):
+    scn = _trigger_scan(record, 'windowed', StationJackknife=True)
+    scn.Trigger(START, END)
+    names = list(_lut(record).station_data['Name'])
+    for evid in scn._Trigger_scn(windowed, START, END)['EventID']:
+        EV = pd.read_csv(os.path.join(record, 'windowed_{}.event'.format(evid)))
+        assert len(EV) == 1
+        assert list(EV.columns[-(1 + 2*len(names)):]) == (['Jackknife_COA'] + ['Jackknife_COA_{}'.format(n) for n in names] +
+                                                          ['Jackknife_Shift_{}'.format(n) for n in names])
+        # The stack of all stations is the event maximum, every station is stacked
+        np.testing.assert_allclose(EV['Jackknife_COA'], EV['DecCOA'], rtol=1e-9)
+        loo = EV[['Jackknife_COA_{}'.format(n) for n in names]].values
+        assert np.all(np.isfinite(loo)) and np.all(loo > 0)
+        assert np.all(EV[['Jackknife_Shift_{}'.format(n) for n in names]].values >= 0)
+
+
+def test_trigger_no_events(record, windowed):
+    scn = _trigger_scan(record, 'windowed')
+    scn.DetectionThreshold = 10 * windowed['COA'].max()
+    events = scn._Trigger_scn(windowed, START, END)
+    assert len(events) == 0
+    assert 'EventID' in events.columns
@@ -0,0 +1,76 @@
+'''
+    Travel-time tables of SeisLoc.core.model.LUT published in shared memory by
+    LUT.share, for the Detect worker processes.
+
+'''
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import SeisLoc.core.model as cmod
+
+
+STATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Examples', 'SeisLoc_inputs', 'Stations.txt')
+RATE     = 100.0
+
+
+@pytest.fixture
+def lut():
+    ''' Homogeneous LUT of the example stations with its index tables cached. '''
+    lut = cmod.LUT(center=[0.0, 0.0, 0.0], cell_count=[6, 5, 4], cell_size=[200, 200, 100], azimuth=0.0)
+    lut.set_lonlat(-17.224, 64.328)
+    lut.lcc_standard_parallels = (64.32, 64.335)
+    lut.setproj_wgs84('LCC')
+    lut.set_station(pd.read_csv(STATIONS, delimiter=',').values, units='lat_lon_elev')
+    lut.compute_Homogeous(3630, 1833)
+    lut.fetch_index_table(['TIME_P'], RATE)
+    lut.fetch_index_table(['TIME_P', 'TIME_S'], RATE)
+    lut.fetch_unique_cells(['TIME_P', 'TIME_S'], RATE)
+    return lut
+
+
+def _assert_shared(shared, lut):
+    ''' The tables of shared equal those of lut, as read-only memory maps. '''
+    assert sorted(shared.maps) == sorted(lut.maps)
+    for name, map in lut.maps.items():
+        assert isinstance(shared.maps[name], np.memmap)
+        assert not shared.maps[name].flags.writeable
+        np.testing.assert_array_equal(shared.maps[name], map)
+
+    assert sorted(shared._index_cache, key=str) == sorted(lut._index_cache, key=str)
+    for key, value in lut._index_cache.items():
+        values = value if isinstance(value, tuple) else (value,)
+        tables = shared._index_cache[key] if isinstance(value, tuple) else (shared._index_cache[key],)
+        for table, array in zip(tables, values):
+            assert isinstance(table, np.memmap)
+            np.testing.assert_array_equal(table, array)
+
+
+def test_share(lut):
+    shared    = lut.share()
+    directory = shared._shared[0]
+    try:
+        if os.path.isdir('/dev/shm'):
+            assert os.path.dirname(directory) == '/dev/shm'
+        _assert_shared(shared, lut)
+
+        # Pickled without its tables, they are mapped again from the files
+        nbyte = sum(map.nbytes for map in lut.maps.values())
+        text  = pickle.dumps(shared)
+        assert len(text) < nbyte / 10
+        _assert_shared(pickle.loads(text), lut)
+
+        attached = cmod.LUT.__new__(cmod.LUT)
+        attached.attach(directory)
+        _assert_shared(attached, lut)
+        np.testing.assert_array_equal(attached.fetch_index_table(['TIME_P', 'TIME_S'], RATE),
+                                      lut.fetch_index_table(['TIME_P', 'TIME_S'], RATE))
+    finally:
+        shared.unshare()
+
+    # The files are removed, the maps already attached stay readable
+    assert not os.path.exists(directory)
+    np.testing.assert_array_equal(shared.maps['TIME_P'], lut.maps['TIME_P'])
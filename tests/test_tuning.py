@@ -0,0 +1,91 @@
+'''
+    Kernel tuning cache of SeisLoc.core.tuning, kept in $SEISLOC_CACHE for each
+    host and travel-time table shape.
+
+'''
+import json
+
+import numpy as np
+import pytest
+
+import SeisLoc.core.backend as ilib
+import SeisLoc.core.tuning as tuning
+
+if 'compiled' not in ilib.available_backends():
+    pytest.skip('The compiled backend lib/SeisLoc.so is not built.', allow_module_level=True)
+
+
+FSMP  = 10
+LSMP  = 20
+NSAMP = 200
+
+
+def _phases(ncell, nstn=4, seed=0):
+    rng = np.random.RandomState(seed)
+    return [(rng.rand(nstn, FSMP + LSMP + NSAMP), rng.randint(0, LSMP, ncell + (nstn,)).astype(np.int32)) for phase in 'PS']
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    ''' Empty cache directory, and nothing tuned yet in this process. '''
+    monkeypatch.setenv(tuning.CACHE_VARIABLE, str(tmp_path))
+    monkeypatch.setattr(tuning, '_settings', {})
+    ilib.set_backend('compiled')
+    return tmp_path
+
+
+def _calibrations(monkeypatch):
+    ''' Counting the calls of tuning.calibrate. '''
+    calls     = []
+    calibrate = tuning.calibrate
+
+    def count(*args, **kwargs):
+        calls.append(args)
+        return calibrate(*args, **kwargs)
+
+    monkeypatch.setattr(tuning, 'calibrate', count)
+    return calls
+
+
+def test_cache_written(cache, monkeypatch):
+    calls    = _calibrations(monkeypatch)
+    settings = tuning.kernel_settings(_phases((5, 4, 3)), None, FSMP, LSMP, NSAMP, max_threads=2)
+    assert len(calls) == 1
+    assert tuning.cache_file().startswith(str(cache))
+
+    with open(tuning.cache_file(), 'r') as fp:
+        stored = json.load(fp)
+    assert list(stored) == [tuning._host()]
+    (key, cached), = stored[tuning._host()].items()
+    assert key == tuning._key((5, 4, 3, 8), NSAMP, np.float64, 'compiled')
+    assert cached == settings
+    for stage in tuning.STAGES:
+        assert 1 <= settings[stage]['threads'] <= 2
+    assert set(settings['layout'].values()) <= {'cell', 'time'}
+
+
+def test_cache_read(cache, monkeypatch):
+    settings = tuning.kernel_settings(_phases((5, 4, 3)), None, FSMP, LSMP, NSAMP, max_threads=2)
+
+    # A new process reads the settings of the same shape from the file
+    monkeypatch.setattr(tuning, '_settings', {})
+    calls = _calibrations(monkeypatch)
+    assert tuning.kernel_settings(_phases((5, 4, 3), seed=1), None, FSMP, LSMP, NSAMP, max_threads=2) == settings
+    assert len(calls) == 0
+
+    # Another grid shape or precision is calibrated again and added to the file
+    tuning.kernel_settings(_phases((6, 4, 3)), None, FSMP, LSMP, NSAMP, max_threads=2)
+    tuning.kernel_settings([(sig.astype(np.float32), tt) for sig, tt in _phases((5, 4, 3))], None, FSMP, LSMP, NSAMP, max_threads=2)
+    assert len(calls) == 2
+    with open(tuning.cache_file(), 'r') as fp:
+        assert len(json.load(fp)[tuning._host()]) == 3
+
+
+def test_cache_unreadable(cache, monkeypatch):
+    with open(tuning.cache_file(), 'w') as fp:
+        fp.write('{')
+    calls = _calibrations(monkeypatch)
+    tuning.kernel_settings(_phases((5, 4, 3)), None, FSMP, LSMP, NSAMP, max_threads=2)
+    assert len(calls) == 1
+    with open(tuning.cache_file(), 'r') as fp:
+        assert len(json.load(fp)[tuning._host()]) == 1